@@ -28,11 +28,13 @@ from sklearn.metrics import roc_auc_score
 import math
 import time
 import numpy as np
-import matplotlib.pyplot as plt
+import scipy.sparse as sp
+from E_Pipeline_Utilities import defer_plot, profiled, profile_span
 
 # -------------------- FUNCTIONS FOR FEATURE ENGINEERING -------------------------- #
 
 
+@profiled()
 def merge_datasets(train, validation, test):
     """
     Merges datasets for preprocessing
@@ -44,6 +46,7 @@ def merge_datasets(train, validation, test):
     return data
 
 
+@profiled()
 def separate_datasets(merged, train, validation, test):
     """
     Separates preprocessed datasets
@@ -56,13 +59,33 @@ def separate_datasets(merged, train, validation, test):
     return train, validation, test
 
 
+def split_useragents(useragents):
+    """
+    Operating system and browser of a useragent column as categoricals (int8 codes), splitting only the distinct
+    useragents and broadcasting the codes back to the rows
+    """
+
+    useragent_codes, distinct_useragents = pd.factorize(useragents)
+    parts = pd.Series(np.asarray(distinct_useragents, dtype=object)).str.split('_', n=1)
+
+    output = []
+    for part in [parts.str[0], parts.str[1]]:
+        part_codes, categories = pd.factorize(part, sort=True)
+
+        # Missing useragents (code -1) pick up the -1 appended at the end
+        codes = np.append(part_codes, -1).astype(np.int8 if len(categories) < 128 else np.int16)[useragent_codes]
+        output.append(pd.Categorical.from_codes(codes, categories))
+
+    return output
+
+
 def separate_useragent(data):
     """
     Separates operating system and internet browser in useragent variable
     """
 
-    # Split the useragent into two new columns
-    data['opsys'], data['browser'] = data['useragent'].str.split('_').str
+    # Split the useragent into two new categorical columns
+    data['opsys'], data['browser'] = split_useragents(data['useragent'].values)
 
     # Remove column
     data = data.drop(['useragent'], axis=1)
@@ -103,9 +126,165 @@ def slot_width_height_combiner(data):
     return data
 
 
-def add_features(data):
+class UsertagEncoder:
+    """
+    Multi-hot encoding of the comma-separated usertag column into a CSR matrix. The raw strings are tokenised once as
+    bytes: every tag of up to 8 characters (the iPinYou tags are 5 digits or 'null') is packed into a uint64 key and
+    looked up in the sorted vocabulary, longer tags fall back to a dictionary. Missing values count as the 'null'
+    tag. The vocabulary can be fitted chunk by chunk with update, so large logs can be encoded in a stream.
+    """
+
+    def __init__(self, prefix='usertags_', min_count=1):
+        self.prefix = prefix
+        self.min_count = min_count
+        self.counts = {}
+        self.vocabulary = np.array([], dtype=object)
+        self.keys = np.array([], dtype=np.uint64)
+        self.key_columns = np.array([], dtype=np.int64)
+        self.long_tags = {}
+
+    @staticmethod
+    def tokenise(values):
+        """
+        Byte tokens of the strings: packed keys, lengths, start offsets, the row of every token and the buffer
+        """
+
+        values = pd.Series(values).fillna('null').astype(str).to_numpy(dtype=object)
+        text = np.frombuffer(('\n'.join(values) + '\n').encode(), dtype=np.uint8)
+
+        separators = np.flatnonzero((text == 44) | (text == 10)) # ',' and '\n'
+        starts = np.concatenate(([0], separators[:-1] + 1))
+        lengths = separators - starts
+        rows = np.concatenate(([0], np.cumsum(text[separators[:-1]] == 10)))
+
+        # Pack the first 8 bytes of every token into a big-endian uint64
+        padded = np.concatenate((text, np.zeros(8, dtype=np.uint8)))
+        keys = np.zeros(len(starts), dtype=np.uint64)
+
+        for k in range(8):
+            byte = np.where(lengths > k, padded[starts + k], 0).astype(np.uint64)
+            keys |= byte << np.uint64(8 * (7 - k))
+
+        return keys, lengths, starts, rows, text
+
+    @staticmethod
+    def decode_key(key):
+        return int(key).to_bytes(8, 'big').rstrip(b'\0').decode()
+
+    def update(self, values):
+        """
+        Adds the tag counts of a chunk to the vocabulary
+        """
+
+        keys, lengths, starts, rows, text = self.tokenise(values)
+        short = lengths <= 8
+        unique_keys, counts = np.unique(keys[short & (lengths > 0)], return_counts=True)
+
+        for key, count in zip(unique_keys, counts):
+            tag = self.decode_key(key)
+            self.counts[tag] = self.counts.get(tag, 0) + int(count)
+
+        for start, length in zip(starts[~short], lengths[~short]):
+            tag = text[start:start + length].tobytes().decode()
+            self.counts[tag] = self.counts.get(tag, 0) + 1
+
+        return self.build_vocabulary()
+
+    def build_vocabulary(self):
+
+        # Sorted like the columns of str.get_dummies
+        self.vocabulary = np.array(sorted(tag for tag, count in self.counts.items() if count >= self.min_count),
+                                   dtype=object)
+        short_tags = [(i, tag) for i, tag in enumerate(self.vocabulary) if len(tag.encode()) <= 8]
+        self.long_tags = {tag: i for i, tag in enumerate(self.vocabulary) if len(tag.encode()) > 8}
+
+        keys = np.array([int.from_bytes(tag.encode().ljust(8, b'\0'), 'big') for _, tag in short_tags],
+                        dtype=np.uint64)
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.key_columns = np.array([i for i, _ in short_tags], dtype=np.int64)[order]
+
+        return self
+
+    def fit(self, values):
+        self.counts = {}
+        return self.update(values)
+
+    def transform(self, values, dtype=np.uint8):
+        """
+        CSR matrix with one row per value and one column per vocabulary tag; tags outside the vocabulary are ignored
+        """
+
+        keys, lengths, starts, rows, text = self.tokenise(values)
+        n_rows = rows[-1] + 1 if len(rows) else 0
+        columns = np.full(len(keys), -1, dtype=np.int64)
+
+        short = lengths <= 8
+        if len(self.keys):
+            position = np.minimum(np.searchsorted(self.keys, keys[short]), len(self.keys) - 1)
+            columns[short] = np.where(self.keys[position] == keys[short], self.key_columns[position], -1)
+
+        for i in np.flatnonzero(~short):
+            columns[i] = self.long_tags.get(text[starts[i]:starts[i] + lengths[i]].tobytes().decode(), -1)
+
+        known = columns >= 0
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[known], minlength=n_rows))))
+        matrix = sp.csr_matrix((np.ones(known.sum(), dtype=dtype), columns[known], indptr),
+                               shape=(n_rows, len(self.vocabulary)))
+
+        # A tag repeated within a row still counts once
+        matrix.sum_duplicates()
+        matrix.data[:] = 1
+
+        return matrix
+
+    def fit_transform(self, values, dtype=np.uint8):
+        return self.fit(values).transform(values, dtype=dtype)
+
+    def transform_chunks(self, chunks, dtype=np.uint8):
+        """
+        Encodes an iterable of usertag chunks (e.g. from pd.read_csv(..., chunksize=...)) one at a time
+        """
+
+        for chunk in chunks:
+            yield self.transform(chunk, dtype=dtype)
+
+    def columns(self):
+        return [self.prefix + tag for tag in self.vocabulary]
+
+    def to_frame(self, matrix, index=None, sparse='yes'):
+        """
+        The encoded matrix as DataFrame columns, with a sparse uint8 dtype unless sparse='no'
+        """
+
+        if sparse == 'yes':
+            return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=self.columns())
+
+        return pd.DataFrame(matrix.toarray(), index=index, columns=self.columns())
+
+
+def encode_usertag_file(file_name, encoder=None, chunksize=500000, dtype=np.uint8):
     """
-    Add new features to the dataset
+    Usertag CSR matrix of a csv log read in chunks; without a fitted encoder the vocabulary is built in a first pass
+    """
+
+    if encoder is None:
+        encoder = UsertagEncoder()
+        for chunk in pd.read_csv(file_name, usecols=['usertag'], chunksize=chunksize):
+            encoder.update(chunk['usertag'])
+
+    matrices = list(encoder.transform_chunks((chunk['usertag'] for chunk in
+                                              pd.read_csv(file_name, usecols=['usertag'], chunksize=chunksize)),
+                                             dtype=dtype))
+
+    return sp.vstack(matrices, format='csr'), encoder
+
+
+@profiled()
+def add_features(data, usertag_encoder=None, sparse_usertags='yes'):
+    """
+    Add new features to the dataset. The usertag columns come from usertag_encoder (fitted on data if None) and are
+    sparse uint8 columns unless sparse_usertags='no'.
     """
 
     # Separate useragent variable
@@ -114,15 +293,17 @@ def add_features(data):
     # Create a categorical variable for slot size
     data = slot_width_height_combiner(data)
 
-    # Add count variables from usertag
-    data['usertag'] = data['usertag'].str.split(',')
-    data_usertags = data['usertag'].str.join('@').str.get_dummies('@').add_prefix('usertags_')
-    data = pd.concat([data, data_usertags], axis=1)
-    data = data.drop(['usertag'], axis=1)
+    # Add indicator variables from usertag (one tokenising pass into a CSR matrix)
+    if usertag_encoder is None:
+        usertag_encoder = UsertagEncoder().fit(data['usertag'])
+    usertags = usertag_encoder.transform(data['usertag'])
+    data = pd.concat([data.drop(['usertag'], axis=1),
+                      usertag_encoder.to_frame(usertags, index=data.index, sparse=sparse_usertags)], axis=1)
 
     return data
 
 
+@profiled()
 def exclude_irrelevant_features(data, remove_columns = ['bidid', 'userid', 'IP',
                       'domain', 'url', 'urlid', 'slotid']):
     """
@@ -134,6 +315,7 @@ def exclude_irrelevant_features(data, remove_columns = ['bidid', 'userid', 'IP',
     return data
 
 
+@profiled()
 def label_encoder(data, columns_for_enconding = ['slotvisibility', 'slotformat', 'creative', 'keypage']):
     """
     Use binary features only
@@ -159,30 +341,263 @@ def label_encoder(data, columns_for_enconding = ['slotvisibility', 'slotformat',
     return data, inverse_transform_dict
 
 
+@profiled()
 def one_hot_encoding(data, columns_to_encode = ['weekday', 'hour', 'region',
                                                 'city', 'adexchange', 'slotvisibility',
                                                 'slotformat', 'creative', 'keypage',
                                                 'advertiser', 'opsys', 'browser']):
     """
-    One-hot encode multi-class columns
+    One-hot encode multi-class columns (one byte per dummy)
+    """
+
+    data = pd.get_dummies(data, columns=columns_to_encode, dtype=np.uint8)
+
+    return data
+
+
+def get_feature_fields(columns, field_prefixes = ['weekday', 'hour', 'region', 'city', 'adexchange',
+                                                  'slotvisibility', 'slotformat', 'creative', 'keypage',
+                                                  'advertiser', 'opsys', 'browser', 'slot_width_height',
+                                                  'slotprice', 'usertags']):
+    """
+    Map one-hot encoded columns back to the field (original variable) they were created from. Columns that do not
+    belong to any one-hot group get a field of their own.
+    """
+
+    # Match the longest prefix first (e.g. 'slot_width_height' before 'slot')
+    prefixes = sorted(field_prefixes, key=len, reverse=True)
+
+    field_names = []
+    fields = np.zeros(len(columns), dtype=np.int32)
+
+    for i, column in enumerate(columns):
+        field = next((prefix for prefix in prefixes if str(column).startswith(prefix + '_')), str(column))
+
+        if field not in field_names:
+            field_names.append(field)
+
+        fields[i] = field_names.index(field)
+
+    return fields, field_names
+
+
+def fit_feature_encoder(data, categorical_columns, remove_columns, usertag_encoder, target_encoder=None):
+    """
+    Everything needed to encode new raw rows (e.g. chunks of the test log) exactly like the merged training data:
+    the removed columns, the categories of every categorical column, the usertag vocabulary and, with target
+    encoding, the target encoder. Call it on the data after add_features and set 'feature_columns' to the model
+    columns once the data is encoded.
+    """
+
+    categories = {}
+    for column in categorical_columns:
+        values = data[column]
+        categories[column] = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) \
+            else pd.Index(np.sort(values.dropna().unique()))
+
+    return {'remove_columns': list(remove_columns), 'categorical_columns': list(categorical_columns),
+            'categories': categories, 'usertag_encoder': usertag_encoder, 'target_encoder': target_encoder,
+            'feature_columns': None}
+
+
+def encode_features(data, encoder):
+    """
+    Raw log rows to the model columns of a fitted feature encoder; categories and usertags that were not seen in
+    training get no column, and dummies keep their uint8 dtype
+    """
+
+    data = exclude_irrelevant_features(data, remove_columns=[column for column in encoder['remove_columns']
+                                                             if column in data.columns])
+    data['slotprice'] = slot_price_buckets(data['slotprice'].values)
+    data = add_features(data, usertag_encoder=encoder['usertag_encoder'])
+
+    if encoder['target_encoder'] is not None:
+        data = apply_target_encoding(data, encoder['target_encoder'])
+        data = data.drop(encoder['categorical_columns'], axis=1)
+
+    else:
+        # Fixed categories give every chunk the same dummy columns
+        for column in encoder['categorical_columns']:
+            data[column] = pd.Categorical(data[column], categories=encoder['categories'][column])
+        data = pd.get_dummies(data, columns=encoder['categorical_columns'], dtype=np.uint8)
+
+    return data.reindex(columns=encoder['feature_columns'], fill_value=0)
+
+
+def model_features(data, dtype=np.float32, exclude_columns=['click', 'bidprice', 'payprice']):
+    """
+    Feature matrix for the models. The frame keeps its uint8 dummies and is only converted to float32 here, at the
+    model boundary (sklearn trees and xgboost work in float32 anyway).
+    """
+
+    return data.drop(exclude_columns, axis=1, errors='ignore').to_numpy(dtype=dtype)
+
+
+def sparse_model_features(data, dtype=np.float32, exclude_columns=['click', 'bidprice', 'payprice']):
+    """
+    CSR feature matrix for the sparse models: the dense (dummy) columns first, then the sparse usertag columns,
+    which are never densified
+    """
+
+    features = data.drop(exclude_columns, axis=1, errors='ignore')
+    is_sparse = np.array([isinstance(dtype, pd.SparseDtype) for dtype in features.dtypes], dtype=bool)
+
+    blocks = [sp.csr_matrix(features.loc[:, ~is_sparse].to_numpy())]
+    if is_sparse.any():
+        blocks.append(features.loc[:, is_sparse].sparse.to_coo())
+
+    return sp.hstack(blocks, format='csr', dtype=dtype)
+
+
+def sparse_model_columns(data, exclude_columns=['click', 'bidprice', 'payprice']):
+    """
+    Column names in the order of sparse_model_features (dense columns first, then the sparse ones)
+    """
+
+    features = data.drop(exclude_columns, axis=1, errors='ignore')
+    is_sparse = np.array([isinstance(dtype, pd.SparseDtype) for dtype in features.dtypes], dtype=bool)
+
+    return list(features.columns[~is_sparse]) + list(features.columns[is_sparse])
+
+
+def factorize_columns(data, columns):
+    """
+    Integer codes (and the matching categories) for a single column or for a cross of several columns
+    """
+
+    codes, categories = pd.factorize(data[columns[0]])
+    categories = [np.asarray(categories)]
+    parent_codes = codes
+
+    for column in columns[1:]:
+        column_codes, column_categories = pd.factorize(data[column])
+
+        # Combine with the codes so far and re-factorize to keep only the observed combinations
+        combined = np.where((codes >= 0) & (column_codes >= 0), codes * len(column_categories) + column_codes, -1)
+        codes, uniques = pd.factorize(combined)
+        uniques = np.asarray(uniques)
+        valid = uniques >= 0
+
+        categories = [values[uniques[valid] // len(column_categories)] for values in categories] \
+            + [np.asarray(column_categories)[uniques[valid] % len(column_categories)]]
+
+        # The sentinel -1 may have been given a code of its own, move it back to -1
+        if not valid.all():
+            sentinel = np.flatnonzero(~valid)[0]
+            codes = np.where(codes == sentinel, -1, codes - (codes > sentinel))
+
+    if len(columns) == 1:
+        categories = pd.Index(categories[0])
+    else:
+        categories = pd.MultiIndex.from_arrays(categories, names=columns)
+
+    return codes, categories, parent_codes
+
+
+@profiled()
+def target_encoding(data, n_train, columns = ['weekday', 'hour', 'region', 'slotvisibility', 'slotformat',
+                                              'opsys', 'browser', 'slot_width_height', 'slotprice'],
+                    crosses = [('weekday', 'hour'), ('opsys', 'browser'), ('slot_width_height', 'slotvisibility')],
+                    n_folds=5, smoothing=50, seed=500, target='click'):
+    """
+    Replace categorical fields by their smoothed historical CTR (target encoding).
+
+    Statistics are taken from the first n_train rows (the training set of the merged data) with a single bincount
+    per field. Training rows get out-of-fold estimates so that their own click does not leak into the feature;
+    the remaining rows use the full training statistics. Single fields shrink towards the global CTR and crosses
+    shrink towards the CTR of their first field (hierarchical smoothing). Returns the data with 'te_' columns and
+    an encoder of compact lookup arrays that can be applied to new data with apply_target_encoding.
+    """
+
+    y = data[target].values[:n_train].astype(np.float64)
+    folds = np.random.RandomState(seed).randint(0, n_folds, n_train)
+    global_CTR = y.mean()
+
+    encoder = {'prior': global_CTR, 'smoothing': smoothing, 'fields': {}}
+    row_priors = {}
+
+    # Single fields first (including the parents of the crosses), so that crosses can shrink towards them
+    columns = list(columns) + [cross[0] for cross in crosses if cross[0] not in columns]
+
+    for field in [(column,) for column in columns] + [tuple(cross) for cross in crosses]:
+
+        name = '_x_'.join(field)
+        codes, categories, parent_codes = factorize_columns(data, list(field))
+        n_categories = len(categories)
+
+        # Per category and fold impression and click counts
+        train_codes = codes[:n_train]
+        seen = train_codes >= 0
+        keys = train_codes[seen] * n_folds + folds[seen]
+        impressions = np.bincount(keys, minlength=n_categories * n_folds).reshape(n_categories, n_folds)
+        clicks = np.bincount(keys, weights=y[seen], minlength=n_categories * n_folds).reshape(n_categories, n_folds)
+
+        # Prior of every category: global CTR for single fields, smoothed parent CTR for crosses
+        if len(field) == 1:
+            prior = np.repeat(global_CTR, n_categories)
+            parent = None
+            prior_rows = np.repeat(global_CTR, len(data))
+
+        else:
+            parent = field[0]
+            prior = np.repeat(global_CTR, n_categories)
+            prior[codes[codes >= 0]] = encoder['fields'][parent]['CTR'][parent_codes[codes >= 0]]
+            prior_rows = row_priors[parent]
+
+        # Full-data lookup array
+        CTR = ((clicks.sum(axis=1) + smoothing * prior) / (impressions.sum(axis=1) + smoothing)).astype(np.float32)
+
+        # Out-of-fold estimates for the training rows, full estimates elsewhere
+        encoded = np.where(codes >= 0, CTR[np.maximum(codes, 0)], prior_rows).astype(np.float32)
+        oof_impressions = impressions.sum(axis=1)[train_codes[seen]] - impressions[train_codes[seen], folds[seen]]
+        oof_clicks = clicks.sum(axis=1)[train_codes[seen]] - clicks[train_codes[seen], folds[seen]]
+        train_encoded = encoded[:n_train]
+        train_encoded[seen] = (oof_clicks + smoothing * prior_rows[:n_train][seen]) / (oof_impressions + smoothing)
+        encoded[:n_train] = train_encoded
+
+        data['te_' + name] = encoded
+        row_priors[name] = encoded
+        encoder['fields'][name] = {'columns': list(field), 'categories': categories, 'CTR': CTR,
+                                   'parent': parent}
+
+    return data, encoder
+
+
+@profiled()
+def apply_target_encoding(data, encoder):
+    """
+    Add the 'te_' columns to new data using the lookup arrays of a fitted target encoder
     """
 
-    data = pd.get_dummies(data, columns=columns_to_encode)
+    for name, field in encoder['fields'].items():
+
+        # Look up every row's category, unseen categories fall back to the parent (or global) CTR
+        if len(field['columns']) == 1:
+            index = field['categories'].get_indexer(data[field['columns'][0]])
+        else:
+            index = field['categories'].get_indexer(pd.MultiIndex.from_arrays([data[column]
+                                                                                for column in field['columns']]))
+
+        fallback = data['te_' + field['parent']].values if field['parent'] is not None \
+            else np.repeat(encoder['prior'], len(data))
+        data['te_' + name] = np.where(index >= 0, field['CTR'][np.maximum(index, 0)], fallback).astype(np.float32)
 
     return data
 
 
+@profiled()
 def min_max_scaling(data, scale_columns = ['slotwidth', 'slotheight', 'slotprice',
                                            'slotarea']):
     """
     Scale the columns for better inference/training
     """
     mm = preprocessing.MinMaxScaler()
-    data[scale_columns] = pd.DataFrame(mm.fit_transform(data[scale_columns]))
+    data[scale_columns] = mm.fit_transform(data[scale_columns].to_numpy(dtype=np.float32)).astype(np.float32)
 
     return data
 
 
+@profiled()
 def upsampling_minority_class(data, class_ratio = 0.05, seed=500):
 
     # Display old class counts
@@ -215,6 +630,7 @@ def upsampling_minority_class(data, class_ratio = 0.05, seed=500):
     return df_upsampled
 
 
+@profiled()
 def downsampling_majority_class(data, class_ratio = 0.05, seed=500):
 
     # Display old class counts
@@ -247,7 +663,562 @@ def downsampling_majority_class(data, class_ratio = 0.05, seed=500):
     return df_downsampled
 
 
+# -------------------- FUNCTIONS FOR DESCRIPTIVE STATISTICS ----------------------- #
+
+
+def slot_price_buckets(floor_prices):
+    """
+    Vectorised version of slot_price_bucketing for a whole column
+    """
+
+    floor_prices = np.asarray(floor_prices)
+
+    return 1 + (floor_prices >= 1) + (floor_prices > 10) + (floor_prices > 50) + (floor_prices > 100)
+
+
+def dimension_codes(values):
+    """
+    Sorted integer codes of a column, missing values get a category of their own
+    """
+
+    codes, categories = pd.factorize(values, sort=True)
+    categories = np.asarray(categories, dtype=object)
+
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(categories), codes)
+        categories = np.append(categories, np.nan)
+
+    return codes, categories
+
+
+def cube_dimension(data, dimension):
+    """
+    Codes and categories of a cube dimension, derived from the raw log columns where needed
+    """
+
+    if dimension in data.columns:
+        return dimension_codes(data[dimension].values)
+
+    # Operating system and browser: split the few distinct useragents instead of every row
+    if dimension in ['opsys', 'browser']:
+        useragent_codes, useragents = dimension_codes(data['useragent'].values)
+        parts = pd.Series(useragents).str.split('_', n=1).str[0 if dimension == 'opsys' else 1]
+        part_codes, categories = dimension_codes(parts.values)
+        return part_codes[useragent_codes], categories
+
+    if dimension == 'slot_width_height':
+        codes, categories = dimension_codes(data['slotwidth'].values * 100000 + data['slotheight'].values)
+        return codes, np.array(['%d_%d' % (size // 100000, size % 100000) for size in categories], dtype=object)
+
+    if dimension == 'slotprice_bucket':
+        return dimension_codes(slot_price_buckets(data['slotprice'].values))
+
+    raise ValueError('Unknown cube dimension: %s' % dimension)
+
+
+@profiled()
+def aggregate_cube(data, dimensions = ['advertiser', 'weekday', 'hour', 'opsys', 'browser',
+                                       'slot_width_height', 'slotprice_bucket']):
+    """
+    Single pass aggregation of the log into a cube of impressions, clicks, cost (payprice) and bids (bidprice)
+    for every observed combination of the dimensions. CTR/CPM/eCPC for any slice can then be answered from the
+    cube with cube_slice, without going back to the log.
+    """
+
+    # Combine the dimension codes into one mixed-radix key per row
+    key = np.zeros(len(data), dtype=np.int64)
+    all_categories = []
+
+    for dimension in dimensions:
+        codes, categories = cube_dimension(data, dimension)
+        key = key * len(categories) + codes
+        all_categories.append(categories)
+
+    # One bincount per measure over the observed keys
+    keys, cells = np.unique(key, return_inverse=True)
+    measures = {'impressions': np.bincount(cells, minlength=len(keys))}
+
+    for measure, column in [('clicks', 'click'), ('cost', 'payprice'), ('bids', 'bidprice')]:
+        measures[measure] = np.bincount(cells, weights=data[column].values, minlength=len(keys))
+
+    # Decode the keys back to the dimension values
+    levels = []
+    for categories in reversed(all_categories):
+        levels.append(categories[keys % len(categories)])
+        keys = keys // len(categories)
+
+    index = pd.MultiIndex.from_arrays(levels[::-1], names=dimensions)
+
+    return pd.DataFrame(measures, index=index)
+
+
+def cube_slice(cube, by, CTR_scale=1):
+    """
+    Impressions, clicks, cost, CTR, CPM and eCPC by the given dimensions, answered from the cube.
+    Cost is reported in thousands of the payprice units as in the exploratory tables.
+    """
+
+    output = cube.groupby(level=by, dropna=False).sum()
+    output['cost'] = output['cost'] / 1000
+    output['CTR'] = output['clicks'] / output['impressions'] * CTR_scale # Click-Through Rate
+    output['CPM'] = output['cost'] * 1000 / output['impressions'] # Cost per-mille
+    output['eCPC'] = output['cost'] / output['clicks'] # Effective Cost-per-Click
+
+    return output[['impressions', 'clicks', 'CTR', 'cost', 'CPM', 'eCPC', 'bids']]
+
+
+def merge_cubes(cubes):
+    """
+    Add up cubes built on separate chunks of the log
+    """
+
+    cubes = list(cubes)
+
+    return pd.concat(cubes).groupby(level=list(cubes[0].index.names), dropna=False).sum()
+
+
+# ------------------ STREAMING SKETCHES FOR OUT-OF-CORE STATISTICS ----------------- #
+
+
+class RunningMoments:
+    """
+    Mergeable count, mean, (co)variance, min and max of one or more numeric columns. Rows with a missing value in
+    any of the columns are skipped. Chunks are combined with the parallel (Chan et al.) update.
+    """
+
+    def __init__(self, n_columns=1):
+        self.count = 0
+        self.mean = np.zeros(n_columns)
+        self.comoments = np.zeros((n_columns, n_columns))
+        self.min = np.repeat(np.inf, n_columns)
+        self.max = np.repeat(-np.inf, n_columns)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values.reshape(len(values), -1) if values.size else values.reshape(0, len(self.mean))
+        values = values[~np.isnan(values).any(axis=1)]
+
+        if len(values) == 0:
+            return self
+
+        chunk = RunningMoments(values.shape[1])
+        chunk.count = len(values)
+        chunk.mean = values.mean(axis=0)
+        centred = values - chunk.mean
+        chunk.comoments = centred.T @ centred
+        chunk.min, chunk.max = values.min(axis=0), values.max(axis=0)
+
+        return self.merge(chunk)
+
+    def merge(self, other):
+        count = self.count + other.count
+
+        if count == 0:
+            return self
+
+        delta = other.mean - self.mean
+        self.comoments = self.comoments + other.comoments + np.outer(delta, delta) * self.count * other.count / count
+        self.mean = self.mean + delta * other.count / count
+        self.count = count
+        self.min, self.max = np.minimum(self.min, other.min), np.maximum(self.max, other.max)
+
+        return self
+
+    def std(self):
+        if self.count - 1 <= 0:
+            return np.repeat(np.nan, len(self.mean))
+
+        return np.sqrt(np.diag(self.comoments) / (self.count - 1))
+
+    def correlation(self):
+        std = np.sqrt(np.diag(self.comoments))
+        return self.comoments / np.outer(std, std)
+
+
+class HyperLogLog:
+    """
+    Mergeable distinct count sketch with 2**precision registers (relative error about 1.04 / sqrt(2**precision))
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def update(self, values):
+        values = pd.Series(values).dropna()
+
+        # Numbers are hashed as floats so that int and float chunks of the same column agree
+        if pd.api.types.is_numeric_dtype(values):
+            values = values.astype(np.float64)
+        else:
+            values = values.astype(str)
+
+        hashes = pd.util.hash_pandas_object(values, index=False).values
+        bits = 64 - self.precision
+        register = (hashes >> np.uint64(bits)).astype(np.int64)
+        remainder = hashes & np.uint64(2 ** bits - 1)
+
+        # Position of the leftmost 1-bit in the remaining bits (exact in float64 since bits <= 52)
+        exponent = np.frexp(remainder.astype(np.float64))[1]
+        rank = np.where(remainder == 0, bits + 1, bits - exponent + 1).astype(np.uint8)
+        np.maximum.at(self.registers, register, rank)
+
+        return self
+
+    def merge(self, other):
+        self.registers = np.maximum(self.registers, other.registers)
+
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m ** 2 / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = np.sum(self.registers == 0)
+
+        # Linear counting for small cardinalities
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * np.log(m / zeros)
+
+        return int(round(estimate))
+
+
+class QuantileDigest:
+    """
+    Mergeable t-digest style quantile sketch. Values are kept as weighted centroids whose size is bounded by the
+    arcsine scale function, so the tails are summarised much more finely than the centre.
+    """
+
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min, self.max = np.inf, -np.inf
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+
+        # Cluster id from the scale function at the left edge of every centroid
+        q = (np.cumsum(weights) - weights) / weights.sum()
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        cluster = np.floor(k - k[0]).astype(np.int64)
+
+        self.weights = np.bincount(cluster, weights=weights)
+        self.means = np.bincount(cluster, weights=means * weights)[self.weights > 0] / self.weights[self.weights > 0]
+        self.weights = self.weights[self.weights > 0]
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+
+        if len(values) == 0:
+            return self
+
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+        self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+
+        return self
+
+    def merge(self, other):
+        if len(other.weights) == 0:
+            return self
+
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+
+        return self
+
+    def quantile(self, q):
+        total = self.weights.sum()
+        midpoints = np.cumsum(self.weights) - self.weights / 2
+
+        return np.interp(np.asarray(q) * total, np.concatenate([[0], midpoints, [total]]),
+                         np.concatenate([[self.min], self.means, [self.max]]))
+
+
+class FixedHistogram:
+    """
+    Mergeable histogram over fixed bin edges (values outside the edges are ignored)
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.counts += np.histogram(values[~np.isnan(values)], self.edges)[0]
+
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+
+        return self
+
+    def density(self):
+        return self.counts / self.counts.sum() / np.diff(self.edges)
+
+
+@profiled()
+def streaming_statistics(file_name, price_columns = ['bidprice', 'payprice', 'slotprice'],
+                         price_edges = np.linspace(0, 400, 51), difference_edges = np.linspace(-400, 400, 51),
+                         cube_dimensions = None, chunksize = 500000):
+    """
+    Exploratory statistics of a csv log read in chunks, so the log never has to fit in memory: moments, distinct
+    counts and quantiles of every numeric column, distinct counts of the other columns, price histograms and
+    correlations (for all rows and for clicks only), a histogram of bid minus paid price and, optionally, the
+    aggregate cube.
+    """
+
+    statistics = None
+
+    for chunk in pd.read_csv(file_name, chunksize=chunksize):
+
+        if statistics is None:
+            numeric_columns = [column for column in chunk.columns if pd.api.types.is_numeric_dtype(chunk[column])]
+            statistics = {'rows': 0,
+                          'moments': {column: RunningMoments() for column in numeric_columns},
+                          'quantiles': {column: QuantileDigest() for column in numeric_columns},
+                          'distinct': {column: HyperLogLog() for column in chunk.columns},
+                          'histograms': {subset: {column: FixedHistogram(price_edges) for column in price_columns}
+                                         for subset in ['all', 'clicks']},
+                          'price_quantiles': {subset: {column: QuantileDigest() for column in price_columns}
+                                              for subset in ['all', 'clicks']},
+                          'price_moments': {subset: RunningMoments(len(price_columns))
+                                            for subset in ['all', 'clicks']},
+                          'price_difference': FixedHistogram(difference_edges),
+                          'cube': None}
+
+        statistics['rows'] += len(chunk)
+
+        for column in statistics['moments']:
+            statistics['moments'][column].update(chunk[column].values)
+            statistics['quantiles'][column].update(chunk[column].values)
+
+        for column in statistics['distinct']:
+            statistics['distinct'][column].update(chunk[column].values)
+
+        statistics['price_difference'].update(chunk['bidprice'].values - chunk['payprice'].values)
+
+        for subset, rows in [('all', chunk), ('clicks', chunk[chunk['click'] == 1])]:
+            statistics['price_moments'][subset].update(rows[price_columns].values)
+
+            for column in price_columns:
+                statistics['histograms'][subset][column].update(rows[column].values)
+                statistics['price_quantiles'][subset][column].update(rows[column].values)
+
+        if cube_dimensions is not None:
+            cube = aggregate_cube(chunk, dimensions=cube_dimensions)
+            statistics['cube'] = cube if statistics['cube'] is None else merge_cubes([statistics['cube'], cube])
+
+    return statistics
+
+
+def describe_from_statistics(statistics):
+    """
+    Equivalent of DataFrame.describe().transpose() from the streaming statistics
+    """
+
+    rows = []
+    for column, moments in statistics['moments'].items():
+
+        # No non-null values: NaN like describe(), not the inf / -inf starting values of the sketches
+        if moments.count == 0:
+            rows.append([0] + [np.nan] * 7)
+            continue
+
+        quartiles = statistics['quantiles'][column].quantile([0.25, 0.5, 0.75])
+        rows.append([moments.count, moments.mean[0], moments.std()[0], moments.min[0]] + list(quartiles)
+                    + [moments.max[0]])
+
+    return pd.DataFrame(rows, index=list(statistics['moments']),
+                        columns=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'])
+
+
+def violin_statistics(histograms, digests):
+    """
+    Inputs for matplotlib's Axes.violin built from histograms and quantile sketches instead of the raw values
+    """
+
+    output = []
+    for column in histograms:
+        histogram, digest = histograms[column], digests[column]
+        output.append({'coords': (histogram.edges[:-1] + histogram.edges[1:]) / 2,
+                       'vals': histogram.density(),
+                       'mean': np.sum(histogram.counts * (histogram.edges[:-1] + histogram.edges[1:]) / 2)
+                               / histogram.counts.sum(),
+                       'median': digest.quantile(0.5),
+                       'min': digest.min,
+                       'max': digest.max})
+
+    return output
+
+
+# ------------------------ SYNTHETIC IPINYOU-SHAPED LOGS ----------------------------- #
+
+# Marginals loosely follow the iPinYou season 2/3 logs used in the coursework
+synthetic_useragents = {'windows_ie': 0.42, 'windows_chrome': 0.30, 'windows_other': 0.05, 'mac_safari': 0.05,
+                        'mac_chrome': 0.02, 'linux_firefox': 0.01, 'android_safari': 0.05, 'ios_safari': 0.06,
+                        'windows_firefox': 0.02, 'other_other': 0.02}
+synthetic_slot_sizes = {(300, 250): 0.30, (728, 90): 0.25, (160, 600): 0.10, (950, 90): 0.10, (1000, 90): 0.10,
+                        (336, 280): 0.05, (200, 200): 0.05, (468, 60): 0.05}
+synthetic_slot_visibility = {'FirstView': 0.35, 'Na': 0.30, 'SecondView': 0.15, 'OtherView': 0.05, '0': 0.08,
+                             '1': 0.04, '2': 0.02, '255': 0.01}
+synthetic_slot_format = {'Na': 0.40, 'Fixed': 0.30, '0': 0.20, '1': 0.05, '5': 0.05}
+synthetic_advertisers = {1458: 0.20, 2259: 0.05, 2261: 0.05, 2821: 0.08, 2997: 0.03, 3358: 0.11, 3386: 0.14,
+                         3427: 0.14, 3476: 0.20}
+synthetic_bid_prices = {1458: 300, 2259: 300, 2261: 300, 2821: 238, 2997: 227, 3358: 300, 3386: 300, 3427: 294,
+                        3476: 300}
+synthetic_usertags = np.array([10006, 10024, 10031, 10048, 10052, 10057, 10059, 10063, 10067, 10074, 10075, 10076,
+                               10077, 10079, 10083, 10093, 10102, 10684, 11092, 11278, 11379, 11423, 11512, 11576,
+                               11632, 11680, 11724, 11944, 13042, 13403, 13496, 13678, 13776, 13800, 13866, 13874,
+                               14273, 16593, 16617, 16661, 16706, 10110, 10111])
+
+
+def weighted_choice(generator, weights, n_rows):
+    """
+    Draws n_rows keys of a {value: probability} dictionary
+    """
+
+    values = list(weights)
+    probabilities = np.array(list(weights.values()), dtype=np.float64)
+    index = generator.choice(len(values), size=n_rows, p=probabilities / probabilities.sum())
+
+    return index, values
+
+
+def random_hex(generator, n_rows, digits=16):
+    """
+    Random lower-case hex identifiers (bidid, userid, creative, ...)
+    """
+
+    # One hex string for all rows, cut into fixed-width identifiers
+    hex_digits = generator.bytes(n_rows * digits // 2).hex().encode()
+
+    return np.frombuffer(hex_digits, dtype='S%d' % digits).astype(str).astype(object)
+
+
+def synthetic_usertag_profiles(generator, n_profiles=5000):
+    """
+    A pool of comma-separated usertag strings with Zipf-like tag frequencies
+    """
+
+    tag_weights = 1.0 / np.arange(1, len(synthetic_usertags) + 1) ** 0.8
+    tag_weights /= tag_weights.sum()
+    profiles = []
+
+    for length in generator.integers(1, 12, size=n_profiles):
+        tags = generator.choice(synthetic_usertags, size=length, replace=False, p=tag_weights)
+        profiles.append(','.join(str(tag) for tag in np.sort(tags)))
+
+    return np.array(profiles, dtype=object)
+
+
+def synthetic_log(n_rows, seed=500, average_CTR=7.375623e-04, labelled='yes', identifiers='yes', usertag_profiles=None):
+    """
+    Synthetic bid log with the columns (and value formats) of the iPinYou train/validation csv files: useragent as
+    os_browser, comma-separated usertag ('null' when missing), slot fields, second-price payprice <= bidprice and
+    rare clicks whose rate depends on advertiser, slot, hour and usertags. With labelled='no' the click, bidprice
+    and payprice columns are left out, as in test.csv. With identifiers='no' the id-like columns (bidid, userid,
+    domain, url, slotid, creative, keypage) hold one placeholder string, which saves most of the memory at 10M rows.
+    """
+
+    generator = np.random.default_rng(seed)
+    hex_identifiers = random_hex if identifiers == 'yes' else lambda generator, n_rows, digits=16: 'null'
+
+    if usertag_profiles is None:
+        usertag_profiles = synthetic_usertag_profiles(np.random.default_rng(0))
+
+    # Traffic peaks in the evening
+    hour_weights = 1 + 0.6 * np.sin((np.arange(24) - 14) / 24 * 2 * np.pi)
+    hour = generator.choice(24, size=n_rows, p=hour_weights / hour_weights.sum())
+    advertiser_index, advertisers = weighted_choice(generator, synthetic_advertisers, n_rows)
+    advertiser = np.array(advertisers)[advertiser_index]
+    size_index, sizes = weighted_choice(generator, synthetic_slot_sizes, n_rows)
+    slot_size = np.array(sizes)[size_index]
+    visibility_index, visibilities = weighted_choice(generator, synthetic_slot_visibility, n_rows)
+    useragent_index, useragents = weighted_choice(generator, synthetic_useragents, n_rows)
+
+    # Usertags: a share of users has no profile, the rest share a pool of Zipf-distributed profiles
+    profile_index = np.minimum(generator.zipf(1.3, size=n_rows) - 1, len(usertag_profiles) - 1)
+    usertag = usertag_profiles[profile_index]
+    usertag[generator.random(n_rows) < 0.15] = 'null'
+
+    # Floor prices are mostly zero or small; the market price sits above the floor and below the (constant) bid
+    slotprice = np.where(generator.random(n_rows) < 0.45, 0,
+                         generator.choice([5, 10, 30, 50, 70, 100, 150, 200], size=n_rows,
+                                          p=[0.25, 0.1, 0.15, 0.15, 0.1, 0.1, 0.1, 0.05]))
+    bidprice = pd.Series(advertiser).map(synthetic_bid_prices).values
+    payprice = np.clip(np.round(generator.lognormal(np.log(60 + slotprice / 2), 0.6)), slotprice, bidprice)
+
+    # Click-through rate from a few multiplicative effects, rescaled to the requested average
+    visibility_effect = np.where(np.array(visibilities)[visibility_index] == 'FirstView', 2.0, 1.0)
+    hour_effect = 1 + 0.3 * np.cos((hour - 20) / 24 * 2 * np.pi)
+    advertiser_effect = 0.5 + (advertiser_index % 4) * 0.5
+    size_effect = np.where(size_index == 0, 1.5, 1.0) * np.where(size_index == 2, 0.6, 1.0)
+    usertag_effect = np.where(pd.Series(usertag_profiles).str.contains('10006|13866').values, 1.8, 1.0)[profile_index]
+    usertag_effect[usertag == 'null'] = 1.0
+    CTR = visibility_effect * hour_effect * advertiser_effect * size_effect * usertag_effect
+    CTR *= average_CTR / CTR.mean()
+
+    data = pd.DataFrame({'click': (generator.random(n_rows) < CTR).astype(np.int64),
+                         'weekday': generator.integers(0, 7, n_rows),
+                         'hour': hour,
+                         'bidid': hex_identifiers(generator, n_rows),
+                         'userid': hex_identifiers(generator, n_rows),
+                         'useragent': np.array(useragents, dtype=object)[useragent_index],
+                         'IP': pd.Series(generator.integers(1, 255, n_rows)).astype(str).values + '.'
+                               + pd.Series(generator.integers(0, 255, n_rows)).astype(str).values + '.*.*',
+                         'region': generator.choice([1, 2, 3, 15, 27, 40, 55, 65, 79, 80, 94, 106, 124, 134, 146,
+                                                     164, 183, 201, 216, 238, 253, 275, 276, 298, 308, 325, 333, 344,
+                                                     359, 368, 374, 393, 395], size=n_rows),
+                         'city': generator.integers(1, 400, n_rows),
+                         'adexchange': generator.choice([1, 2, 3, 4, np.nan], size=n_rows,
+                                                        p=[0.3, 0.35, 0.2, 0.1, 0.05]),
+                         'domain': hex_identifiers(generator, n_rows, 8),
+                         'url': hex_identifiers(generator, n_rows),
+                         'urlid': 'null',
+                         'slotid': hex_identifiers(generator, n_rows, 10),
+                         'slotwidth': slot_size[:, 0],
+                         'slotheight': slot_size[:, 1],
+                         'slotvisibility': np.array(visibilities, dtype=object)[visibility_index],
+                         'slotformat': np.array(list(synthetic_slot_format), dtype=object)[
+                             weighted_choice(generator, synthetic_slot_format, n_rows)[0]],
+                         'slotprice': slotprice,
+                         'creative': hex_identifiers(generator, n_rows, 8),
+                         'bidprice': bidprice,
+                         'payprice': payprice.astype(np.int64),
+                         'keypage': hex_identifiers(generator, n_rows, 8),
+                         'advertiser': advertiser,
+                         'usertag': usertag})
+
+    # Logs are in time order
+    data = data.sort_values(['weekday', 'hour'], kind='stable').reset_index(drop=True)
+
+    if labelled == 'no':
+        data = data.drop(['click', 'bidprice', 'payprice'], axis=1)
+
+    return data
+
+
+def write_synthetic_log(file_name, n_rows, seed=500, chunksize=1000000, **arguments):
+    """
+    Writes a synthetic log to csv in chunks, so e.g. 10M rows never have to be held in memory at once
+    """
+
+    usertag_profiles = synthetic_usertag_profiles(np.random.default_rng(0))
+
+    for i, start in enumerate(range(0, n_rows, chunksize)):
+        chunk = synthetic_log(min(chunksize, n_rows - start), seed=seed + i, usertag_profiles=usertag_profiles,
+                              **arguments)
+        chunk.to_csv(file_name, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+
+    return file_name
+
+
 # --- TEST THE PREDICTION ERROR WITH VARIOUS LEVELS OF DOWN-SAMPLING --- #
+@profiled()
 def test_downsampling(train, validation, prediction_model, minority_levels=np.linspace(0.005, 0.1, 20),
                       model_type='ERF', random_seed=500, to_plot = 'yes'):
     # Initialise output
@@ -255,42 +1226,32 @@ def test_downsampling(train, validation, prediction_model, minority_levels=np.li
     output = pd.DataFrame(index=range(len(minority_levels)), columns=colnames)
     output['model'] = model_type
 
+    # Time it
+    start_time = time.time()
+
     for i,j in zip(minority_levels, range(0,len(minority_levels))):
 
         print('Testing %s%% case.' % (i*100))
 
-        # Time it
-        start_time = time.time()
-
         # Refit the model
         new_data = downsampling_majority_class(train, class_ratio=i, seed=random_seed)
-        refitted_model = prediction_model.fit(new_data.drop(['click', 'bidprice', 'payprice'], axis=1).values,
-                                              new_data['click'].values)
+        with profile_span('test_downsampling.fit', minority_level=i):
+            refitted_model = prediction_model.fit(model_features(new_data), new_data['click'].values)
 
         # Make prediction
-        prediction = refitted_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+        with profile_span('test_downsampling.predict', minority_level=i):
+            prediction = refitted_model.predict_proba(model_features(validation))
 
         # Populate output dataframe
-        output['minority_level'][j] = i
-        output['AUC'][j] = roc_auc_score(validation['click'].values, prediction[:,1])
+        output.loc[j, 'minority_level'] = i
+        output.loc[j, 'AUC'] = roc_auc_score(validation['click'].values, prediction[:,1])
 
-    print("Evaluation for %s type model finished in %.2f mins." % (type, (time.time() - start_time)))
+    print("Evaluation for %s type model finished in %.2f mins." % (model_type, (time.time() - start_time) / 60))
 
     if to_plot == 'yes':
 
-        # Title and format
-        plot_title = 'Sensitivity Analysis of Downsampling (Using %s Model)' %('XGBoost')
-        plt.style.use("seaborn-darkgrid")
-
-        # Plot ROC curve
-        plt.figure(figsize=(3.3 * 1.2, 2.2 * 1.2))
-        plt.plot(output.minority_level*100, output.AUC)
-        plt.tick_params(labelsize=6)
-       # fig.set_size_inches(3.3 * 1.2, 2.2 * 1.2)
-        plt.xlabel('% of Samples from Minority Class', fontsize=8)
-        plt.ylabel('AUC', fontsize= 8)
-        plt.title(plot_title, fontsize=10)
-        plt.savefig(os.getcwd() + '/results/downsizing_sensitivity_new3.pdf', dpi=300)
+        # Drawn later by render_plots
+        defer_plot('downsampling', 'downsizing_sensitivity_new3.pdf', output=output, model_type=model_type)
 
     return output
 ############################## END ##################################
\ No newline at end of file
@@ -22,8 +22,8 @@ Date:
 # ------------------------------ IMPORT LIBRARIES --------------------------------- #
 
 import pandas as pd
+import numpy as np
 import xgboost
-from pylab import rcParams
 from sklearn.linear_model import LogisticRegression
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.naive_bayes import GaussianNB
@@ -34,24 +34,29 @@ from sklearn.metrics import make_scorer
 from sklearn.model_selection import GridSearchCV
 from sklearn.metrics import roc_curve
 from sklearn.metrics import auc
-import matplotlib.pyplot as plt
 from sklearn.ensemble import ExtraTreesClassifier
 from mlxtend.classifier import StackingCVClassifier
 from sklearn.ensemble import RandomForestClassifier
-from fastFM import als
 import scipy.sparse as sp
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.linear_model import SGDClassifier
+from sklearn.kernel_approximation import RBFSampler, Nystroem
+from sklearn.calibration import CalibratedClassifierCV
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.externals import joblib
 from sklearn import svm
-from sknn.mlp import Classifier, Layer
 import os
+from B_Data_Preprocessing import get_feature_fields, model_features, sparse_model_features, sparse_model_columns
+from E_Pipeline_Utilities import defer_plot, profiled, profile_span, cached_predictions
 
 # --------------------------------- FITTING --------------------------------------- #
 
 
 # --- PLOT ROC CURVE
-def plot_ROC_curve(data, prediction, model=None, minority_class=None):
+def plot_ROC_curve(data, prediction, model=None, minority_class=None, file_name=None):
     """
-    Function to plot the ROC curve with AUC.
+    Function to compute the ROC curve with AUC. Returns the curve for plot_ROC_curves; with file_name a single
+    curve plot is queued for render_plots.
     """
 
     # Compute fpr, tpr, thresholds and roc auc
@@ -70,21 +75,16 @@ def plot_ROC_curve(data, prediction, model=None, minority_class=None):
     else:
         plot_title = 'ROC'
 
-    # Plot ROC curve
-   # plt.figure(figsize=(3.3 * 1.2, 2.2 * 1.2))
-    rcParams['figure.figsize'] = 3.3 * 1.2, 2.2 * 1.4
-    plt.tick_params(labelsize=6)
-    plt.plot(fpr, tpr, label=label_title)
-    plt.plot([0, 1], [0, 1], 'k--')  # random predictions curve
-    plt.xlim([0.0, 1.0])
-    plt.ylim([0.0, 1.0])
-    plt.xlabel('False Positive Rate or (1 - Specifity)', fontsize=8)
-    plt.ylabel('True Positive Rate or (Sensitivity)', fontsize=8)
-    plt.title(plot_title, fontsize=10)
-    plt.legend(loc="lower right", fontsize=6)
+    curve = {'fpr': fpr, 'tpr': tpr, 'AUC': roc_auc, 'label': label_title, 'title': plot_title}
+
+    if file_name is not None:
+        defer_plot('ROC_curves', file_name, curves=[curve], title=plot_title)
+
+    return curve
 
 
 # --- LOGISTIC REGRESSION
+@profiled()
 def logistic_model(train, validation,
                    parameters = {'C': [0.1, 1, 2, 5, 10],
                   'penalty': ['l1', 'l2'],
@@ -108,7 +108,8 @@ def logistic_model(train, validation,
         model = GridSearchCV(LogisticRegression(), parameters, cv=3, verbose=10, scoring = 'roc_auc')
 
         # Fit the model
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
+        with profile_span('logistic_model.fit'):
+            model = model.fit(model_features(train), train['click'])
 
         # View best hyperparameters
         print('Best Penalty:', model.best_estimator_.get_params()['penalty'])
@@ -128,13 +129,16 @@ def logistic_model(train, validation,
                                        verbose=10)
 
             # Refit
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('logistic_model.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('logistic_model.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = model.best_estimator_.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('logistic_model.predict'):
+                prediction = model.best_estimator_.predict_proba(model_features(validation))
 
     elif use_saved_model == 'yes':
 
@@ -160,13 +164,17 @@ def logistic_model(train, validation,
                                        verbose=10)
 
             # Fit the model
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('logistic_model.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('logistic_model.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('logistic_model.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(model_features(validation)))
             model = saved_model
     else:
 
@@ -179,8 +187,10 @@ def logistic_model(train, validation,
                                    random_state = random_seed,
                                    verbose=10)
 
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('logistic_model.fit'):
+            model = model.fit(model_features(train), train['click'])
+        with profile_span('logistic_model.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     # Print scores
     print("AUC: %0.5f for Logistic Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
@@ -194,12 +204,14 @@ def logistic_model(train, validation,
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Logistic',
+                       file_name='ROC_logistic.pdf')
 
     return model, prediction[:,1]
 
 
 # --- RANDOM FOREST
+@profiled()
 def random_forest(train, validation,
                    parameters = {'max_depth': [2,3,4,5,6,7,8,9,10,11,12, None],
               'min_samples_split' :[4,5,6],
@@ -222,7 +234,8 @@ def random_forest(train, validation,
         model = GridSearchCV(RandomForestClassifier(), parameters, cv=3, verbose=10, scoring = 'roc_auc')
 
         # Fit the model
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
+        with profile_span('random_forest.fit'):
+            model = model.fit(model_features(train), train['click'])
 
         # View best hyperparameters
         print('Best Max Depth:', model.best_estimator_.get_params()['max_depth'])
@@ -245,13 +258,16 @@ def random_forest(train, validation,
                                            , random_state= random_seed)
 
             # Refit
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('random_forest.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('random_forest.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = model.best_estimator_.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('random_forest.predict'):
+                prediction = model.best_estimator_.predict_proba(model_features(validation))
 
     elif use_saved_model == 'yes':
 
@@ -279,13 +295,17 @@ def random_forest(train, validation,
                                    , verbose=10
                                            , random_state=random_seed)
             # Fit the model
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('random_forest.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('random_forest.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('random_forest.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(model_features(validation)))
             model = saved_model
 
     else:
@@ -301,8 +321,10 @@ def random_forest(train, validation,
                                        , verbose=10
                                        , random_state=random_seed)
 
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('random_forest.fit'):
+            model = model.fit(model_features(train), train['click'])
+        with profile_span('random_forest.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     # Print scores
     print("AUC: %0.5f for Random Forest Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
@@ -316,12 +338,14 @@ def random_forest(train, validation,
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Random Forest',
+                       file_name='ROC_random_forest.pdf')
 
     return model, prediction[:,1]
 
 
 # --- EXTREME RANDOM FOREST
+@profiled()
 def extreme_random_forest(train, validation,
                    parameters = {'max_depth': [2,3,4,5,6,7,8,9,10,11,12, None],
               'min_samples_split' :[4,5,6],
@@ -344,7 +368,8 @@ def extreme_random_forest(train, validation,
         model = GridSearchCV(ExtraTreesClassifier(), parameters, cv=3, verbose=10, scoring = 'roc_auc')
 
         # Fit the model
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
+        with profile_span('extreme_random_forest.fit'):
+            model = model.fit(model_features(train), train['click'])
 
         # View best hyperparameters
         print('Best Max Depth:', model.best_estimator_.get_params()['max_depth'])
@@ -367,13 +392,16 @@ def extreme_random_forest(train, validation,
                                          , random_state = random_seed)
 
             # Refit
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('extreme_random_forest.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('extreme_random_forest.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = model.best_estimator_.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('extreme_random_forest.predict'):
+                prediction = model.best_estimator_.predict_proba(model_features(validation))
 
     elif use_saved_model == 'yes':
 
@@ -401,13 +429,17 @@ def extreme_random_forest(train, validation,
                                    , verbose=10
                                          , random_state=random_seed)
             # Fit the model
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('extreme_random_forest.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('extreme_random_forest.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('extreme_random_forest.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(model_features(validation)))
             model = saved_model
 
     else:
@@ -423,8 +455,10 @@ def extreme_random_forest(train, validation,
                                        , verbose=10
                                      , random_state=random_seed)
 
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('extreme_random_forest.fit'):
+            model = model.fit(model_features(train), train['click'])
+        with profile_span('extreme_random_forest.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     # Whether to save the model
     if save_model == 'yes':
@@ -438,12 +472,14 @@ def extreme_random_forest(train, validation,
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Extreme Random Forest',
+                       file_name='ROC_extreme_random_forest.pdf')
 
     return model, prediction[:,1]
 
 
 # --- GRADIENT BOOSTED TREES (XGBOOST)
+@profiled()
 def gradient_boosted_trees(train, validation,
                            parameters={'max_depth': [15, 20],
                                        "n_estimators": [10],
@@ -468,7 +504,8 @@ def gradient_boosted_trees(train, validation,
         model = GridSearchCV(xgboost.XGBClassifier(), parameters, cv=3, verbose=10, scoring = 'roc_auc')
 
         # Fit the model
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
+        with profile_span('gradient_boosted_trees.fit'):
+            model = model.fit(model_features(train), train['click'])
 
         # View best hyperparameters
         print('Saved Model Max Depth:', model.best_estimator_.get_params()['max_depth'])
@@ -498,13 +535,16 @@ def gradient_boosted_trees(train, validation,
                                           , silent=False)
 
             # Refit
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('gradient_boosted_trees.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('gradient_boosted_trees.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = model.best_estimator_.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('gradient_boosted_trees.predict'):
+                prediction = model.best_estimator_.predict_proba(model_features(validation))
 
     elif use_saved_model == 'yes':
 
@@ -538,13 +578,17 @@ def gradient_boosted_trees(train, validation,
                                           , random_state=random_seed,
                                           silent=False)
             # Fit the model
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('gradient_boosted_trees.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('gradient_boosted_trees.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('gradient_boosted_trees.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(model_features(validation)))
             model = saved_model
 
     else:
@@ -563,8 +607,10 @@ def gradient_boosted_trees(train, validation,
                                       , random_state=random_seed
                                       , silent=False)
 
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('gradient_boosted_trees.fit'):
+            model = model.fit(model_features(train), train['click'])
+        with profile_span('gradient_boosted_trees.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     # Print scores
     print("AUC: %0.5f for XGBoost Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
@@ -578,12 +624,14 @@ def gradient_boosted_trees(train, validation,
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='XGBoost',
+                       file_name='ROC_xgboost.pdf')
 
     return model, prediction[:,1]
 
 
 # --- SUPPORT VECTOR MACHINES
+@profiled()
 def support_vector_machine(train, validation,
                            parameters={'C': [0.1, 1, 2],
                                        "kernel": ['linear', 'poly', 'rbf', 'sigmoid'],
@@ -599,8 +647,14 @@ def support_vector_machine(train, validation,
                    use_saved_model = 'no',
                    save_model = 'yes',
                    to_plot ='yes',
-                   random_seed = 500):
+                   random_seed = 500,
+                   model_type = 'SVC'):
 
+    # SGD hinge loss on sparse features instead of the kernel SVC (parameters of LinearSVMClassifier)
+    if model_type == 'linear':
+        return linear_support_vector_machine(train, validation, parameters=parameters, use_gridsearch=use_gridsearch,
+                                             refit=refit, refit_iter=refit_iter, use_saved_model=use_saved_model,
+                                             save_model=save_model, to_plot=to_plot, random_seed=random_seed)
 
     if use_gridsearch == 'yes':
 
@@ -608,7 +662,8 @@ def support_vector_machine(train, validation,
         model = GridSearchCV(svm.SVC(), parameters, cv=3, verbose=10, scoring = 'roc_auc')
 
         # Fit the model
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
+        with profile_span('support_vector_machine.fit'):
+            model = model.fit(model_features(train), train['click'])
 
         # View best hyperparameters
         print('Saved Model C:', model.best_estimator_.get_params()['C'])
@@ -628,13 +683,16 @@ def support_vector_machine(train, validation,
                             ,probability=True)
 
             # Refit
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('support_vector_machine.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('support_vector_machine.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = model.best_estimator_.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('support_vector_machine.predict'):
+                prediction = model.best_estimator_.predict_proba(model_features(validation))
 
     elif use_saved_model == 'yes':
 
@@ -659,13 +717,17 @@ def support_vector_machine(train, validation,
                             ,random_state = random_seed
                             ,probability=True)
             # Fit the model
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('support_vector_machine.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('support_vector_machine.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('support_vector_machine.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(model_features(validation)))
             model = saved_model
 
     else:
@@ -681,8 +743,10 @@ def support_vector_machine(train, validation,
                         , random_state=random_seed
                         , probability=True)
 
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('support_vector_machine.fit'):
+            model = model.fit(model_features(train), train['click'])
+        with profile_span('support_vector_machine.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     # Print scores
     print("AUC: %0.5f for SVM Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
@@ -696,12 +760,186 @@ def support_vector_machine(train, validation,
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='SVM',
+                       file_name='ROC_SVM.pdf')
+
+    return model, prediction[:,1]
+
+
+# --- LINEAR SVM (SGD HINGE LOSS, OPTIONAL KERNEL APPROXIMATION)
+class LinearSVMClassifier(ClassifierMixin, BaseEstimator):
+    """
+    Linear SVM (SGD on the hinge loss) on the sparse features or an approximate RBF kernel ('rbf_sampler' or
+    'nystroem'), calibrated to probabilities with CalibratedClassifierCV
+    """
+
+    def __init__(self, alpha=1e-5, kernel='none', n_components=300, gamma=None, max_iter=20, tol=1e-4,
+                 class_weight=None, calibration='sigmoid', cv=3, random_state=500):
+        self.alpha = alpha
+        self.kernel = kernel
+        self.n_components = n_components
+        self.gamma = gamma
+        self.max_iter = max_iter
+        self.tol = tol
+        self.class_weight = class_weight
+        self.calibration = calibration
+        self.cv = cv
+        self.random_state = random_state
+
+    def _transform(self, X):
+
+        X = to_sparse_features(X)
+
+        if self.kernel_map_ is None:
+            return X
+
+        # Kernel features in blocks of rows, kept in float32
+        return np.vstack([self.kernel_map_.transform(X[i:i + 65536]).astype(np.float32)
+                          for i in range(0, X.shape[0], 65536)])
+
+    def fit(self, X, y):
+
+        X = to_sparse_features(X)
+        gamma = self.gamma if self.gamma is not None else 1.0 / X.shape[1]
+
+        if self.kernel == 'rbf_sampler':
+            self.kernel_map_ = RBFSampler(gamma=gamma, n_components=self.n_components,
+                                          random_state=self.random_state).fit(X)
+        elif self.kernel == 'nystroem':
+            self.kernel_map_ = Nystroem(kernel='rbf', gamma=gamma, n_components=self.n_components,
+                                        random_state=self.random_state).fit(X)
+        elif self.kernel == 'none':
+            self.kernel_map_ = None
+        else:
+            raise ValueError("Unknown kernel '%s' (none, rbf_sampler or nystroem)" % self.kernel)
+
+        model = SGDClassifier(loss='hinge', alpha=self.alpha, max_iter=self.max_iter, tol=self.tol,
+                              class_weight=self.class_weight, random_state=self.random_state)
+        self.model_ = CalibratedClassifierCV(model, method=self.calibration, cv=self.cv).fit(self._transform(X), y)
+        self.classes_ = self.model_.classes_
+
+        return self
+
+    def predict_proba(self, X):
+
+        return self.model_.predict_proba(self._transform(X))
+
+    def predict(self, X):
+
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+@profiled()
+def linear_support_vector_machine(train, validation,
+                                  parameters={'alpha': [1e-6, 1e-5, 1e-4],
+                                              'kernel': ['none', 'nystroem'],
+                                              'n_components': [300],
+                                              'max_iter': [20],
+                                              'calibration': ['sigmoid']},
+                                  use_gridsearch = 'yes',
+                                  refit = 'yes',
+                                  refit_iter = 20,
+                                  use_saved_model = 'no',
+                                  save_model = 'yes',
+                                  to_plot ='yes',
+                                  random_seed = 500):
+
+    # Sparse features (the usertag columns stay sparse)
+    train_X = sparse_model_features(train)
+    validation_X = sparse_model_features(validation)
+
+    if use_gridsearch == 'yes':
+
+        # Create model object
+        model = GridSearchCV(LinearSVMClassifier(random_state=random_seed), parameters, cv=3, verbose=10,
+                             scoring='roc_auc')
+
+        # Fit the model
+        with profile_span('linear_support_vector_machine.fit'):
+            model = model.fit(train_X, train['click'])
+
+        # View best hyperparameters
+        print('Best Alpha:', model.best_estimator_.get_params()['alpha'])
+        print('Best Kernel:', model.best_estimator_.get_params()['kernel'])
+
+        if refit == 'yes':
+
+            # If refit, run
+            model = LinearSVMClassifier(**dict(model.best_estimator_.get_params(), max_iter=refit_iter))
+
+            # Refit
+            with profile_span('linear_support_vector_machine.fit'):
+                model = model.fit(train_X, train['click'])
+
+            # Make prediction
+            with profile_span('linear_support_vector_machine.predict'):
+                prediction = model.predict_proba(validation_X)
+
+        else:
+            with profile_span('linear_support_vector_machine.predict'):
+                prediction = model.best_estimator_.predict_proba(validation_X)
+
+    elif use_saved_model == 'yes':
+
+        # Load from saved files
+        model_filename = os.getcwd() + "/models/linear_svm_model.pkl"
+        saved_model = joblib.load(model_filename)
+
+        # View saved model hyperparameters
+        print('Saved Model Alpha:', saved_model.get_params()['alpha'])
+        print('Saved Kernel:', saved_model.get_params()['kernel'])
+
+        if refit == 'yes':
+
+            # If refit, run
+            model = LinearSVMClassifier(**dict(saved_model.get_params(), max_iter=refit_iter,
+                                               random_state=random_seed))
+
+            # Fit the model
+            with profile_span('linear_support_vector_machine.fit'):
+                model = model.fit(train_X, train['click'])
+
+            # Make prediction
+            with profile_span('linear_support_vector_machine.predict'):
+                prediction = model.predict_proba(validation_X)
+
+        else:
+            with profile_span('linear_support_vector_machine.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(validation_X))
+            model = saved_model
+
+    else:
+
+        # Fit the model (first value of any grid)
+        model = LinearSVMClassifier(**{name: value[0] if isinstance(value, list) else value
+                                       for name, value in parameters.items()}, random_state=random_seed)
+
+        with profile_span('linear_support_vector_machine.fit'):
+            model = model.fit(train_X, train['click'])
+        with profile_span('linear_support_vector_machine.predict'):
+            prediction = model.predict_proba(validation_X)
+
+    # Print scores
+    print("AUC: %0.5f for Linear SVM Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
+
+    # Whether to save the model
+    if save_model == 'yes':
+
+        print('Saving the linear support vector machine to the disc.')
+        model_filename = os.getcwd() + "/models/linear_svm_model.pkl"
+        joblib.dump(model, model_filename, compress=9)
+
+    if to_plot == 'yes':
+
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Linear SVM',
+                       file_name='ROC_linear_SVM.pdf')
 
     return model, prediction[:,1]
 
 
 # --- NAIVE BAYES
+@profiled()
 def naive_bayes(train, validation, use_saved_model='yes', save_model='yes', to_plot ='yes'):
 
     if use_saved_model == 'yes':
@@ -711,16 +949,20 @@ def naive_bayes(train, validation, use_saved_model='yes', save_model='yes', to_p
         saved_model = joblib.load(model_filename)
 
         # Make prediction
-        prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('naive_bayes.predict'):
+            prediction = cached_predictions(model_filename, validation,
+                                            lambda: saved_model.predict_proba(model_features(validation)))
 
     else:
 
         # Fit the model
         model = GaussianNB()
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
+        with profile_span('naive_bayes.fit'):
+            model = model.fit(model_features(train), train['click'])
 
         # Make prediction
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('naive_bayes.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     # Print scores
     print("AUC: %0.5f for Naive Bayes."% (roc_auc_score(validation['click'], prediction[:, 1])))
@@ -734,13 +976,15 @@ def naive_bayes(train, validation, use_saved_model='yes', save_model='yes', to_p
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Naive Bayes',
+                       file_name='ROC_naive_bayes.pdf')
 
     return model, prediction[:,1]
 
 # naive_bayes(train2, validation1, to_plot ='yes')
 
 # --- KNN
+@profiled()
 def KNN(train, validation,
                            parameters={'n_neighbors': [1, 2,3],
                                        "algorithm": ['auto']},
@@ -749,8 +993,15 @@ def KNN(train, validation,
                    use_saved_model = 'no',
                    saved_model = [],
                    to_plot ='yes',
-                   random_seed = 500):
+                   random_seed = 500,
+                   model_type = 'sklearn',
+                   save_model = 'no'):
 
+    # Approximate search over bit-packed binary features (parameters of HammingKNNClassifier)
+    if model_type == 'hamming':
+        return approximate_KNN(train, validation, parameters=parameters, use_gridsearch=use_gridsearch, refit=refit,
+                               use_saved_model=use_saved_model, save_model=save_model, to_plot=to_plot,
+                               random_seed=random_seed)
 
     if use_gridsearch == 'yes':
 
@@ -758,7 +1009,8 @@ def KNN(train, validation,
         model = GridSearchCV(KNeighborsClassifier(), parameters, cv=3, verbose=10, scoring = 'roc_auc')
 
         # Fit the model
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
+        with profile_span('KNN.fit'):
+            model = model.fit(model_features(train), train['click'])
 
         # View best hyperparameters
         print('Best Model N Neighbours:', model.best_estimator_.get_params()['n_neighbors'])
@@ -769,20 +1021,27 @@ def KNN(train, validation,
             # If refit, run
             model = KNeighborsClassifier(n_neighbors=model.best_estimator_.get_params()['n_neighbors']
                                           , algorithm=model.best_estimator_.get_params()['algorithm'],
-                                         n_jobs = 3
-                                          , verbose=10)
+                                         n_jobs = 3)
 
             # Refit
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('KNN.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('KNN.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = model.best_estimator_.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('KNN.predict'):
+                prediction = model.best_estimator_.predict_proba(model_features(validation))
 
     elif use_saved_model == 'yes':
 
+        # Load from saved files (unless a fitted model is passed in)
+        model_filename = os.getcwd() + "/models/knn_model.pkl"
+        if not saved_model:
+            saved_model = joblib.load(model_filename)
+
         # View saved model hyperparameters
         print('Saved Model N Neighbours:', saved_model.get_params()['n_neighbors'])
         print('Saved Algorithm:', saved_model.get_params()['algorithm'])
@@ -792,16 +1051,18 @@ def KNN(train, validation,
             # If refit, run
             model = KNeighborsClassifier(n_neighbors=saved_model.get_params()['n_neighbors']
                                          , algorithm=saved_model.get_params()['algorithm'],
-                                         n_jobs=3
-                                         , verbose=10)
+                                         n_jobs=3)
             # Fit the model
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1), train['click'])
+            with profile_span('KNN.fit'):
+                model = model.fit(model_features(train), train['click'])
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('KNN.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+            with profile_span('KNN.predict'):
+                prediction = saved_model.predict_proba(model_features(validation))
             model = saved_model
 
     else:
@@ -809,54 +1070,578 @@ def KNN(train, validation,
         # Fit the model
         model = KNeighborsClassifier(n_neighbors=parameters['n_neighbors']
                                      , algorithm=parameters['algorithm'],
-                                     n_jobs=3
-                                     , verbose=10)
+                                     n_jobs=3)
 
 
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1), train['click'])
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1))
+        with profile_span('KNN.fit'):
+            model = model.fit(model_features(train), train['click'])
+        with profile_span('KNN.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     # Print scores
     print("AUC: %0.5f for KNN Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
 
+    # Whether to save the model
+    if save_model == 'yes':
+
+        print('Saving the KNN model to the disc.')
+        model_filename = os.getcwd() + "/models/knn_model.pkl"
+        joblib.dump(model, model_filename, compress=9)
+
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='KNN',
+                       file_name='ROC_KNN.pdf')
+
+    return model, prediction[:,1]
+
+
+# --- APPROXIMATE KNN (IVF INDEX OVER BIT-PACKED BINARY FEATURES, HAMMING DISTANCE)
+
+# Number of set bits of every byte value (popcount for numpy versions without np.bitwise_count)
+popcount_table = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(queries, codes):
+    """
+    Hamming distances between bit-packed query and stored codes (popcount of the XOR)
+    """
+
+    distances = np.zeros((queries.shape[0], codes.shape[0]), dtype=np.int32)
+
+    for word in range(codes.shape[1]):
+        xor = queries[:, word, None] ^ codes[None, :, word]
+        if hasattr(np, 'bitwise_count'):
+            distances += np.bitwise_count(xor)
+        else:
+            distances += popcount_table[xor[..., None].view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+    return distances
+
+
+def nearest_codes(queries, codes, k, block_size=1 << 20):
+    """
+    Distances and positions of the k nearest codes of every query (unordered)
+    """
+
+    k = min(k, codes.shape[0])
+    rows = max(1, block_size // max(codes.shape[0], 1))
+    distances = np.empty((queries.shape[0], k), dtype=np.int32)
+    positions = np.empty((queries.shape[0], k), dtype=np.int64)
+
+    for i in range(0, queries.shape[0], rows):
+        block = hamming_distances(queries[i:i + rows], codes)
+        nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+        distances[i:i + rows] = np.take_along_axis(block, nearest, axis=1)
+        positions[i:i + rows] = nearest
+
+    return distances, positions
+
+
+class HammingKNNClassifier(ClassifierMixin, BaseEstimator):
+    """
+    Approximate KNN on binarised, bit-packed features: an IVF index of n_lists cells, of which a query searches the
+    n_probe nearest by Hamming distance. Predicts the smoothed click rate of the neighbours found.
+    """
+
+    def __init__(self, n_neighbors=50, n_lists=256, n_probe=4, smoothing=5, n_iter=5, n_jobs=1, random_state=500):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.smoothing = smoothing
+        self.n_iter = n_iter
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def _codes(self, X):
+
+        codes = []
+        for i in range(0, X.shape[0], 65536):
+            block = X[i:i + 65536]
+            bits = (block.toarray() if sp.issparse(block) else np.asarray(block)) > self.thresholds_
+            bits = np.packbits(bits, axis=1, bitorder='little')
+            codes.append(np.pad(bits, ((0, 0), (0, -bits.shape[1] % 8))))
+
+        return np.ascontiguousarray(np.vstack(codes)).view(np.uint64)
+
+    def fit(self, X, y):
+
+        X = sp.csc_matrix(X) if sp.issparse(X) else np.asarray(X)
+        y = np.asarray(y)
+        generator = np.random.RandomState(self.random_state)
+
+        # Column medians (zero for one-hot columns, which are zero in most rows)
+        if sp.issparse(X):
+            mostly_set = np.nonzero(np.diff(X.indptr) > X.shape[0] // 2)[0]
+            self.thresholds_ = np.zeros(X.shape[1])
+            self.thresholds_[mostly_set] = [np.median(X[:, j].toarray()) for j in mostly_set]
+            X = X.tocsr()
+        else:
+            self.thresholds_ = np.median(X, axis=0)
+
+        codes = self._codes(X)
+        n_lists = min(self.n_lists, codes.shape[0])
+
+        # Binary k-majority centroids on a sample: each bit is set when most rows of the cell have it
+        sample = codes[generator.choice(codes.shape[0], min(codes.shape[0], 64 * n_lists), replace=False)]
+        centroids = sample[generator.choice(sample.shape[0], n_lists, replace=False)]
+        sample_bits = np.unpackbits(sample.view(np.uint8), axis=1, bitorder='little').astype(np.float32)
+
+        for iteration in range(self.n_iter):
+            cells = nearest_codes(sample, centroids, 1)[1][:, 0]
+            members = sp.csr_matrix((np.ones(len(cells), dtype=np.float32), (cells, np.arange(len(cells)))),
+                                    shape=(n_lists, len(cells)))
+            sizes = np.bincount(cells, minlength=n_lists)
+            majority = np.asarray(members @ sample_bits) * 2 > sizes[:, None]
+            updated = np.packbits(majority, axis=1, bitorder='little').view(np.uint64)
+            centroids[sizes > 0] = updated[sizes > 0]
+
+        # Training rows sorted by cell, with the offsets of every cell
+        cells = nearest_codes(codes, centroids, 1)[1][:, 0]
+        order = np.argsort(cells, kind='stable')
+        self.centroids_ = centroids
+        self.codes_ = codes[order]
+        self.clicks_ = y[order].astype(np.float32)
+        self.offsets_ = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=n_lists))])
+        self.prior_ = y.mean()
+        self.classes_ = np.unique(y)
+
+        return self
+
+    def kneighbors_clicks(self, X):
+        """
+        Clicks of the nearest training rows found in the probed cells, and how many were found
+        """
+
+        queries = self._codes(sp.csr_matrix(X) if sp.issparse(X) else np.asarray(X))
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+
+        if n_jobs > 1 and queries.shape[0] > 65536:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(self._search, np.array_split(queries, n_jobs)))
+            return np.concatenate([clicks for clicks, _ in results]), np.concatenate([found for _, found in results])
+
+        return self._search(queries)
+
+    def _search(self, queries):
+
+        n_probe = min(self.n_probe, self.centroids_.shape[0])
+        probes = nearest_codes(queries, self.centroids_, n_probe)[1]
+
+        # Running k nearest per query; empty slots sit at an infinite distance
+        best_distances = np.full((queries.shape[0], self.n_neighbors), np.iinfo(np.int32).max, dtype=np.int32)
+        best_clicks = np.zeros((queries.shape[0], self.n_neighbors), dtype=np.float32)
+
+        # Queries grouped by probed cell, so every cell is compared with all of its queries at once
+        pairs = np.argsort(probes.ravel(), kind='stable')
+        bounds = np.searchsorted(probes.ravel()[pairs], np.arange(self.centroids_.shape[0] + 1))
+
+        for cell in range(self.centroids_.shape[0]):
+
+            asked = pairs[bounds[cell]:bounds[cell + 1]] // n_probe
+            start, end = self.offsets_[cell], self.offsets_[cell + 1]
+            if len(asked) == 0 or start == end:
+                continue
+
+            # Current best and the whole cell in one partition, in blocks of queries
+            rows = max(1, (1 << 20) // (end - start))
+            for i in range(0, len(asked), rows):
+                block = asked[i:i + rows]
+                distances = np.hstack([best_distances[block], hamming_distances(queries[block],
+                                                                                self.codes_[start:end])])
+                nearest = np.argpartition(distances, self.n_neighbors - 1, axis=1)[:, :self.n_neighbors]
+                best_distances[block] = np.take_along_axis(distances, nearest, axis=1)
+                best_clicks[block] = np.where(nearest < self.n_neighbors,
+                                              np.take_along_axis(best_clicks[block],
+                                                                 np.minimum(nearest, self.n_neighbors - 1), axis=1),
+                                              self.clicks_[start:end][np.maximum(nearest - self.n_neighbors, 0)])
+
+        found = best_distances < np.iinfo(np.int32).max
+
+        return np.where(found, best_clicks, 0).sum(axis=1), found.sum(axis=1)
+
+    def predict_proba(self, X):
+
+        clicks, found = self.kneighbors_clicks(X)
+        probability = (clicks + self.smoothing * self.prior_) / (found + self.smoothing)
+
+        return np.column_stack([1 - probability, probability])
+
+    def predict(self, X):
+
+        return (self.predict_proba(X)[:, 1] >= 0.5).astype(int)
+
+
+@profiled()
+def approximate_KNN(train, validation,
+                    parameters={'n_neighbors': [20, 50, 100],
+                                'n_lists': [256],
+                                'n_probe': [2, 4, 8],
+                                'smoothing': [5]},
+                    use_gridsearch = 'yes',
+                    refit = 'yes',
+                    use_saved_model = 'no',
+                    save_model = 'yes',
+                    to_plot ='yes',
+                    random_seed = 500):
+
+    # Sparse features (the usertag columns stay sparse until they are bit-packed)
+    train_X = sparse_model_features(train)
+    validation_X = sparse_model_features(validation)
+
+    if use_gridsearch == 'yes':
+
+        # Create model object
+        model = GridSearchCV(HammingKNNClassifier(random_state=random_seed), parameters, cv=3, verbose=10,
+                             scoring='roc_auc')
+
+        # Fit the model
+        with profile_span('approximate_KNN.fit'):
+            model = model.fit(train_X, train['click'])
+
+        # View best hyperparameters
+        print('Best Model N Neighbours:', model.best_estimator_.get_params()['n_neighbors'])
+        print('Best Probed Lists:', model.best_estimator_.get_params()['n_probe'])
+
+        if refit == 'yes':
+
+            # If refit, run
+            model = HammingKNNClassifier(**model.best_estimator_.get_params())
+
+            # Refit
+            with profile_span('approximate_KNN.fit'):
+                model = model.fit(train_X, train['click'])
+
+            # Make prediction
+            with profile_span('approximate_KNN.predict'):
+                prediction = model.predict_proba(validation_X)
+
+        else:
+            with profile_span('approximate_KNN.predict'):
+                prediction = model.best_estimator_.predict_proba(validation_X)
+
+    elif use_saved_model == 'yes':
+
+        # Load from saved files
+        model_filename = os.getcwd() + "/models/approximate_knn_model.pkl"
+        saved_model = joblib.load(model_filename)
+
+        # View saved model hyperparameters
+        print('Saved Model N Neighbours:', saved_model.get_params()['n_neighbors'])
+        print('Saved Probed Lists:', saved_model.get_params()['n_probe'])
+
+        if refit == 'yes':
+
+            # If refit, run
+            model = HammingKNNClassifier(**dict(saved_model.get_params(), random_state=random_seed))
+
+            # Fit the model
+            with profile_span('approximate_KNN.fit'):
+                model = model.fit(train_X, train['click'])
+
+            # Make prediction
+            with profile_span('approximate_KNN.predict'):
+                prediction = model.predict_proba(validation_X)
+
+        else:
+            with profile_span('approximate_KNN.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(validation_X))
+            model = saved_model
+
+    else:
+
+        # Fit the model (first value of any grid)
+        model = HammingKNNClassifier(**{name: value[0] if isinstance(value, list) else value
+                                        for name, value in parameters.items()}, random_state=random_seed)
+
+        with profile_span('approximate_KNN.fit'):
+            model = model.fit(train_X, train['click'])
+        with profile_span('approximate_KNN.predict'):
+            prediction = model.predict_proba(validation_X)
+
+    # Print scores
+    print("AUC: %0.5f for Approximate KNN Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
+
+    # Whether to save the model
+    if save_model == 'yes':
+
+        print('Saving the approximate KNN model to the disc.')
+        model_filename = os.getcwd() + "/models/approximate_knn_model.pkl"
+        joblib.dump(model, model_filename, compress=9)
+
+    if to_plot == 'yes':
+
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Approximate KNN',
+                       file_name='ROC_approximate_KNN.pdf')
 
     return model, prediction[:,1]
 
 
 # --- FIELD-AWARE FACTORIZATION MACHINE
+def to_sparse_features(data, dtype=np.float32):
+    """
+    Convert a feature frame (or matrix) to CSR representation used by the sparse models
+    """
+
+    if sp.issparse(data):
+        return sp.csr_matrix(data, dtype=dtype)
+
+    return sp.csr_matrix(np.asarray(data, dtype=dtype))
+
+
+def pad_sparse_rows(X, rows, padding_index):
+    """
+    Turn selected CSR rows into padded (rows x max non-zeros) index and value arrays. Padding slots point to
+    padding_index and carry a value of zero, so they do not contribute to scores or gradients.
+    """
+
+    batch = X[rows]
+    lengths = np.diff(batch.indptr)
+    width = max(int(lengths.max()) if lengths.size else 0, 1)
+
+    # Position of every non-zero within its row
+    row_ids = np.repeat(np.arange(len(lengths)), lengths)
+    positions = np.arange(batch.nnz) - np.repeat(batch.indptr[:-1], lengths)
+
+    indices = np.full((len(lengths), width), padding_index, dtype=np.int64)
+    values = np.zeros((len(lengths), width), dtype=np.float32)
+    indices[row_ids, positions] = batch.indices
+    values[row_ids, positions] = batch.data
+
+    return indices, values
+
+
+class FieldAwareFactorizationMachine(ClassifierMixin, BaseEstimator):
+    """
+    Field-aware factorization machine for binary click prediction on sparse one-hot data.
+
+    Every feature holds one latent vector per field and the pairwise interaction between features i and j is
+    <V[i, field(j)], V[j, field(i)]>. Trained with mini-batch SGD or AdaGrad on the logistic loss; with n_jobs > 1
+    the mini-batches are spread over threads that update the shared weights without locking (Hogwild). Training
+    stops early when validation AUC has not improved for n_iter_no_change epochs.
+    """
+
+    def __init__(self, fields=None, rank=4, learning_rate=0.05, l2_reg_w=1e-5, l2_reg_V=1e-5, init_stdev=0.1,
+                 batch_size=1024, n_iter=20, solver='adagrad', n_jobs=1, n_iter_no_change=3,
+                 validation_fraction=0.1, random_state=500, verbose=0):
+        self.fields = fields
+        self.rank = rank
+        self.learning_rate = learning_rate
+        self.l2_reg_w = l2_reg_w
+        self.l2_reg_V = l2_reg_V
+        self.init_stdev = init_stdev
+        self.batch_size = batch_size
+        self.n_iter = n_iter
+        self.solver = solver
+        self.n_jobs = n_jobs
+        self.n_iter_no_change = n_iter_no_change
+        self.validation_fraction = validation_fraction
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def _pairs(self, width):
+
+        # Cache the upper-triangular pair indices for every padded row width
+        if width not in self._pair_cache:
+            self._pair_cache[width] = np.triu_indices(width, 1)
+
+        return self._pair_cache[width]
+
+    def _forward(self, indices, values):
+
+        fields = self.fields_[indices]
+        a, b = self._pairs(indices.shape[1])
+
+        V_a = self.V_[indices[:, a], fields[:, b]]
+        V_b = self.V_[indices[:, b], fields[:, a]]
+        x_ab = values[:, a] * values[:, b]
+
+        score = self.w0_ + np.sum(self.w_[indices] * values, axis=1) \
+            + np.sum(np.sum(V_a * V_b, axis=2) * x_ab, axis=1)
+
+        return score, (fields, a, b, V_a, V_b, x_ab)
+
+    def _update(self, parameter, accumulator, index, gradient, l2_reg):
+
+        # Aggregate the gradients of repeated indices (np.bincount is much faster than np.add.at)
+        unique_index, inverse = np.unique(index, return_inverse=True)
+
+        if gradient.ndim == 1:
+            gradient = np.bincount(inverse, weights=gradient, minlength=len(unique_index))
+        else:
+            gradient = np.column_stack([np.bincount(inverse, weights=gradient[:, k], minlength=len(unique_index))
+                                        for k in range(gradient.shape[1])])
+
+        gradient += l2_reg * parameter[unique_index]
+
+        if self.solver == 'adagrad':
+            accumulator[unique_index] += gradient ** 2
+            parameter[unique_index] -= self.learning_rate * gradient / np.sqrt(accumulator[unique_index] + 1e-8)
+
+        else:
+            parameter[unique_index] -= self.learning_rate * gradient
+
+    def _train_batch(self, X, y, rows):
+
+        indices, values = pad_sparse_rows(X, rows, self.padding_index_)
+        score, (fields, a, b, V_a, V_b, x_ab) = self._forward(indices, values)
+
+        # Gradient of the mean logistic loss with respect to the score
+        g = (1 / (1 + np.exp(-score)) - y[rows]) / len(rows)
+
+        # Bias
+        self.w0_ -= self.learning_rate * np.sum(g)
+
+        # Linear weights
+        self._update(self.w_, self.G_w_, indices.ravel(), (g[:, None] * values).ravel(), self.l2_reg_w)
+
+        # Latent factors, stored as a flat (feature * field, rank) table
+        n_fields = self.n_fields_
+        V_flat, G_V_flat = self.V_.reshape(-1, self.rank), self.G_V_.reshape(-1, self.rank)
+        g_pair = (g[:, None] * x_ab)[:, :, None]
+        index = np.concatenate([(indices[:, a] * n_fields + fields[:, b]).ravel(),
+                                (indices[:, b] * n_fields + fields[:, a]).ravel()])
+        gradient = np.concatenate([(g_pair * V_b).reshape(-1, self.rank), (g_pair * V_a).reshape(-1, self.rank)])
+        self._update(V_flat, G_V_flat, index, gradient, self.l2_reg_V)
+
+    def fit(self, X, y, X_val=None, y_val=None):
+        """
+        Fit the model on sparse (or dense) features X and binary labels y
+        """
+
+        X = to_sparse_features(X)
+        y = np.asarray(y, dtype=np.float32)
+        random_state = np.random.RandomState(self.random_state)
+
+        # Hold out part of the training set for early stopping if no validation set is given
+        if X_val is None:
+            permutation = random_state.permutation(X.shape[0])
+            n_validation = int(X.shape[0] * self.validation_fraction)
+            X_val, y_val = X[permutation[:n_validation]], y[permutation[:n_validation]]
+            X, y = X[permutation[n_validation:]], y[permutation[n_validation:]]
+
+        else:
+            X_val, y_val = to_sparse_features(X_val), np.asarray(y_val)
+
+        # Each column is its own field if field ids are not given
+        n_features = X.shape[1]
+        fields = np.arange(n_features) if self.fields is None else np.asarray(self.fields)
+        self.n_fields_ = int(fields.max()) + 1
+        self.padding_index_ = n_features
+        self.fields_ = np.append(fields, 0)
+        self._pair_cache = {}
+
+        # Initialise the parameters (the extra padding row stays at zero)
+        self.w0_ = 0.0
+        self.w_ = np.zeros(n_features + 1)
+        self.V_ = random_state.normal(0, self.init_stdev, (n_features + 1, self.n_fields_, self.rank))
+        self.V_[self.padding_index_] = 0
+        self.G_w_ = np.zeros_like(self.w_)
+        self.G_V_ = np.zeros_like(self.V_)
+        self.classes_ = np.array([0, 1])
+
+        best_auc, best_parameters, epochs_without_improvement = -np.inf, None, 0
+
+        for epoch in range(self.n_iter):
+
+            # Shuffle and split into mini-batches, distributed over the threads
+            permutation = random_state.permutation(X.shape[0])
+            batches = [permutation[i:i + self.batch_size] for i in range(0, len(permutation), self.batch_size)]
+
+            if self.n_jobs > 1:
+                with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+                    list(executor.map(lambda thread: [self._train_batch(X, y, rows)
+                                                      for rows in batches[thread::self.n_jobs]],
+                                      range(self.n_jobs)))
+            else:
+                for rows in batches:
+                    self._train_batch(X, y, rows)
+
+            # Early stopping on validation AUC
+            validation_auc = roc_auc_score(y_val, self.predict_proba(X_val)[:, 1])
+
+            if self.verbose:
+                print('Epoch %d: validation AUC %0.5f' % (epoch + 1, validation_auc))
+
+            if validation_auc > best_auc:
+                best_auc, epochs_without_improvement = validation_auc, 0
+                best_parameters = (self.w0_, self.w_.copy(), self.V_.copy())
+
+            else:
+                epochs_without_improvement += 1
+
+                if epochs_without_improvement >= self.n_iter_no_change:
+                    break
+
+        # Keep the current weights when no epoch ran or none improved (n_iter=0 or a NaN validation AUC)
+        if best_parameters is not None:
+            self.w0_, self.w_, self.V_ = best_parameters
+        self.best_validation_auc_ = best_auc
+
+        return self
+
+    def predict_proba(self, X):
+        """
+        Predict click probabilities, returned as (n_samples, 2) array like the sklearn classifiers
+        """
+
+        X = to_sparse_features(X)
+        if X.shape[0] == 0:
+            return np.empty((0, 2))
+
+        scores = np.concatenate([self._forward(*pad_sparse_rows(X, np.arange(i, min(i + 8192, X.shape[0])),
+                                                                self.padding_index_))[0]
+                                 for i in range(0, X.shape[0], 8192)])
+        probability = 1 / (1 + np.exp(-scores))
+
+        return np.column_stack([1 - probability, probability])
+
+    def predict(self, X):
+
+        return (self.predict_proba(X)[:, 1] >= 0.5).astype(int)
+
+
+@profiled()
 def factorization_machine(train, validation,
-                           parameters={'init_stdev': [0.1],
-                                       "rank": [2, 3, 4],
-                                       'l2_reg_w': [0.1, 1, 2],
-                                       'l2_reg_V':[0.1, 0.5, 1],
-                                       'n_iter': [10]},
-                  # use_gridsearch = 'yes',
+                           parameters={'rank': 4,
+                                       'learning_rate': 0.05,
+                                       'l2_reg_w': 1e-5,
+                                       'l2_reg_V': 1e-5,
+                                       'init_stdev': 0.1,
+                                       'batch_size': 1024,
+                                       'n_iter': 20,
+                                       'solver': 'adagrad',
+                                       'n_jobs': 3},
                    refit = 'yes',
-                          refit_iter = 20,
+                   refit_iter = 20,
                    use_saved_model = 'no',
                    save_model = 'yes',
                    to_plot ='yes',
                    random_seed = 500):
 
-    # Transform the data to sparse representation
-    train_X = train.drop(['click', 'bidprice', 'payprice'], axis=1)
-    sparse_train_X = sp.csc_matrix(train_X)
-    train_Y = train['click']
-    train_Y[train_Y == 0] = -1
+    # Sparse features without a dense copy of the frame, and the field of every column in the same order
+    fields, field_names = get_feature_fields(sparse_model_columns(train))
+    sparse_train_X = sparse_model_features(train)
+    train_Y = train['click'].values
 
-    validation_X = validation.drop(['click', 'bidprice', 'payprice'], axis=1)
-    validation_Y = validation['click']
-    validation_Y[validation_Y == 0] = -1
-    sparse_validation_X = sp.csc_matrix(validation_X)
+    sparse_validation_X = sparse_model_features(validation)
+    validation_Y = validation['click'].values
 
-    if use_saved_model == 'yes':
+    print('Factorization machine uses %d fields over %d features.' % (len(field_names), len(fields)))
 
+    if use_saved_model == 'yes':
 
         model_filename = os.getcwd() + "/models/fm_model.pkl"
-        saved_model = joblib.load(model_filename)
+        try:
+            saved_model = joblib.load(model_filename)
+        except (OSError, ImportError):
+            saved_model = None
+
+        # Older fm_model.pkl files hold a fastFM model, which this function can neither load nor refit
+        if not isinstance(saved_model, FieldAwareFactorizationMachine):
+            raise ValueError("%s is not a saved FieldAwareFactorizationMachine; run with use_saved_model='no' and "
+                             "save_model='yes' first." % model_filename)
 
         # View saved model hyperparameters
         print('Saved Model Rank:', saved_model.get_params()['rank'])
@@ -866,35 +1651,34 @@ def factorization_machine(train, validation,
         if refit == 'yes':
 
             # If refit, run
-            model = als.FMClassification(rank=saved_model.get_params()['rank']
-                                          , l2_reg_w=saved_model.get_params()['l2_reg_w']
-                                         , l2_reg_V = saved_model.get_params()['l2_reg_V'],
-                                         n_iter = refit_iter,
-                                         random_state = random_seed)
+            model = FieldAwareFactorizationMachine(**dict(saved_model.get_params(), fields=fields,
+                                                          n_iter=refit_iter, random_state=random_seed))
 
-            model = model.fit(sparse_train_X, train_Y)
+            with profile_span('factorization_machine.fit'):
+                model = model.fit(sparse_train_X, train_Y, sparse_validation_X, validation_Y)
 
             # Make prediction
-            prediction = model.predict_proba(sparse_validation_X)
+            with profile_span('factorization_machine.predict'):
+                prediction = model.predict_proba(sparse_validation_X)
 
         else:
-            prediction = saved_model.predict_proba(sparse_validation_X)
+            with profile_span('factorization_machine.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(sparse_validation_X))
             model = saved_model
 
     else:
 
         # Fit the model
-        model = als.FMClassification(rank=parameters['rank']
-                                     , l2_reg_w=parameters['l2_reg_w']
-                                     , l2_reg_V=parameters['l2_reg_V'],
-                                     n_iter=parameters['n_iter'],
-                                     random_state=random_seed)
+        model = FieldAwareFactorizationMachine(fields=fields, random_state=random_seed, **parameters)
 
-        model = model.fit(sparse_train_X, train_Y)
-        prediction = model.predict_proba(sparse_validation_X)
+        with profile_span('factorization_machine.fit'):
+            model = model.fit(sparse_train_X, train_Y, sparse_validation_X, validation_Y)
+        with profile_span('factorization_machine.predict'):
+            prediction = model.predict_proba(sparse_validation_X)
 
     # Print scores
-    print("AUC: %0.5f for Factorization Machine Model"% (roc_auc_score(validation_Y, prediction)))
+    print("AUC: %0.5f for Factorization Machine Model"% (roc_auc_score(validation_Y, prediction[:, 1])))
 
     # Whether to save the model
     if save_model == 'yes':
@@ -905,22 +1689,191 @@ def factorization_machine(train, validation,
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation_Y, prediction)
+        plot_ROC_curve(validation_Y, prediction[:, 1], model='Factorization Machine',
+                       file_name='ROC_factorization_machine.pdf')
 
-    return model, prediction
+    return model, prediction[:, 1]
 
 
 # --- NEURAL NETWORK
+class FieldEmbeddingMLPClassifier(ClassifierMixin, BaseEstimator):
+    """
+    Multi-layer perceptron for click prediction on sparse one-hot data.
+
+    The first layer embeds every feature field: the active columns of a field are looked up in an embedding table
+    and summed, and the field embeddings are concatenated before the fully connected ReLU layers. Forward and
+    backward passes are vectorised over mini-batches and the weights are updated with Adam. Training stops early
+    when validation AUC has not improved for n_iter_no_change epochs.
+    """
+
+    def __init__(self, fields=None, embedding_dim=4, hidden_layer_sizes=(64,), learning_rate=0.001, alpha=1e-5,
+                 batch_size=256, max_iter=20, n_iter_no_change=3, validation_fraction=0.1, random_state=500,
+                 verbose=0):
+        self.fields = fields
+        self.embedding_dim = embedding_dim
+        self.hidden_layer_sizes = hidden_layer_sizes
+        self.learning_rate = learning_rate
+        self.alpha = alpha
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.n_iter_no_change = n_iter_no_change
+        self.validation_fraction = validation_fraction
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def _field_selector(self, X):
+
+        # Sparse (rows * fields, features) matrix that sums the active columns of every field of every row
+        X = X.tocoo()
+        rows = X.row * self.n_fields_ + self.fields_[X.col]
+
+        return sp.csr_matrix((X.data, (rows, X.col)), shape=(X.shape[0] * self.n_fields_, X.shape[1]))
+
+    def _forward(self, X):
+
+        selector = self._field_selector(X)
+        activations = [np.asarray(selector @ self.coefs_[0]).reshape(X.shape[0], -1)]
+
+        for W, b in zip(self.coefs_[1:-1], self.intercepts_[1:-1]):
+            activations.append(np.maximum(activations[-1] @ W + b, 0))
+
+        score = (activations[-1] @ self.coefs_[-1] + self.intercepts_[-1]).ravel()
+
+        return score, activations, selector
+
+    def _train_batch(self, X, y):
+
+        score, activations, selector = self._forward(X)
+
+        # Gradient of the mean logistic loss with respect to the output score
+        delta = ((1 / (1 + np.exp(-score)) - y) / X.shape[0])[:, None]
+        coef_grads, intercept_grads = [None] * len(self.coefs_), [None] * len(self.coefs_)
+
+        for layer in range(len(self.coefs_) - 1, 0, -1):
+            coef_grads[layer] = activations[layer - 1].T @ delta + self.alpha * self.coefs_[layer]
+            intercept_grads[layer] = delta.sum(axis=0)
+            delta = delta @ self.coefs_[layer].T
+
+            # ReLU derivative (the embedding layer is linear)
+            if layer > 1:
+                delta *= activations[layer - 1] > 0
+
+        # Embedding table gradient is scattered back through the sparse field selector
+        coef_grads[0] = np.asarray(selector.T @ delta.reshape(-1, self.embedding_dim)) + self.alpha * self.coefs_[0]
+        intercept_grads[0] = 0
+
+        # Adam update
+        self.t_ += 1
+        correction = np.sqrt(1 - 0.999 ** self.t_) / (1 - 0.9 ** self.t_)
+
+        for parameters, gradients, moments in [(self.coefs_, coef_grads, self.coef_moments_),
+                                               (self.intercepts_, intercept_grads, self.intercept_moments_)]:
+            for i, (gradient, (m, v)) in enumerate(zip(gradients, moments)):
+                m *= 0.9
+                m += 0.1 * gradient
+                v *= 0.999
+                v += 0.001 * gradient ** 2
+                parameters[i] -= self.learning_rate * correction * m / (np.sqrt(v) + 1e-8)
+
+    def fit(self, X, y, X_val=None, y_val=None):
+        """
+        Fit the model on sparse (or dense) features X and binary labels y
+        """
+
+        X = to_sparse_features(X)
+        y = np.asarray(y, dtype=np.float32)
+        random_state = np.random.RandomState(self.random_state)
+
+        # Hold out part of the training set for early stopping if no validation set is given
+        if X_val is None:
+            permutation = random_state.permutation(X.shape[0])
+            n_validation = int(X.shape[0] * self.validation_fraction)
+            X_val, y_val = X[permutation[:n_validation]], y[permutation[:n_validation]]
+            X, y = X[permutation[n_validation:]], y[permutation[n_validation:]]
+
+        else:
+            X_val, y_val = to_sparse_features(X_val), np.asarray(y_val)
+
+        # Each column is its own field if field ids are not given
+        self.fields_ = np.arange(X.shape[1]) if self.fields is None else np.asarray(self.fields)
+        self.n_fields_ = int(self.fields_.max()) + 1
+        self.classes_ = np.array([0, 1])
+
+        # Glorot initialisation; layer 0 is the embedding table
+        layer_sizes = [self.n_fields_ * self.embedding_dim] + list(self.hidden_layer_sizes) + [1]
+        self.coefs_ = [random_state.normal(0, 0.1, (X.shape[1], self.embedding_dim)).astype(np.float32)]
+        self.intercepts_ = [np.zeros(self.embedding_dim, dtype=np.float32)]
+
+        for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:]):
+            bound = np.sqrt(6 / (n_in + n_out))
+            self.coefs_.append(random_state.uniform(-bound, bound, (n_in, n_out)).astype(np.float32))
+            self.intercepts_.append(np.zeros(n_out, dtype=np.float32))
+
+        self.coef_moments_ = [(np.zeros_like(W), np.zeros_like(W)) for W in self.coefs_]
+        self.intercept_moments_ = [(np.zeros_like(b), np.zeros_like(b)) for b in self.intercepts_]
+        self.t_ = 0
+
+        best_auc, best_parameters, epochs_without_improvement = -np.inf, None, 0
+
+        for epoch in range(self.max_iter):
+
+            permutation = random_state.permutation(X.shape[0])
+
+            for i in range(0, len(permutation), self.batch_size):
+                rows = permutation[i:i + self.batch_size]
+                self._train_batch(X[rows], y[rows])
+
+            # Early stopping on validation AUC
+            validation_auc = roc_auc_score(y_val, self.predict_proba(X_val)[:, 1])
+
+            if self.verbose:
+                print('Epoch %d: validation AUC %0.5f' % (epoch + 1, validation_auc))
+
+            if validation_auc > best_auc:
+                best_auc, epochs_without_improvement = validation_auc, 0
+                best_parameters = ([W.copy() for W in self.coefs_], [b.copy() for b in self.intercepts_])
+
+            else:
+                epochs_without_improvement += 1
+
+                if epochs_without_improvement >= self.n_iter_no_change:
+                    break
+
+        # Keep the current weights when no epoch ran or none improved (max_iter=0 or a NaN validation AUC)
+        if best_parameters is not None:
+            self.coefs_, self.intercepts_ = best_parameters
+        self.best_validation_auc_ = best_auc
+
+        return self
+
+    def predict_proba(self, X):
+        """
+        Predict click probabilities, returned as (n_samples, 2) array like the sklearn classifiers
+        """
+
+        X = to_sparse_features(X)
+        if X.shape[0] == 0:
+            return np.empty((0, 2))
+
+        scores = np.concatenate([self._forward(X[i:i + 8192])[0] for i in range(0, X.shape[0], 8192)])
+        probability = 1 / (1 + np.exp(-scores))
+
+        return np.column_stack([1 - probability, probability])
+
+    def predict(self, X):
+
+        return (self.predict_proba(X)[:, 1] >= 0.5).astype(int)
+
+
+@profiled()
 def neural_network(train, validation,
-                           parameters={'learning_rate': [0.005, 0.01],
-                                       "learning_momentum": ['0.9'],
-                                       "regularize": ['L2'],
-                                       "dropout_rate": [0.2],
-                                       "batch_size": [1],
-                                       "n_stable": [10],
-                                       "n_iter": [10],
-                                       'hidden0__units': [32, 64],
-                                       'hidden0__type': ["Rectifier"]},
+                           parameters={'learning_rate': [0.001, 0.005],
+                                       'alpha': [1e-5],
+                                       'embedding_dim': [4, 8],
+                                       'batch_size': [256],
+                                       'n_iter_no_change': [3],
+                                       'max_iter': [10],
+                                       'hidden_layer_sizes': [(32,), (64,)]},
                    use_gridsearch='yes',
                    refit='yes',
                    refit_iter=20,
@@ -929,45 +1882,46 @@ def neural_network(train, validation,
                    to_plot='yes',
                    random_seed=500):
 
-    if use_gridsearch == 'yes':
+    # Sparse features without a dense copy of the frame, and the field of every column in the same order
+    fields, field_names = get_feature_fields(sparse_model_columns(train))
+    sparse_train_X = sparse_model_features(train)
+    sparse_validation_X = sparse_model_features(validation)
 
-        # Create layers object
-        nn_layers = [Layer("Rectifier", units=64), Layer("Softmax")]
+    if use_gridsearch == 'yes':
 
         # Create model object
-        model = GridSearchCV(sknn.mlp.Classifier(layers=nn_layers, random_state=random_seed),
+        model = GridSearchCV(FieldEmbeddingMLPClassifier(fields=fields, random_state=random_seed),
                              parameters, cv=3, verbose=10, scoring='roc_auc')
 
         # Fit the model
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1).values, train['click'].values)
+        with profile_span('neural_network.fit'):
+            model = model.fit(sparse_train_X, train['click'].values)
 
         # View best hyperparameters
-        print('Saved Model Learning Rate:', model.best_estimator_.get_params()['learning_rate'])
-        print('Saved Model Dropout Rate:', model.best_estimator_.get_params()['dropout_rate'])
-        print('Saved Model Batch Size:', model.best_estimator_.get_params()['batch_size'])
-        print('Saved Model Hidden Architecture:', model.best_estimator_.get_params()['layers'])
-        print('Saved Model Learning Momentum:', model.best_estimator_.get_params()['learning_momentum'])
+        print('Best Model Learning Rate:', model.best_estimator_.get_params()['learning_rate'])
+        print('Best Model Embedding Dimension:', model.best_estimator_.get_params()['embedding_dim'])
+        print('Best Model Batch Size:', model.best_estimator_.get_params()['batch_size'])
+        print('Best Model Hidden Architecture:', model.best_estimator_.get_params()['hidden_layer_sizes'])
+        print('Best Model L2 Regularisation:', model.best_estimator_.get_params()['alpha'])
 
         if refit == 'yes':
 
             # If refit, run
-            model = sknn.mlp.Classifier(layers=model.best_estimator_.get_params()['layers']
-                                          , learning_rate=model.best_estimator_.get_params()['learning_rate']
-                                        , learning_momentum=model.best_estimator_.get_params()['learning_momentum']
-                                        , dropout_rate=model.best_estimator_.get_params()['dropout_rate']
-                                          , batch_size=model.best_estimator_.get_params()['batch_size']
-                                          , n_iter=refit_iter
-                                          , verbose=10
-                                , random_state = random_seed)
+            model = FieldEmbeddingMLPClassifier(**dict(model.best_estimator_.get_params(), max_iter=refit_iter,
+                                                       verbose=10, random_state=random_seed))
 
             # Refit
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1).values, train['click'].values)
+            with profile_span('neural_network.fit'):
+                model = model.fit(sparse_train_X, train['click'].values, sparse_validation_X,
+                                  validation['click'].values)
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+            with profile_span('neural_network.predict'):
+                prediction = model.predict_proba(sparse_validation_X)
 
         else:
-            prediction = model.best_estimator_.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+            with profile_span('neural_network.predict'):
+                prediction = model.best_estimator_.predict_proba(sparse_validation_X)
 
     elif use_saved_model == 'yes':
 
@@ -977,47 +1931,41 @@ def neural_network(train, validation,
 
         # View saved model hyperparameters
         print('Saved Model Learning Rate:', saved_model.get_params()['learning_rate'])
-        print('Saved Model Dropout Rate:', saved_model.get_params()['dropout_rate'])
+        print('Saved Model Embedding Dimension:', saved_model.get_params()['embedding_dim'])
         print('Saved Model Batch Size:', saved_model.get_params()['batch_size'])
-        print('Saved Model Hidden Architecture:', saved_model.get_params()['layers'])
-        print('Saved Model Learning Momentum:', saved_model.get_params()['learning_momentum'])
+        print('Saved Model Hidden Architecture:', saved_model.get_params()['hidden_layer_sizes'])
+        print('Saved Model L2 Regularisation:', saved_model.get_params()['alpha'])
 
         if refit == 'yes':
 
             # If refit, run
-            model = sknn.mlp.Classifier(layers=saved_model.get_params()['layers']
-                                          , learning_rate=saved_model.get_params()['learning_rate']
-                                        , learning_momentum=saved_model.get_params()['learning_momentum']
-                                        , dropout_rate=saved_model.get_params()['dropout_rate']
-                                          , batch_size=saved_model.get_params()['batch_size']
-                                          , n_iter=refit_iter
-                                          , verbose=10
-                                , random_state = random_seed)
+            model = FieldEmbeddingMLPClassifier(**dict(saved_model.get_params(), fields=fields, max_iter=refit_iter,
+                                                       verbose=10, random_state=random_seed))
 
             # Fit the model
-            model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1).values, train['click'].values)
+            with profile_span('neural_network.fit'):
+                model = model.fit(sparse_train_X, train['click'].values, sparse_validation_X,
+                                  validation['click'].values)
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+            with profile_span('neural_network.predict'):
+                prediction = model.predict_proba(sparse_validation_X)
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+            with profile_span('neural_network.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(sparse_validation_X))
             model = saved_model
 
     else:
 
         # Fit the model
-        model = sknn.mlp.Classifier(layers=parameters['layers']
-                                    , learning_rate=parameters['learning_rate']
-                                    , learning_momentum=parameters['learning_momentum']
-                                    , dropout_rate=parameters['dropout_rate']
-                                    , batch_size=parameters['batch_size']
-                                    , n_iter=refit_iter
-                                    , verbose=10
-                                    , random_state=random_seed)
-
-        model = model.fit(train.drop(['click','bidprice', 'payprice'], axis=1).values, train['click'].values)
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+        model = FieldEmbeddingMLPClassifier(fields=fields, verbose=10, random_state=random_seed, **parameters)
+
+        with profile_span('neural_network.fit'):
+            model = model.fit(sparse_train_X, train['click'].values, sparse_validation_X, validation['click'].values)
+        with profile_span('neural_network.predict'):
+            prediction = model.predict_proba(sparse_validation_X)
 
     # Print scores
     print("AUC: %0.5f for Neural Network Model"% (roc_auc_score(validation['click'], prediction[:, 1])))
@@ -1031,12 +1979,14 @@ def neural_network(train, validation,
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Neural Network',
+                       file_name='ROC_neural_network.pdf')
 
     return model, prediction[:,1]
 
 
 # --- STACKING
+@profiled()
 def stacking_classifier(train, validation, refit = 'yes', use_saved_model = 'no', save_model = 'yes', to_plot ='yes',
                         meta_leaner_parameters={'max_depth':20, "n_estimators":20, "learning_rate":0.05,
                                                 'silent':False, 'n_jobs':3,'subsample':1, 'objective':'binary:logistic',
@@ -1046,7 +1996,8 @@ def stacking_classifier(train, validation, refit = 'yes', use_saved_model = 'no'
                                                'use_features_in_secondary': True,
                                                'cv': 5,
                                                'store_train_meta_features': True,
-                                               'refit': True}):
+                                               'refit': True},
+                        include_knn = 'no'):
 
     if use_saved_model == 'no':
 
@@ -1093,14 +2044,21 @@ def stacking_classifier(train, validation, refit = 'yes', use_saved_model = 'no'
                                              reg_lambda=meta_leaner_parameters['reg_lambda'],
                                              random_state = meta_leaner_parameters['random_state'])
 
-        model = StackingCVClassifier(classifiers=[rf_model, erf_model, xgb_model],
+        # Approximate KNN neighbour CTR as an extra first-level feature (saved by KNN(..., model_type='hamming'))
+        classifiers = [rf_model, erf_model, xgb_model]
+        if include_knn == 'yes':
+            classifiers.append(joblib.load(os.getcwd() + "/models/approximate_knn_model.pkl"))
+
+        model = StackingCVClassifier(classifiers=classifiers,
                                     meta_classifier=meta_learner, use_probas=stacking_cv_parameters['use_probas'],
                                     use_features_in_secondary = stacking_cv_parameters['use_features_in_secondary'],
                                     store_train_meta_features=stacking_cv_parameters['store_train_meta_features'],
                                     cv = stacking_cv_parameters['cv'])
 
-        model = model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1).values, train['click'].values)
-        prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+        with profile_span('stacking_classifier.fit'):
+            model = model.fit(model_features(train), train['click'].values)
+        with profile_span('stacking_classifier.predict'):
+            prediction = model.predict_proba(model_features(validation))
 
     else:
 
@@ -1111,13 +2069,18 @@ def stacking_classifier(train, validation, refit = 'yes', use_saved_model = 'no'
         if refit == 'yes':
 
             # If refit, run
-            model = saved_model.fit(train.drop(['click', 'bidprice', 'payprice'], axis=1).values, train['click'].values)
+            with profile_span('stacking_classifier.fit'):
+                model = saved_model.fit(model_features(train),
+                                        train['click'].values)
 
             # Make prediction
-            prediction = model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+            with profile_span('stacking_classifier.predict'):
+                prediction = model.predict_proba(model_features(validation))
 
         else:
-            prediction = saved_model.predict_proba(validation.drop(['click', 'bidprice', 'payprice'], axis=1).values)
+            with profile_span('stacking_classifier.predict'):
+                prediction = cached_predictions(model_filename, validation,
+                                                lambda: saved_model.predict_proba(model_features(validation)))
             model = saved_model
 
 
@@ -1134,7 +2097,8 @@ def stacking_classifier(train, validation, refit = 'yes', use_saved_model = 'no'
 
     if to_plot == 'yes':
 
-        plot_ROC_curve(validation['click'], prediction[:, 1])
+        plot_ROC_curve(validation['click'], prediction[:, 1], model='Stacked',
+                       file_name='ROC_stacked.pdf')
 
     return model, prediction[:,1]
 
@@ -24,11 +24,19 @@ Date:
 import pandas as pd
 import numpy as np
 import time
-import matplotlib.pyplot as plt
-from scipy.interpolate import griddata
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.ticker as mtick
-import matplotlib.cm as cm
+import json
+import sqlite3
+import hashlib
+import inspect
+import tracemalloc
+import os
+from scipy.optimize import minimize_scalar
+from scipy.stats import t as student_t
+from sklearn.isotonic import IsotonicRegression
+from sklearn.linear_model import LogisticRegression
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from E_Pipeline_Utilities import defer_plot, profiled, share_arrays, attach_arrays, release_arrays
 
 
 # ----------------------------- BID NORMALISATION --------------------------------- #
@@ -44,6 +52,78 @@ def normalise_bids(prediction, minority_weighting = 0.025):
     return output
 
 
+# --- CALIBRATION LAYER (REPLACES THE FORMULA FOR MODELS THAT ARE NOT CALIBRATED ON THE DOWNSAMPLED DATA)
+def fit_calibration(prediction, clicks, method='isotonic', n_points=1000):
+    '''
+    Maps raw model scores to pCTR on the true click rate, fitted on validation predictions. Isotonic or Platt
+    (logistic on the log-odds of the score), compiled into an interpolation table: {'method', 'x', 'y'}.
+    '''
+
+    prediction = np.asarray(prediction, dtype=np.float64)
+    clicks = np.asarray(clicks)
+
+    if method == 'isotonic':
+        # The isotonic fit is piecewise linear between its thresholds, so the table is exact
+        isotonic = IsotonicRegression(y_min=0, y_max=1, out_of_bounds='clip').fit(prediction, clicks)
+        x, y = isotonic.X_thresholds_, isotonic.y_thresholds_
+
+    elif method == 'platt':
+        # Monotone sigmoid evaluated on the score quantiles
+        log_odds = lambda p: np.log(np.clip(p, 1e-12, 1 - 1e-12) / (1 - np.clip(p, 1e-12, 1 - 1e-12)))
+        platt = LogisticRegression(C=1e6).fit(log_odds(prediction)[:, None], clicks)
+        x = np.unique(np.quantile(prediction, np.linspace(0, 1, n_points)))
+        y = platt.predict_proba(log_odds(x)[:, None])[:, 1]
+
+    else:
+        raise ValueError("Unknown calibration method '%s' (isotonic or platt)" % method)
+
+    return {'method': method, 'x': np.asarray(x, dtype=np.float64), 'y': np.asarray(y, dtype=np.float64)}
+
+
+def calibrate_predictions(prediction, calibration):
+    '''
+    Vectorised table lookup (no model call); scores outside the fitted range take the end values
+    '''
+
+    return np.interp(prediction, calibration['x'], calibration['y'])
+
+
+def cross_fitted_calibration(prediction, clicks, method='isotonic', n_folds=5, seed=500, n_points=1000,
+                             minority_weighting=0.025):
+    '''
+    Out-of-fold calibrated validation predictions (the bid parameters are tuned on the same rows, so each row is
+    calibrated by a table that did not see its click) and the table fitted on all rows for scoring new data
+    '''
+
+    prediction = np.asarray(prediction, dtype=np.float64)
+    clicks = np.asarray(clicks)
+    folds = np.random.RandomState(seed).randint(0, n_folds, prediction.shape[0])
+
+    calibrated = np.empty_like(prediction)
+    for fold in range(n_folds):
+        held_out = folds == fold
+        table = fit_calibration(prediction[~held_out], clicks[~held_out], method=method, n_points=n_points)
+        calibrated[held_out] = calibrate_predictions(prediction[held_out], table)
+
+    calibration = fit_calibration(prediction, clicks, method=method, n_points=n_points)
+
+    print('Calibration (%s): mean pCTR %.6f against CTR %.6f, log loss %.6f (formula: %.6f).'
+          % (method, calibrated.mean(), clicks.mean(), calibration_log_loss(calibrated, clicks),
+             calibration_log_loss(normalise_bids(prediction, minority_weighting), clicks)))
+
+    return calibrated, calibration
+
+
+def calibration_log_loss(prediction, clicks):
+    '''
+    Log loss of pCTR against clicks
+    '''
+
+    prediction = np.clip(prediction, 1e-12, 1 - 1e-12)
+
+    return -np.mean(clicks * np.log(prediction) + (1 - clicks) * np.log(1 - prediction))
+
+
 # --------------------------------- FITTING --------------------------------------- #
 
 # --- CONSTANT BIDDING STRATEGY
@@ -88,16 +168,70 @@ def random_bidding_strategy(data, lower_bound=0, upper_bound=400, budget=6250000
     return impressions, clicks, ads_auctioned
 
 
-# --- pCTR BASED BIDDING STRATEGIES (CRUDE PARAMETER ESTIMATION)
-def parametrised_bidding_strategy(data, prediction, type='linear', parameter=100, budget=625000,
-                                  average_CTR=None):
+# --- MONTE CARLO FOR RANDOM BIDDING
+@profiled()
+def random_bidding_monte_carlo(data, parameters, repeated_runs=20, budget=6250000, seed=500, confidence=0.95,
+                               common_random_numbers='yes'):
 
-    if average_CTR == None:
-        avgCTR = np.repeat(average_CTR, prediction.shape[0])
+    '''
+    All runs of random bidding for every (lower, upper) pair, drawn with a seeded numpy Generator. With common
+    random numbers one block of uniforms (runs x auctions) is shared by every pair and rescaled to its bounds,
+    which removes the between-pair noise from comparisons; otherwise each pair gets its own block. Returns the
+    mean impressions, clicks and ads auctioned for per pair, and a table with the confidence interval half-widths.
+    '''
 
-    else:
-        # Calculate bids based on the model
-        avgCTR = np.repeat(np.sum(data['click'] == 1) / data.shape[0], prediction.shape[0])
+    # Integer prices keep the cumulative spend exact; int64 so long logs cannot overflow it
+    payprice = np.asarray(data['payprice'], dtype=np.int64)
+    clicks = np.asarray(data['click']) == 1
+    parameters = np.asarray(parameters, dtype=np.float64).reshape(-1, 2)
+    generator = np.random.default_rng(seed)
+
+    if common_random_numbers == 'yes':
+        uniforms = generator.random((repeated_runs, payprice.shape[0]))
+
+    bids = np.empty((repeated_runs, payprice.shape[0]))
+    spend = np.empty(bids.shape, dtype=np.int64)
+    won = np.empty(bids.shape, dtype=bool)
+    results = np.empty((parameters.shape[0], 4, repeated_runs))
+
+    for i, (lower_bound, upper_bound) in enumerate(parameters):
+
+        if common_random_numbers != 'yes':
+            uniforms = generator.random((repeated_runs, payprice.shape[0]))
+
+        # Integer bids in [lower, upper) like randint
+        np.multiply(uniforms, upper_bound - lower_bound, out=bids)
+        np.add(bids, lower_bound, out=bids)
+        np.floor(bids, out=bids)
+
+        # Same budget rule as random_bidding_strategy; spend is monotone so the valid bids are a prefix of each run
+        np.less(payprice, bids, out=won)
+        np.multiply(payprice, won, out=spend)
+        np.cumsum(spend, axis=1, out=spend)
+
+        for run in range(repeated_runs):
+            valid = np.searchsorted(spend[run], budget, side='right')
+            results[i, 0, run] = np.count_nonzero(won[run, :valid])
+            results[i, 1, run] = np.count_nonzero(won[run, :valid] & clicks[:valid])
+            results[i, 2, run] = np.searchsorted(spend[run], budget, side='left')
+
+        results[i, 3] = results[i, 1] / np.maximum(results[i, 0], 1)
+
+    # Student t intervals over the runs
+    means = results.mean(axis=2)
+    quantile = student_t.ppf((1 + confidence) / 2, max(repeated_runs - 1, 1))
+    half_widths = quantile * results.std(axis=2, ddof=1) / np.sqrt(repeated_runs) if repeated_runs > 1 \
+        else np.full(means.shape, np.nan)
+    intervals = pd.DataFrame(half_widths, columns=['impressions_won_ci', 'clicks_won_ci', 'ads_auctioned_for_ci',
+                                                   'CTR_ci'])
+
+    return means[:, 0], means[:, 1], means[:, 2], intervals
+
+
+# --- pCTR BASED BIDDING STRATEGIES (CRUDE PARAMETER ESTIMATION)
+def parametrised_bids(prediction, type, parameter, avgCTR):
+
+    # Bid vector of parametrised_bidding_strategy (also timed by benchmark_bid_functions)
 
     # For linear model
     if type == 'linear':
@@ -109,6 +243,21 @@ def parametrised_bidding_strategy(data, prediction, type='linear', parameter=100
     if type == 'exponential':
         bids = np.repeat(parameter, prediction.shape[0]) * np.exp(np.array(prediction) / avgCTR)
 
+    return bids
+
+
+def parametrised_bidding_strategy(data, prediction, type='linear', parameter=100, budget=625000,
+                                  average_CTR=None):
+
+    if average_CTR is None:
+        # Calculate bids based on the model
+        avgCTR = np.repeat(np.sum(data['click'] == 1) / data.shape[0], prediction.shape[0])
+
+    else:
+        avgCTR = np.repeat(average_CTR, prediction.shape[0])
+
+    bids = parametrised_bids(prediction, type, parameter, avgCTR)
+
     # Get boolean vector of the bids won
     bids_won = np.array(data['payprice']) < bids
 
@@ -127,18 +276,9 @@ def parametrised_bidding_strategy(data, prediction, type='linear', parameter=100
 
 
 # --- Optimal Real Time Bidding (ORTB)
-def ORTB_strategy(data, prediction, type = 'ORTB1', c=50, b=1, budget=6250000, average_CTR=7.375623e-04):
-
-    """
-    ORTB1 formula:
-    sqrt(c/lambda * pctr + c**2) - c
+def ORTB_bids(prediction, type='ORTB1', c=50, b=1, average_CTR=7.375623e-04):
 
-    ORTB2 formula:
-    term = (pCTR + np.sqrt(c * c * lambda_ * lambda_ + pCTR * pCTR)) / (c * lambda_)
-    bid = c * (term**(1 / 3) - term**(-1 / 3))
-    """
-
-    # Calculate bids based on the specified model
+    # Bid vector of ORTB_strategy (also timed by benchmark_bid_functions)
     size = prediction.shape[0]
 
     if type == 'ORTB1':
@@ -154,10 +294,27 @@ def ORTB_strategy(data, prediction, type = 'ORTB1', c=50, b=1, budget=6250000, a
 
     else:
         term = (np.array(prediction) + np.sqrt(np.repeat(c, size) ** 2
-                                               * np.repeat(b, size) * 2 + np.array(prediction) ** 2)) \
+                                               * np.repeat(b, size) ** 2 + np.array(prediction) ** 2)) \
             / (np.repeat(c, size) * np.repeat(b, size))
         bids = np.repeat(c, size) * ((term ** (1 / 3)) - (term ** (-1 / 3)))
 
+    return bids
+
+
+def ORTB_strategy(data, prediction, type = 'ORTB1', c=50, b=1, budget=6250000, average_CTR=7.375623e-04):
+
+    """
+    ORTB1 formula:
+    sqrt(c/lambda * pctr + c**2) - c
+
+    ORTB2 formula:
+    term = (pCTR + np.sqrt(c * c * lambda_ * lambda_ + pCTR * pCTR)) / (c * lambda_)
+    bid = c * (term**(1 / 3) - term**(-1 / 3))
+    """
+
+    # Calculate bids based on the specified model
+    bids = ORTB_bids(prediction, type, c, b, average_CTR)
+
     # Get boolean vector of the bids won
     bids_won = np.array(data['payprice']) < bids
 
@@ -175,220 +332,1082 @@ def ORTB_strategy(data, prediction, type = 'ORTB1', c=50, b=1, budget=6250000, a
     return impressions, clicks, ads_auctioned
 
 
-# --- Evaluate Strategies Using Different Parameter Combinations
-def strategy_evaluation(data, prediction, parameter_range, type = 'linear',  budget = 6250000,
-                        only_best = 'no', to_plot = 'yes', plot_3d = 'no', repeated_runs = 1,
-                        average_CTR = 7.375623e-04, to_save='no', file_name='bidding_strategy.pdf'):
+# ----------------------------- BID FUNCTION REGISTRY ----------------------------- #
 
-    # Time it
-    start_time = time.time()
+# Every bid function fills a (parameters x auctions) array in place: prediction and ratio (= pCTR / average CTR)
+# are 1-d, parameters is 2-d with one row per parameter combination, out and work are preallocated buffers
+def constant_bids(prediction, ratio, parameters, out, work):
+    np.copyto(out, parameters[:, 0:1])
 
-    # Initialise output
-    colnames = ['type', 'budget', 'parameter_1', 'parameter_2', 'total_auctions',
-                'ads_auctioned_for', 'impressions_won', 'clicks_won',
-                'CTR', 'CPM', 'CPC']
-    output = pd.DataFrame(index=range(len(parameter_range)), columns=colnames)
 
-    for i, parameter in zip(range(len(parameter_range)), parameter_range):
+def linear_bids(prediction, ratio, parameters, out, work):
+    np.multiply(parameters[:, 0:1], ratio, out=out)
 
-        print(i, parameter)
 
-        if parameter_range[0].size == 1:
-            output['parameter_1'][i] = parameter
+def square_bids(prediction, ratio, parameters, out, work):
+    np.square(ratio, out=out)
+    np.multiply(parameters[:, 0:1], out, out=out)
+
+
+def exponential_bids(prediction, ratio, parameters, out, work):
+    np.exp(ratio, out=out)
+    np.multiply(parameters[:, 0:1], out, out=out)
+
+
+def ORTB1_bids(prediction, ratio, parameters, out, work):
+    '''
+    sqrt(c / lambda * pCTR + c**2) - c
+    '''
+    c, lambda_ = parameters[:, 0:1], parameters[:, 1:2]
+    np.multiply(c / lambda_, prediction, out=out)
+    np.add(out, c ** 2, out=out)
+    np.sqrt(out, out=out)
+    np.subtract(out, c, out=out)
+
+
+def ORTB2_bids(prediction, ratio, parameters, out, work):
+    '''
+    term = (pCTR + sqrt(c**2 * lambda**2 + pCTR**2)) / (c * lambda)
+    bid = c * (term**(1 / 3) - term**(-1 / 3))
+    '''
+    c, lambda_ = parameters[:, 0:1], parameters[:, 1:2]
+    np.square(prediction, out=out)
+    np.add(out, c ** 2 * lambda_ ** 2, out=out)
+    np.sqrt(out, out=out)
+    np.add(out, prediction, out=out)
+    np.divide(out, c * lambda_, out=out)
+    np.cbrt(out, out=out)
+    np.reciprocal(out, out=work)
+    np.subtract(out, work, out=out)
+    np.multiply(c, out, out=out)
+
 
+def ORTBx_bids(prediction, ratio, parameters, out, work):
+    np.square(ratio, out=out)
+    np.multiply(out, parameters[:, 0:1], out=out)
+    np.add(out, parameters[:, 1:2], out=out)
+
+
+def ORTBy_bids(prediction, ratio, parameters, out, work):
+    np.square(ratio, out=out)
+    np.multiply(out, parameters[:, 0:1], out=out)
+    np.multiply(ratio, parameters[:, 1:2], out=work)
+    np.add(out, work, out=out)
+
+
+bid_functions = {}
+
+
+def register_bid_function(name, function, n_parameters):
+
+    '''
+    Adds a bid function (same signature as linear_bids) to the registry so that generate_bids and
+    strategy_evaluation accept its name as type.
+    '''
+
+    bid_functions[name] = {'function': function, 'n_parameters': n_parameters}
+
+
+for name, function, n_parameters in [('constant', constant_bids, 1), ('linear', linear_bids, 1),
+                                     ('square', square_bids, 1), ('exponential', exponential_bids, 1),
+                                     ('ORTB1', ORTB1_bids, 2), ('ORTB2', ORTB2_bids, 2),
+                                     ('ORTBx', ORTBx_bids, 2), ('ORTBy', ORTBy_bids, 2)]:
+    register_bid_function(name, function, n_parameters)
+
+
+# --- BIDS FOR A GRID OF PARAMETERS
+def bid_function_grid(prediction, parameters, type='linear', average_CTR=7.375623e-04, out=None, work=None):
+
+    '''
+    Bids of every parameter row (a scalar, a 1-d range or an n x k array) for every auction, shape
+    (parameters x auctions). Only the two output-sized buffers are allocated (or passed in to be reused).
+    '''
+
+    bid_function = bid_functions[type]
+    prediction = np.asarray(prediction, dtype=np.float64)
+    parameters = np.asarray(parameters, dtype=np.float64).reshape(-1, bid_function['n_parameters'])
+
+    if out is None:
+        out = np.empty((parameters.shape[0], prediction.shape[0]))
+
+    if work is None:
+        work = np.empty_like(out)
+
+    bid_function['function'](prediction, prediction / average_CTR, parameters, out, work)
+
+    return out
+
+
+@profiled()
+def evaluate_bid_grid(data, prediction, parameters, type='linear', budget=6250000, average_CTR=7.375623e-04,
+                      chunk_size=16):
+
+    '''
+    Impressions, clicks and ads auctioned for every parameter row, with the same budget rule as the strategy
+    functions above (file order). Parameter rows are processed in chunks that reuse the same buffers.
+    '''
+
+    payprice = np.asarray(data['payprice'], dtype=np.float64)
+    clicks = np.asarray(data['click']) == 1
+    parameters = np.asarray(parameters, dtype=np.float64).reshape(-1, bid_functions[type]['n_parameters'])
+
+    impressions = np.zeros(parameters.shape[0], dtype=np.int64)
+    clicks_won = np.zeros(parameters.shape[0], dtype=np.int64)
+    ads_auctioned = np.zeros(parameters.shape[0], dtype=np.int64)
+    out = np.empty((min(chunk_size, parameters.shape[0]), payprice.shape[0]))
+    work = np.empty_like(out)
+    won = np.empty(out.shape, dtype=bool)
+
+    for start in range(0, parameters.shape[0], chunk_size):
+
+        rows = slice(start, start + chunk_size)
+        size = len(parameters[rows])
+        bids = bid_function_grid(prediction, parameters[rows], type=type, average_CTR=average_CTR,
+                                 out=out[:size], work=work[:size])
+
+        # Spend only where won, then the budget rule of the strategy functions
+        np.less(payprice, bids, out=won[:size])
+        np.multiply(payprice, won[:size], out=work[:size])
+        np.cumsum(work[:size], axis=1, out=work[:size])
+        valid = work[:size] <= budget
+
+        impressions[rows] = np.count_nonzero(valid & won[:size], axis=1)
+        clicks_won[rows] = np.count_nonzero(valid & won[:size] & clicks, axis=1)
+        ads_auctioned[rows] = np.count_nonzero(work[:size] < budget, axis=1)
+
+    return impressions, clicks_won, ads_auctioned
+
+
+# --- CHECKS AGAINST THE STRATEGY FUNCTIONS
+def verify_bid_functions(data, prediction, budget=6250000, average_CTR=7.375623e-04):
+
+    '''
+    Compares evaluate_bid_grid with the strategy functions above on a few parameter values per type and returns
+    a table of both results (all rows should match).
+    '''
+
+    checks = [('constant', [50, 80, 120]), ('linear', [100, 200]), ('square', [150, 200]),
+              ('exponential', [30, 40]), ('ORTB1', [(10, 5e-7), (50, 2e-6)]), ('ORTB2', [(20, 1e-6), (80, 5e-6)]),
+              ('ORTBx', [(250, 0), (220, 30)]), ('ORTBy', [(250, -10), (280, 20)])]
+    output = []
+
+    for type, parameters in checks:
+
+        grid = np.column_stack(evaluate_bid_grid(data, prediction, parameters, type=type, budget=budget,
+                                                 average_CTR=average_CTR))
+
+        for parameter, result in zip(parameters, grid):
+
+            if type == 'constant':
+                reference = constant_bidding_strategy(data, parameter, budget=budget)
+
+            elif type[0:4] == 'ORTB':
+                reference = ORTB_strategy(data, prediction, type=type, c=parameter[0], b=parameter[1], budget=budget,
+                                          average_CTR=average_CTR)
+
+            else:
+                reference = parametrised_bidding_strategy(data, prediction, type=type, parameter=parameter,
+                                                          budget=budget, average_CTR=average_CTR)
+
+            output.append([type, parameter] + list(result) + list(reference) +
+                          [np.array_equal(result, np.array(reference, dtype=np.int64))])
+
+    return pd.DataFrame(output, columns=['type', 'parameter', 'impressions_grid', 'clicks_grid', 'auctioned_grid',
+                                         'impressions_reference', 'clicks_reference', 'auctioned_reference',
+                                         'match'])
+
+
+def benchmark_bid_functions(prediction, parameters, type='linear', average_CTR=7.375623e-04, repeats=5):
+
+    '''
+    Peak memory allocated (tracemalloc) and time per evaluation of the whole parameter range: one bid vector per
+    parameter from the strategy function of the same type (np.repeat temporaries), against one bid_function_grid
+    call with preallocated buffers.
+    '''
+
+    prediction = np.asarray(prediction, dtype=np.float64)
+    parameters = np.asarray(parameters, dtype=np.float64).reshape(-1, bid_functions[type]['n_parameters'])
+    size = prediction.shape[0]
+
+    def repeated():
+        for parameter in parameters:
+            if type == 'constant':
+                np.repeat(parameter[0], size)
+            elif type[0:4] == 'ORTB':
+                ORTB_bids(prediction, type, parameter[0], parameter[1], average_CTR)
+            else:
+                parametrised_bids(prediction, type, parameter[0], np.repeat(average_CTR, size))
+
+    out = np.empty((parameters.shape[0], size))
+    work = np.empty_like(out)
+    output = []
+
+    # Leave an outer trace (e.g. a peakmem benchmark) running
+    tracing = tracemalloc.is_tracing()
+
+    for name, function in [('np.repeat per parameter', repeated),
+                           ('bid_function_grid', lambda: bid_function_grid(prediction, parameters, type=type,
+                                                                           average_CTR=average_CTR,
+                                                                           out=out, work=work))]:
+
+        if tracing:
+            tracemalloc.reset_peak()
         else:
-            output['parameter_1'][i] = parameter[0]
-            output['parameter_2'][i] = parameter[1]
+            tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        start_time = time.time()
+
+        for repeat in range(repeats):
+            function()
+
+        elapsed = (time.time() - start_time) / repeats
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        if not tracing:
+            tracemalloc.stop()
+        output.append([name, elapsed, peak / 1e6])
+
+    return pd.DataFrame(output, columns=['method', 'seconds_per_evaluation', 'peak_MB_allocated'])
+
+
+# --- BID GENERATION (REGISTERED BID FUNCTIONS, WITHOUT THE BUDGET LOGIC)
+def generate_bids(data, prediction, type='linear', parameter=100, average_CTR=7.375623e-04, seed=None):
+    '''
+    Returns the bid vector of a strategy so that it can be replayed under pacing. parameter is a scalar for the
+    single parameter strategies and a pair ((lower, upper) or (c, b)) for the random and ORTB strategies; type is
+    'random' or any name in bid_functions.
+    '''
+
+    size = len(data)
+    parameter = np.atleast_1d(np.asarray(parameter, dtype=np.float64))
+
+    if average_CTR is None:
+        average_CTR = np.sum(data['click'] == 1) / size
+
+    if type == 'random':
+        bids = np.random.default_rng(seed).integers(parameter[0], parameter[1], size).astype(np.float64)
+
+    else:
+        bids = bid_function_grid(prediction, parameter, type=type, average_CTR=average_CTR)[0]
+
+    return bids
+
+
+# --------------------------------- PACING ---------------------------------------- #
+
+# --- PACING CONTROLLERS (ONE STATE ENTRY PER CAMPAIGN)
+class NoPacing(object):
+    '''
+    Bids every auction at the strategy's price until the budget runs out.
+    '''
+
+    def get_params(self):
+        # Constructor arguments only, not the run-time state set by reset and update
+        return {name: getattr(self, name) for name, parameter in inspect.signature(self.__init__).parameters.items()
+                if parameter.kind in [parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY]}
+
+    def reset(self, budgets, n_slots):
+        pass
+
+    def participation(self, campaign_rows, generator):
+        return np.ones(len(campaign_rows), dtype=bool)
+
+    def shade(self, bids, campaign_rows):
+        return bids
+
+    def update(self, spend, target_spend):
+        pass
+
+
+class ThrottlingPacing(NoPacing):
+    '''
+    Probabilistic throttling: each auction is entered with probability rate, and the rate is moved up or down
+    after every time slot according to how far the slot's spend was from its target.
+    '''
+
+    def __init__(self, initial_rate=1.0, gain=0.5, min_rate=0.01):
+        self.initial_rate = initial_rate
+        self.gain = gain
+        self.min_rate = min_rate
+
+    def reset(self, budgets, n_slots):
+        self.rate = np.full(len(budgets), self.initial_rate)
+
+    def participation(self, campaign_rows, generator):
+        return generator.random(len(campaign_rows)) < self.rate[campaign_rows]
+
+    def update(self, spend, target_spend):
+        error = (target_spend - spend) / np.maximum(target_spend, 1)
+        self.rate = np.clip(self.rate * (1 + self.gain * error), self.min_rate, 1.0)
+
+
+class PIDBidShading(NoPacing):
+    '''
+    Bid shading with a PID controller on the spend rate: bids are scaled by a multiplier which is raised when
+    the slot spent less than its target and lowered when it spent more.
+    '''
+
+    def __init__(self, kp=0.4, ki=0.05, kd=0.1, min_multiplier=0.1, max_multiplier=2.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.min_multiplier = min_multiplier
+        self.max_multiplier = max_multiplier
+
+    def reset(self, budgets, n_slots):
+        self.multiplier = np.ones(len(budgets))
+        self.integral = np.zeros(len(budgets))
+        self.last_error = np.zeros(len(budgets))
 
-        if type == 'constant':
+    def shade(self, bids, campaign_rows):
+        return bids * self.multiplier[campaign_rows]
 
-            output['impressions_won'][i], \
-            output['clicks_won'][i], \
-            output['ads_auctioned_for'][i] = \
-                constant_bidding_strategy(data, parameter, budget=budget)
+    def update(self, spend, target_spend):
+        error = (target_spend - spend) / np.maximum(target_spend, 1)
+        self.integral += error
+        derivative = error - self.last_error
+        self.last_error = error
+        self.multiplier = np.clip(1 + self.kp * error + self.ki * self.integral + self.kd * derivative,
+                                  self.min_multiplier, self.max_multiplier)
 
-        elif type == 'random':
 
-            impressions_won = []
-            clicks_won = []
-            ads_auctioned_for = []
+pacing_controllers = {'none': NoPacing, 'throttling': ThrottlingPacing, 'shading': PIDBidShading}
 
-            for run in range(0, repeated_runs):
 
-                impressions, clicks, ads_auctioned = random_bidding_strategy(data, parameter[0],
-                                                                             parameter[1], budget=budget)
-                impressions_won.append(impressions)
-                clicks_won.append(clicks)
-                ads_auctioned_for.append(ads_auctioned)
+# --- TIME-ORDERED REPLAY
+def time_slots(timestamps, start_weekday=None):
+    '''
+    Maps weekday/hour to an hour index counted from the start of the log. The log starts on the weekday of its
+    first row unless start_weekday is given.
+    '''
+
+    weekday = np.asarray(timestamps['weekday'])
+    hour = np.asarray(timestamps['hour'])
+
+    if start_weekday is None:
+        start_weekday = weekday[0]
+
+    return ((weekday - start_weekday) % 7) * 24 + hour
+
+
+def segmented_cumsum(values, segment_starts):
+    '''
+    Cumulative sum restarting at every segment start (values must already be sorted by segment).
+    '''
+
+    total = np.cumsum(values)
+    offsets = np.concatenate(([0], total[segment_starts[1:] - 1])) if len(segment_starts) else np.zeros(0)
+    lengths = np.diff(np.concatenate((segment_starts, [len(values)])))
+
+    return total - np.repeat(offsets, lengths)
+
+
+@profiled()
+def campaign_replay(data, bids, budgets, campaigns=None, timestamps=None, pacing=None, start_weekday=None,
+                    seed=500):
+    '''
+    Replays the auctions in time order with one budget per campaign (budgets is a scalar, or a dict/Series keyed by
+    the values in campaigns, e.g. the advertiser column). Without pacing the whole log is one vectorised pass:
+    rows are sorted by campaign and time and spend is a segmented cumulative sum. With pacing every hour is one
+    such pass and the controller compares each campaign's spend with a target proportional to its share of the
+    hour's traffic. A campaign stops at the first win that would overdraw its budget, and later auctions are not
+    counted as auctioned for.
+    '''
+
+    size = len(data)
 
-            output['impressions_won'][i] = np.mean(impressions_won)
-            output['clicks_won'][i] = np.mean(clicks_won)
-            output['ads_auctioned_for'][i] = np.mean(ads_auctioned_for)
+    if campaigns is None:
+        campaigns = np.zeros(size, dtype=np.int64)
 
-        elif type[0:4] == 'ORTB':
+    # Map campaign ids to budget positions
+    campaign_ids, campaign_index = np.unique(np.asarray(campaigns), return_inverse=True)
 
-            # Iterate over the parameter range and complete the table
-            output['impressions_won'][i], \
-            output['clicks_won'][i], \
-            output['ads_auctioned_for'][i] = \
-                ORTB_strategy(data, prediction, type=type, c=parameter[0], b=parameter[1], budget=budget,
-                              average_CTR=average_CTR)
+    if np.isscalar(budgets):
+        budget_vector = np.full(len(campaign_ids), float(budgets))
+
+    else:
+        budget_vector = np.array([budgets[campaign] for campaign in campaign_ids], dtype=np.float64)
+
+    if pacing is None:
+        pacing = NoPacing()
+
+    elif isinstance(pacing, str):
+        pacing = pacing_controllers[pacing]()
+
+    # Time slots (file order when there is no weekday/hour to go by)
+    if timestamps is None and 'weekday' in data:
+        timestamps = data
+
+    if timestamps is None:
+        slots = np.zeros(size, dtype=np.int64)
+
+    else:
+        slots = time_slots(timestamps, start_weekday=start_weekday)
+
+    # Sort by slot, then campaign, then file order; without a controller the slots need not be cut
+    paced = not type(pacing) is NoPacing
+    order = np.lexsort((np.arange(size), campaign_index, slots) if paced else (np.arange(size), slots,
+                                                                                  campaign_index))
+    slots = slots[order] if paced else np.zeros(size, dtype=np.int64)
+    campaign_rows = campaign_index[order]
+    payprice = np.asarray(data['payprice'], dtype=np.float64)[order]
+    clicks = np.asarray(data['click'])[order] == 1
+    bids = np.asarray(bids, dtype=np.float64)[order]
+    boundaries = np.flatnonzero(np.diff(slots)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [size]))
+
+    # Each campaign's spend target follows its own traffic
+    n_campaigns = len(campaign_ids)
+    campaign_traffic = np.bincount(campaign_index, minlength=n_campaigns)
+
+    generator = np.random.default_rng(seed)
+    pacing.reset(budget_vector, len(starts))
+    spend = np.zeros(n_campaigns)
+    impressions = np.zeros(n_campaigns, dtype=np.int64)
+    clicks_won = np.zeros(n_campaigns, dtype=np.int64)
+    ads_auctioned = np.zeros(n_campaigns, dtype=np.int64)
+    exhausted = np.zeros(n_campaigns, dtype=bool)
+
+    for start, end in zip(starts, ends):
+
+        rows = campaign_rows[start:end]
+        participating = pacing.participation(rows, generator) & ~exhausted[rows]
+        won = participating & (payprice[start:end] < pacing.shade(bids[start:end], rows))
+
+        # Segmented cumulative spend per campaign, cut at the first win that overdraws its budget
+        segment_starts = np.flatnonzero(np.diff(np.concatenate(([-1], rows))))
+        slot_spend = segmented_cumsum(payprice[start:end] * won, segment_starts)
+        overdrawn = slot_spend > (budget_vector - spend)[rows]
+        stopped = segmented_cumsum(overdrawn, segment_starts) > 0
+        active = participating & ~stopped
+        won &= ~stopped
+
+        slot_total = np.bincount(rows, weights=payprice[start:end] * won, minlength=n_campaigns)
+        impressions += np.bincount(rows, weights=won, minlength=n_campaigns).astype(np.int64)
+        clicks_won += np.bincount(rows, weights=won & clicks[start:end], minlength=n_campaigns).astype(np.int64)
+        ads_auctioned += np.bincount(rows, weights=active, minlength=n_campaigns).astype(np.int64)
+        spend += slot_total
+        exhausted |= np.bincount(rows, weights=overdrawn, minlength=n_campaigns) > 0
+
+        if exhausted.all():
+            break
+
+        target = budget_vector * np.bincount(rows, minlength=n_campaigns) / np.maximum(campaign_traffic, 1)
+        pacing.update(slot_total, target)
+
+    output = pd.DataFrame({'campaign': campaign_ids, 'budget': budget_vector, 'total_auctions': campaign_traffic,
+                           'ads_auctioned_for': ads_auctioned, 'impressions_won': impressions,
+                           'clicks_won': clicks_won, 'spend': spend})
+    output['CTR'] = output['clicks_won'] / output['impressions_won']
+    output['CPM'] = output['spend'] / output['impressions_won'] * 1000
+    output['CPC'] = output['spend'] / output['clicks_won']
+
+    return output
+
+
+def paced_replay(data, bids, budget=6250000, timestamps=None, pacing=None, start_weekday=None, seed=500):
+    '''
+    Single-budget replay, returns impressions, clicks, ads auctioned for and spend.
+    '''
+
+    output = campaign_replay(data, bids, budget, timestamps=timestamps, pacing=pacing, start_weekday=start_weekday,
+                             seed=seed)
+
+    return tuple(output.loc[0, ['impressions_won', 'clicks_won', 'ads_auctioned_for', 'spend']])
+
+
+# ------------------------------- BID LANDSCAPE ----------------------------------- #
+
+# --- WINNING PRICE DISTRIBUTION
+@profiled()
+def fit_bid_landscape(data, segment_columns=['slotvisibility', 'slotwidth', 'slotheight'], max_price=400,
+                      smoothing=100):
+
+    '''
+    Fits the winning (market) price distribution from payprice, one histogram per segment of segment_columns,
+    shrunk towards the global histogram with weight smoothing. Prices are integers, so for every integer k the
+    tables hold
+        win[s, k]  = P(payprice < k)                 (a bid b wins with probability win[s, ceil(b)])
+        cost[s, k] = E[payprice * 1(payprice < k)]   (expected second price paid per auction)
+    The last row of each table is the global distribution and is used for unseen segments.
+    '''
+
+    payprice = np.clip(np.asarray(data['payprice'], dtype=np.int64), 0, max_price)
+
+    if segment_columns:
+        segments = pd.MultiIndex.from_frame(data[segment_columns]).unique()
+        segment_index = segments.get_indexer(pd.MultiIndex.from_frame(data[segment_columns]))
+
+    else:
+        segments = pd.MultiIndex.from_tuples([()])
+        segment_index = np.zeros(len(payprice), dtype=np.int64)
+
+    # Histogram per segment in one bincount, global histogram appended as the last row
+    counts = np.bincount(segment_index * (max_price + 1) + payprice,
+                         minlength=len(segments) * (max_price + 1)).reshape(len(segments), max_price + 1)
+    counts = np.vstack((counts, counts.sum(axis=0)))
+    global_pmf = counts[-1] / counts[-1].sum()
+    pmf = (counts + smoothing * global_pmf) / (counts.sum(axis=1, keepdims=True) + smoothing)
+
+    # Lookup tables indexed by the (integer) bid
+    prices = np.arange(max_price + 1)
+    win = np.hstack((np.zeros((pmf.shape[0], 1)), np.cumsum(pmf, axis=1)))
+    cost = np.hstack((np.zeros((pmf.shape[0], 1)), np.cumsum(pmf * prices, axis=1)))
+
+    landscape = {'segment_columns': segment_columns, 'segments': segments, 'max_price': max_price,
+                 'counts': counts, 'pmf': pmf, 'win': win, 'cost': cost}
+
+    return landscape
+
+
+def landscape_segments(landscape, data):
+
+    '''
+    Row of the landscape tables for every auction in data (-1, the global row, for segments not seen in fitting).
+    '''
+
+    if not landscape['segment_columns']:
+        return np.full(len(data), -1)
+
+    return landscape['segments'].get_indexer(pd.MultiIndex.from_frame(data[landscape['segment_columns']]))
+
+
+def bid_index(landscape, bids):
+    return np.clip(np.ceil(np.asarray(bids, dtype=np.float64)), 0, landscape['max_price'] + 1).astype(np.int64)
+
+
+# --- O(1) QUERIES
+def win_probability(landscape, bids, segments=-1):
+    return landscape['win'][segments, bid_index(landscape, bids)]
+
+
+def expected_cost(landscape, bids, segments=-1):
+    return landscape['cost'][segments, bid_index(landscape, bids)]
+
+
+def expected_performance(landscape, bids, prediction, segments=-1):
+
+    '''
+    Expected impressions, clicks and spend of a bid vector, scored on the landscape instead of replaying the log.
+    '''
+
+    win = win_probability(landscape, bids, segments)
+
+    return np.sum(win), np.sum(win * np.asarray(prediction)), np.sum(expected_cost(landscape, bids, segments))
+
+
+# --- ORTB CALIBRATION
+def fit_ORTB_winning_function(landscape, segment=-1):
+
+    '''
+    Least squares fit of the ORTB winning function w(b) = b / (c + b) to the empirical win rate of a segment,
+    weighted by how often each price clears. Returns c.
+    '''
+
+    bids = np.arange(1, landscape['max_price'] + 2)
+    win = landscape['win'][segment, 1:]
+    weights = landscape['pmf'][segment]
+
+    result = minimize_scalar(lambda c: np.sum(weights * (bids / (c + bids) - win) ** 2),
+                             bounds=(1e-3, 10 * landscape['max_price']), method='bounded')
+
+    return result.x
+
+
+# --- LAGRANGIAN OPTIMAL BIDDING
+def lagrangian_bids(prediction, lambda_, type='linear', c=None):
+
+    '''
+    Budget-constrained optimal bids for a given Lagrange multiplier (scalar or one per auction):
+    linear (second price, any landscape): pCTR / lambda
+    ORTB1 (w(b) = b / (c + b)):          sqrt(c / lambda * pCTR + c**2) - c
+    '''
+
+    if type == 'linear':
+        return np.asarray(prediction) / lambda_
+
+    elif type == 'ORTB1':
+        return np.sqrt(c / lambda_ * np.asarray(prediction) + c ** 2) - c
+
+    else:
+        raise ValueError("Unknown bid type '%s' (linear or ORTB1)" % type)
+
+
+def expected_spend(landscape, prediction, lambda_, segments=-1, type='linear', c=None):
+    return np.sum(expected_cost(landscape, lagrangian_bids(prediction, lambda_, type=type, c=c), segments))
+
+
+@profiled()
+def optimal_lambda(landscape, prediction, budget, segments=-1, type='linear', c=None, campaigns=None,
+                   lower=1e-12, upper=1e2, max_iter=60, tolerance=1e-3):
+
+    '''
+    Solves expected_spend(lambda) = budget by bisection on log(lambda) (spend falls as lambda grows). With campaigns
+    (e.g. the advertiser column) budget is a dict keyed by campaign and a dict of multipliers is returned. If the
+    budget cannot be spent even at the lower bound, the lower bound is returned; if it is overspent even at the
+    upper bound, a message is printed and the upper bound is returned.
+    '''
+
+    if campaigns is not None:
+
+        campaigns = np.asarray(campaigns)
+        segments = np.broadcast_to(segments, campaigns.shape)
+        lambdas = {}
+
+        for campaign in np.unique(campaigns):
+
+            rows = campaigns == campaign
+            lambdas[campaign] = optimal_lambda(landscape, np.asarray(prediction)[rows], budget[campaign],
+                                               segments=segments[rows], type=type, c=c, lower=lower, upper=upper,
+                                               max_iter=max_iter, tolerance=tolerance)
+
+        return lambdas
+
+    log_lower, log_upper = np.log(lower), np.log(upper)
+
+    if expected_spend(landscape, prediction, lower, segments, type=type, c=c) <= budget:
+        return lower
+
+    upper_spend = expected_spend(landscape, prediction, upper, segments, type=type, c=c)
+    if upper_spend > budget:
+        print('Expected spend %.0f at the upper bound lambda = %g is still over the budget %.0f; returning the upper '
+              'bound.' % (upper_spend, upper, budget))
+        return upper
+
+    for iteration in range(max_iter):
+
+        log_lambda = (log_lower + log_upper) / 2
+        spend = expected_spend(landscape, prediction, np.exp(log_lambda), segments, type=type, c=c)
+
+        if abs(spend - budget) <= tolerance * budget:
+            break
+
+        if spend > budget:
+            log_lower = log_lambda
 
         else:
+            log_upper = log_lambda
+
+    return np.exp(log_lambda)
+
+
+# ------------------------------ MULTI-AGENT AUCTIONS ------------------------------ #
+
+# --- SECOND PRICE CLEARING
+def clear_auctions(bids, market_price=None):
+
+    '''
+    Clears every column of an N x M bid matrix (agents x auctions) under second price rules: the top bid wins if it
+    beats the market price (payprice of the rest of the market, strict like payprice < bid) and pays the larger of
+    the second highest agent bid and the market price. A zero bid means the agent does not take part.
+    '''
+
+    columns = np.arange(bids.shape[1])
+    winner = np.argmax(bids, axis=0)
+    highest = bids[winner, columns]
+
+    # Top-2 reduction per column
+    if bids.shape[0] > 1:
+        second = np.partition(bids, -2, axis=0)[-2]
+
+    else:
+        second = np.zeros(bids.shape[1])
+
+    if market_price is None:
+        market_price = np.zeros(bids.shape[1])
+
+    won = (highest > market_price) & (highest > 0)
+    price = np.maximum(second, market_price)
+
+    return winner, won, price
+
+
+def multi_agent_auction(bids, budgets, clicks, market_price=None):
+
+    '''
+    Runs N budgeted agents against each other over the log in order. All auctions are cleared at once; then the
+    earliest auction at which an agent's cumulative spend would overdraw its budget is found, the agent is removed
+    from that auction on and only the remaining auctions are cleared again. That repeats at most once per agent,
+    so the outcome is exactly that of a sequential auction.
+    '''
+
+    bids = np.array(bids, dtype=np.float64)
+    n_agents, size = bids.shape
+    budgets = np.broadcast_to(np.asarray(budgets, dtype=np.float64), (n_agents,))
+    clicks = np.asarray(clicks) == 1
+    market_price = np.zeros(size) if market_price is None else np.asarray(market_price, dtype=np.float64)
+
+    spend = np.zeros(n_agents)
+    impressions = np.zeros(n_agents, dtype=np.int64)
+    clicks_won = np.zeros(n_agents, dtype=np.int64)
+    auctions_entered = np.zeros(n_agents, dtype=np.int64)
+    exhausted_at = np.full(n_agents, size)
+    start = 0
+
+    while start < size:
+
+        winner, won, price = clear_auctions(bids[:, start:], market_price[start:])
+
+        # Cumulative spend of every agent over the remaining auctions
+        agent_spend = np.zeros((n_agents, size - start))
+        agent_spend[winner[won], np.flatnonzero(won)] = price[won]
+        cumulative_spend = np.cumsum(agent_spend, axis=1) + spend[:, None]
+        overdrawn = cumulative_spend > budgets[:, None]
+        first_overdrawn = np.where(overdrawn.any(axis=1), np.argmax(overdrawn, axis=1), size - start)
+        stop = first_overdrawn.min()
+
+        # Auctions before the first exhaustion are final
+        final = won[:stop]
+        impressions += np.bincount(winner[:stop][final], minlength=n_agents)
+        clicks_won += np.bincount(winner[:stop][final & clicks[start:start + stop]], minlength=n_agents)
+        auctions_entered += np.count_nonzero(bids[:, start:start + stop] > 0, axis=1)
+        spend = cumulative_spend[:, stop - 1] if stop else spend
+
+        if stop == size - start:
+            break
+
+        # Remove the agent that runs out of budget and clear the rest again
+        agent = np.argmin(first_overdrawn)
+        bids[agent, start + stop:] = 0
+        exhausted_at[agent] = start + stop
+        start += stop
+
+    output = pd.DataFrame({'agent': np.arange(n_agents), 'budget': budgets, 'auctions_entered': auctions_entered,
+                           'impressions_won': impressions, 'clicks_won': clicks_won, 'spend': spend,
+                           'exhausted_at': exhausted_at})
+    output['CTR'] = output['clicks_won'] / output['impressions_won']
+    output['CPM'] = output['spend'] / output['impressions_won'] * 1000
+    output['CPC'] = output['spend'] / output['clicks_won']
+
+    return output
 
-            # Iterate over the parameter range and complete the table
-            output['impressions_won'][i], \
-            output['clicks_won'][i], \
-            output['ads_auctioned_for'][i] = \
-                parametrised_bidding_strategy(data, prediction, type=type, parameter=parameter, budget=budget,
-                                              average_CTR = average_CTR)
-
-    # Fill in last columns
-    output['type'] = type
-    output['budget'] = budget
-    output['total_auctions'] = prediction.shape[0]
+
+@profiled()
+def multi_agent_simulation(data, prediction, agents, market_price='yes', average_CTR=7.375623e-04):
+
+    '''
+    agents is a list of dicts such as {'type': 'linear', 'parameter': 120, 'budget': 6250000}, optionally with
+    its own 'prediction' (pCTR vector) and 'name'. The bid matrix is built with generate_bids; with
+    market_price='yes' the historical payprice competes as the rest of the market.
+    '''
+
+    start_time = time.time()
+
+    bids = np.vstack([generate_bids(data, agent.get('prediction', prediction), type=agent['type'],
+                                    parameter=agent['parameter'], average_CTR=average_CTR, seed=agent.get('seed'))
+                      for agent in agents])
+
+    output = multi_agent_auction(bids, [agent['budget'] for agent in agents], data['click'],
+                                 market_price=data['payprice'] if market_price == 'yes' else None)
+    output.insert(1, 'name', [agent.get('name', agent['type']) for agent in agents])
+    output.insert(2, 'parameter', [agent['parameter'] for agent in agents])
+
+    print("Multi-agent auction of %d agents over %d impressions finished in %.2f seconds."
+          % (len(agents), len(data), (time.time() - start_time)))
+
+    return output
+
+
+# -------------------------------- RESULTS STORE ---------------------------------- #
+
+# --- SQLITE STORE OF EVALUATED PARAMETER VALUES
+def dataset_hash(*arrays):
+
+    '''
+    SHA-1 of the raw bytes of the arrays (e.g. payprice, click and the pCTR vector).
+    '''
+
+    digest = hashlib.sha1()
+
+    for array in arrays:
+        digest.update(np.ascontiguousarray(np.asarray(array)).tobytes())
+
+    return digest.hexdigest()
+
+
+def results_store_key(data, prediction, type, budget=6250000, average_CTR=7.375623e-04, pacing=None, timestamps=None,
+                      repeated_runs=1, seed=500):
+
+    '''
+    Strategy, dataset hash and the settings that change the results of a parameter value.
+    '''
+
+    arrays = [data['payprice'], data['click'], prediction]
+
+    if timestamps is not None:
+        arrays += [timestamps['weekday'], timestamps['hour']]
+
+    settings = {'budget': budget, 'average_CTR': average_CTR, 'repeated_runs': repeated_runs, 'seed': seed,
+                'pacing': pacing if pacing is None or isinstance(pacing, str) else
+                [pacing.__class__.__name__, sorted(pacing.get_params().items())]}
+
+    return type, dataset_hash(*arrays), json.dumps(settings, sort_keys=True, default=str)
+
+
+def parameter_key(parameter):
+    return json.dumps([float(value) for value in np.atleast_1d(parameter)])
+
+
+def open_results_store(file_name):
+
+    connection = sqlite3.connect(file_name)
+    connection.execute('CREATE TABLE IF NOT EXISTS strategy_results (type TEXT, dataset TEXT, settings TEXT, '
+                       'parameters TEXT, ads_auctioned_for REAL, impressions_won REAL, clicks_won REAL, spend REAL, '
+                       'ads_auctioned_for_ci REAL, impressions_won_ci REAL, clicks_won_ci REAL, CTR_ci REAL, '
+                       'PRIMARY KEY (type, dataset, settings, parameters))')
+
+    return connection
+
+
+def load_strategy_results(file_name, store_key):
+
+    '''
+    Stored results for a strategy/dataset/settings key as {parameter_key: (results, intervals)}.
+    '''
+
+    connection = open_results_store(file_name)
+    rows = connection.execute('SELECT parameters, ads_auctioned_for, impressions_won, clicks_won, spend, '
+                              'ads_auctioned_for_ci, impressions_won_ci, clicks_won_ci, CTR_ci FROM strategy_results '
+                              'WHERE type = ? AND dataset = ? AND settings = ?', store_key).fetchall()
+    connection.close()
+
+    return {row[0]: (np.array(row[1:5], dtype=np.float64), np.array(row[5:], dtype=np.float64)) for row in rows}
+
+
+def save_strategy_results(file_name, store_key, parameters, results, intervals):
+
+    # NaN is stored as NULL and read back as NaN
+    rows = [store_key + (parameter_key(parameter),) +
+            tuple(None if np.isnan(value) else float(value) for value in np.concatenate((result, interval)))
+            for parameter, result, interval in zip(parameters, results, intervals)]
+
+    connection = open_results_store(file_name)
+    connection.executemany('INSERT OR REPLACE INTO strategy_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
+    connection.close()
+
+
+# --- Evaluate A Set Of Parameter Values (In This Process Or A Worker)
+def evaluate_parameters(data, prediction, parameters, type='linear', budget=6250000, average_CTR=7.375623e-04,
+                        pacing=None, timestamps=None, repeated_runs=1, seed=500):
+
+    '''
+    Typed results of strategy_evaluation for the rows of parameters: ads auctioned for, impressions, clicks and
+    spend, and the confidence interval half-widths of random bidding.
+    '''
+
+    results = np.full((parameters.shape[0], 4), np.nan)
+    intervals = np.full((parameters.shape[0], 4), np.nan)
+
+    if pacing is not None:
+
+        for i, parameter in enumerate(parameters):
+
+            print(i, *parameter)
+
+            # Replay in time order under the pacing controller (random bids averaged over the repeated runs)
+            runs = repeated_runs if type == 'random' else 1
+            replays = [paced_replay(data, generate_bids(data, prediction, type=type, parameter=parameter,
+                                                        average_CTR=average_CTR, seed=run),
+                                    budget=budget, timestamps=timestamps, pacing=pacing, seed=run)
+                       for run in range(runs)]
+            impressions, clicks, ads_auctioned, spend = np.mean(replays, axis=0)
+            results[i] = ads_auctioned, impressions, clicks, spend
+
+    elif type == 'random':
+
+        # Random bidding runs as one seeded Monte Carlo batch with common random numbers
+        impressions, clicks, ads_auctioned, random_intervals = \
+            random_bidding_monte_carlo(data, parameters, repeated_runs=repeated_runs, budget=budget, seed=seed)
+        results[:, :3] = np.column_stack((ads_auctioned, impressions, clicks))
+        intervals[:] = random_intervals[['ads_auctioned_for_ci', 'impressions_won_ci', 'clicks_won_ci',
+                                         'CTR_ci']].values
+
+    else:
+
+        # Deterministic strategies are evaluated over the whole parameter grid in one pass
+        impressions, clicks, ads_auctioned = evaluate_bid_grid(data, prediction, parameters, type=type,
+                                                               budget=budget, average_CTR=average_CTR)
+        results[:, :3] = np.column_stack((ads_auctioned, impressions, clicks))
+
+    return results, intervals
+
+
+def evaluate_shared_parameters(handle, parameters, arguments):
+
+    '''
+    Worker side of strategy_evaluation(n_jobs=...): attaches to the shared payprice, click, prediction (and
+    timestamp) arrays instead of receiving the data frame.
+    '''
+
+    arrays = attach_arrays(handle)
+    data = pd.DataFrame({'payprice': arrays['payprice'], 'click': arrays['click']}, copy=False)
+    timestamps = pd.DataFrame({'weekday': arrays['weekday'], 'hour': arrays['hour']}, copy=False) \
+        if 'weekday' in arrays else None
+
+    return evaluate_parameters(data, arrays['prediction'], parameters, timestamps=timestamps, **arguments)
+
+
+def parallel_evaluate_parameters(data, prediction, parameters, n_jobs=-1, timestamps=None, **arguments):
+
+    '''
+    evaluate_parameters split over n_jobs worker processes (-1 for all cores) that share one memory-mapped copy of
+    the columns they need. Random bidding matches the serial results because every worker draws the same common
+    random numbers.
+    '''
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+    if timestamps is None and arguments.get('pacing') is not None and 'weekday' in data:
+        timestamps = data
+    shared = {'payprice': data['payprice'], 'click': data['click'], 'prediction': np.asarray(prediction)}
+    if timestamps is not None:
+        shared.update({'weekday': timestamps['weekday'], 'hour': timestamps['hour']})
+
+    handle = share_arrays(shared)
+    chunks = [chunk for chunk in np.array_split(np.arange(parameters.shape[0]), n_jobs) if len(chunk)]
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            outputs = list(pool.map(evaluate_shared_parameters, repeat(handle), [parameters[chunk] for chunk in chunks],
+                                    repeat(arguments)))
+    finally:
+        release_arrays(handle)
+
+    return np.concatenate([results for results, _ in outputs]), np.concatenate([intervals for _, intervals in outputs])
+
+
+# --- Evaluate Strategies Per Campaign
+@profiled()
+def campaign_evaluation(data, prediction, parameter_range, type='linear', budgets=6250000, campaigns=None,
+                        pacing=None, timestamps=None, repeated_runs=1, average_CTR=7.375623e-04, start_time=None):
+
+    '''
+    All campaigns are replayed together for every parameter value, one row per parameter and campaign.
+    '''
+
+    if start_time is None:
+        start_time = time.time()
+
+    output = []
+
+    for i, parameter in zip(range(len(parameter_range)), parameter_range):
+
+        print(i, parameter)
+
+        # Random bids are averaged over the repeated runs
+        runs = repeated_runs if type == 'random' else 1
+        results = pd.concat([campaign_replay(data, generate_bids(data, prediction, type=type, parameter=parameter,
+                                                                 average_CTR=average_CTR, seed=run),
+                                             budgets, campaigns=campaigns, timestamps=timestamps, pacing=pacing,
+                                             seed=run)
+                             for run in range(runs)])
+        result = results.groupby('campaign', as_index=False)[['budget', 'total_auctions', 'ads_auctioned_for',
+                                                              'impressions_won', 'clicks_won', 'spend']].mean()
+
+        parameter = np.atleast_1d(parameter)
+        result.insert(0, 'parameter_1', parameter[0])
+        result.insert(1, 'parameter_2', parameter[1] if parameter.size > 1 else np.nan)
+        output.append(result)
+
+    output = pd.concat(output, ignore_index=True)
+    output.insert(0, 'type', type)
+    output['CTR'] = output['clicks_won'] / output['impressions_won']
+    output['CPM'] = output['spend'] / output['impressions_won'] * 1000
+    output['CPC'] = output['spend'] / output['clicks_won']
+
+    print("Campaign evaluation for %s type model finished in %.2f seconds." % (type, (time.time() - start_time)))
+
+    return output
+
+
+# --- Evaluate Strategies Using Different Parameter Combinations
+@profiled()
+def strategy_evaluation(data, prediction, parameter_range, type = 'linear',  budget = 6250000,
+                        only_best = 'no', to_plot = 'yes', plot_3d = 'no', repeated_runs = 1,
+                        average_CTR = 7.375623e-04, to_save='no', file_name='bidding_strategy.pdf',
+                        pacing=None, timestamps=None, campaigns=None, seed=500, results_store=None, n_jobs=None):
+
+    '''
+    With pacing set (a name from pacing_controllers or a controller instance) every strategy is evaluated with the
+    time-ordered replay; timestamps holds the weekday/hour columns when data no longer has them (e.g. one-hot).
+    With campaigns set (e.g. the raw advertiser column) budget may be a dict of per-campaign budgets and the output
+    has one row per parameter and campaign (no plots are drawn). Random bidding (without pacing) also gets
+    confidence interval half-widths over the repeated runs. With results_store (an SQLite file name) parameter
+    values already evaluated on the same data and settings are read back instead of being run again. With n_jobs
+    the parameter values are split over worker processes that share the data through memory-mapped arrays. With
+    to_save='yes' the plot is queued for results/file_name (see E_Pipeline_Utilities.render_plots).
+    '''
+
+    # Time it
+    start_time = time.time()
+
+    if campaigns is not None:
+        return campaign_evaluation(data, prediction, parameter_range, type=type, budgets=budget,
+                                   campaigns=campaigns, pacing=pacing, timestamps=timestamps,
+                                   repeated_runs=repeated_runs, average_CTR=average_CTR, start_time=start_time)
+
+    # Typed result arrays: ads auctioned for, impressions, clicks and spend per parameter row
+    parameters = np.asarray(parameter_range, dtype=np.float64).reshape(len(parameter_range), -1)
+    results = np.full((parameters.shape[0], 4), np.nan)
+    intervals = np.full((parameters.shape[0], 4), np.nan)
+
+    # Read back the parameter values that are already in the results store
+    if results_store is not None:
+        store_key = results_store_key(data, prediction, type, budget=budget, average_CTR=average_CTR, pacing=pacing,
+                                      timestamps=timestamps, repeated_runs=repeated_runs, seed=seed)
+        stored = load_strategy_results(results_store, store_key)
+
+        for i, parameter in enumerate(parameters):
+            if parameter_key(parameter) in stored:
+                results[i], intervals[i] = stored[parameter_key(parameter)]
+
+    to_run = np.flatnonzero(np.isnan(results[:, 1]))
+    print("Evaluating %d of %d parameter values for %s type model." % (len(to_run), parameters.shape[0], type))
+
+    arguments = {'type': type, 'budget': budget, 'average_CTR': average_CTR, 'pacing': pacing,
+                 'repeated_runs': repeated_runs, 'seed': seed}
+
+    if len(to_run) > 1 and n_jobs not in [None, 1]:
+        results[to_run], intervals[to_run] = parallel_evaluate_parameters(data, prediction, parameters[to_run],
+                                                                          n_jobs=n_jobs, timestamps=timestamps,
+                                                                          **arguments)
+
+    elif len(to_run):
+        results[to_run], intervals[to_run] = evaluate_parameters(data, prediction, parameters[to_run],
+                                                                 timestamps=timestamps, **arguments)
+
+    if results_store is not None and len(to_run):
+        save_strategy_results(results_store, store_key, parameters[to_run], results[to_run], intervals[to_run])
+
+    # Assemble the typed output
+    output = pd.DataFrame({'type': type,
+                           'budget': budget,
+                           'parameter_1': parameters[:, 0],
+                           'parameter_2': parameters[:, 1] if parameters.shape[1] > 1 else np.nan,
+                           'total_auctions': prediction.shape[0],
+                           'ads_auctioned_for': results[:, 0],
+                           'impressions_won': results[:, 1],
+                           'clicks_won': results[:, 2]})
     output['CTR'] = output['clicks_won']/ output['impressions_won']
     output['CPM'] = output['budget']/ output['impressions_won'] * 1000
     output['CPC'] = output['budget']/ output['clicks_won']
+    output['spend'] = results[:, 3]
 
-    print("Evaluation for %s type model finished in %.2f seconds." % (type, (time.time() - start_time)))
+    if pacing is not None:
+        output['CPM'] = output['spend'] / output['impressions_won'] * 1000
+        output['CPC'] = output['spend'] / output['clicks_won']
 
-    if to_plot == 'yes':
-
-        if plot_3d == 'yes':
-
-            # Get the grid for clicks
-            x1_clicks = np.linspace(output['parameter_1'].min(), output['parameter_1'].max(),
-                             len(output['parameter_1'].unique()))
-            y1_clicks = np.linspace(output['parameter_2'].min(), output['parameter_2'].max(),
-                             len(output['parameter_2'].unique()))
-            x2_clicks, y2_clicks = np.meshgrid(x1_clicks, y1_clicks)
-            z2_clicks = griddata((output['parameter_1'], output['parameter_2']), output['clicks_won'], (x2_clicks, y2_clicks),
-                          method='linear')
-
-            # Get the grid for CTR
-            x1_CTR = np.linspace(output['parameter_1'].min(), output['parameter_1'].max(),
-                             len(output['parameter_1'].unique()))
-            y1_CTR = np.linspace(output['parameter_2'].min(), output['parameter_2'].max(),
-                             len(output['parameter_2'].unique()))
-            x2_CTR, y2_CTR = np.meshgrid(x1_CTR, y1_CTR)
-            z2_CTR = griddata((output['parameter_1'], output['parameter_2']), output['CTR'], (x2_CTR, y2_CTR),
-                          method='linear')
-
-            # Set the parameters for plotting
-            plt.style.use("seaborn-whitegrid")
-            params = {'legend.fontsize': '8',
-                      'figure.figsize': (20,10),
-                      'axes.labelsize': '8',
-                      'axes.titlesize': '12',
-                      'xtick.labelsize': '6',
-                      'ytick.labelsize': '6'}
-
-            plt.rcParams.update(params)
-            plot_title = "Performance Evaluation of %s Model"%(type)
-
-            # Plot the first subplot
-            fig = plt.figure(figsize=(3.3*1.2, 2.2*1.2*2))
-            ax = fig.add_subplot(2, 1, 1, projection='3d')
-            surf = ax.plot_surface(x2_clicks, y2_clicks, z2_clicks, rstride=1, cstride=1, cmap=cm.Blues,
-                                   linewidth=0.01, antialiased=False, edgecolors='grey', alpha=0.8)
-
-            tmp_planes = ax.zaxis._PLANES
-            ax.zaxis._PLANES = (tmp_planes[2], tmp_planes[3],
-                                tmp_planes[0], tmp_planes[1],
-                                tmp_planes[4], tmp_planes[5])
-            view_1 = (25, -135)
-            view_2 = (25, -45)
-            init_view = view_2
-            ax.view_init(*init_view)
-
-            ax.set_xlabel('Parameter 1', fontsize = 6)
-            ax.set_ylabel('Parameter 2', fontsize = 6)
-            ax.zaxis.set_rotate_label(False)
-            ax.set_zlabel('Clicks', fontsize = 6, rotation = 90)
-            plt.tick_params(axis='both', which='major', labelsize=6)
-            plt.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
-            ax.yaxis.major.formatter._useMathText = True
-            fig.colorbar(surf, shrink=0.5, aspect=10)
-            plt.title('Clicks', fontsize = 10)
-
-            # Plot the second subplot
-            ax = fig.add_subplot(2, 1, 2, projection='3d')
-            surf = ax.plot_surface(x2_CTR, y2_CTR, z2_CTR, rstride=1, cstride=1, cmap=cm.Reds,
-                                   linewidth=0.01, antialiased=False, edgecolors='grey', alpha=0.8)
-
-            tmp_planes = ax.zaxis._PLANES
-            ax.zaxis._PLANES = (tmp_planes[2], tmp_planes[3],
-                                tmp_planes[0], tmp_planes[1],
-                                tmp_planes[4], tmp_planes[5])
-            view_1 = (25, -135)
-            view_2 = (25, -45)
-            init_view = view_2
-            ax.view_init(*init_view)
-
-            ax.set_xlabel('Parameter 1', fontsize = 6)
-            ax.set_ylabel('Parameter 2', fontsize = 6)
-            ax.zaxis.set_rotate_label(False)
-            ax.set_zlabel('CTR', fontsize = 6, rotation = 90)
-            plt.tick_params(axis='both', which='major', labelsize=6)
-            plt.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
-            ax.yaxis.major.formatter._useMathText = True
-            fig.colorbar(surf, shrink=0.5, aspect=10)
-            plt.title('CTR', fontsize = 10)
-            plt.subplots_adjust(top=0.94, bottom=0.05, hspace=0.20)
-            plt.suptitle(plot_title, fontsize = 10)
+    elif type == 'random':
+        output = pd.concat([output, pd.DataFrame(intervals, columns=['ads_auctioned_for_ci', 'impressions_won_ci',
+                                                                     'clicks_won_ci', 'CTR_ci'])], axis=1)
 
-        else:
+    print("Evaluation for %s type model finished in %.2f seconds." % (type, (time.time() - start_time)))
+
+    if to_plot == 'yes' and to_save == 'yes':
 
-            # Set title and style
-            # plot_title = "Performance evaluation of %s model"%(type)
-            plot_title = "Performance of Linear Bidding Strategy"
-            plt.style.use("seaborn-darkgrid")
-
-            # Plot bidding performance
-            fig, ax1 = plt.subplots()
-            ax1.plot(output.parameter_1, output.clicks_won, marker='o', markersize =1, color = 'royalblue', label='Clicks')
-            ax1.set_xlabel('Model Parameter', fontsize = 8)
-            ax1.set_ylabel('Clicks Won', color='royalblue', fontsize = 8)
-            ax1.set_title(plot_title, fontsize=10)
-            ax1.ticklabel_format(fontsize=6)
-            ax1.vlines(x=output.parameter_1[output.clicks_won.argmax()], ymin=0,
-                       ymax=output.clicks_won[output.clicks_won.argmax()], linewidth=1, color='royalblue', linestyle='--',
-                       label='Parameter with Max Clicks')
-            ax1.hlines(xmin=output.parameter_1[output.parameter_1.argmin()], xmax=output.parameter_1[output.clicks_won.argmax()],
-                       y=output.clicks_won[output.clicks_won.argmax()], linewidth=1, color='royalblue', linestyle='--',
-                       label='Parameter with Max Clicks')
-            ax1.set_axisbelow(True) # Push gridlines back
-            ax1.tick_params(axis='x', labelsize=6)
-            ax1.tick_params(axis='y', labelsize=6)
-
-
-            ax2 = ax1.twinx()
-            ax2.ticklabel_format(style='sci', axis='y', scilimits=(0,0), fontsize=6)
-            ax2.yaxis.offsetText.set_fontsize(6)
-            ax2.tick_params(axis='y', labelsize=8)
-            # ax2.yaxis.set_major_formatter(mtick.ScalarFormatter(useMathText=True))
-            ax2.plot(output.parameter_1, output.CTR, marker='s', markersize =1, color='darkred', label='CTR')
-            ax2.set_ylabel('CTR', color='darkred', fontsize = 8)
-            ax2.set_axisbelow(True)
-            ax2.grid(None)
-
-            # ax2.vlines(x=output.parameter_1[output.CTR.argmax()], ymin=0,
-            #            ymax=output.CTR[output.CTR.argmax()], linewidth=1, color='darkred', linestyle='--',
-            #            label='Parameter with Max CTR')
-            # ax2.hlines(xmin=output.parameter_1[output.parameter_1.argmin()], xmax=output.parameter_1[output.CTR.argmax()],
-            #            y=output.CTR[output.CTR.argmax()], linewidth=1, color='darkred', linestyle='--',
-            #            label='Parameter with Max CTR')
-
-            lines = ax1.get_lines() + ax2.get_lines()
-            ax1.legend(lines, [line.get_label() for line in lines], loc='top right', frameon=True)
-
-        if to_save =='yes':
-
-            fig.set_size_inches(3.3*1.2, 2.2*1.2)
-            fig.savefig(os.getcwd() + '/results/' + file_name, dpi=300)
-
-        plt.show()
+        # Drawn later by render_plots
+        defer_plot('strategy_evaluation', file_name, output=output, type=type, plot_3d=plot_3d, small=to_save)
 
     return output
 
@@ -0,0 +1,745 @@
+"""
+Project:
+    COMPGW02/M041 Web Economics Coursework Project
+
+Description:
+    In this assignment, we are required to work on an online advertising problem. We will help advertisers to form
+    a bidding strategy in order to place their ads online in a realtime bidding system. We are required to train a
+    bidding strategy based on a provided advertising impression training set. This project aims to help us understand
+    some basic concepts and write a computer program in real-time bidding based display advertising. As we will be
+    evaluated both as a group as well as individually, part of the assignment is to train a model of our choice
+    independently. The performance of the model trained by the team, which is either a combination of the
+    individually developed models or the best performing individually-developed model, will be (mainly) evaluated
+    on the Click-through Rate achieved on a provided test set.
+
+Authors:
+  Sven Sabas
+
+Date:
+  22/02/2018
+"""
+
+# ------------------------------ IMPORT LIBRARIES --------------------------------- #
+
+import os
+import sys
+import time
+import json
+import hashlib
+import platform
+import subprocess
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import matplotlib.pyplot as plt
+import matplotlib.cm as cm
+from mpl_toolkits.mplot3d import Axes3D
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from functools import wraps
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+
+# ----------------------------- DEFERRED PLOTTING --------------------------------- #
+
+# Figures queued by the evaluation functions; nothing is drawn until render_plots is called
+deferred_plots = []
+
+
+def defer_plot(plot, file_name, **arguments):
+    '''
+    Queues a figure for render_plots. plot is a name in plot_functions and arguments are its (data) arguments.
+    '''
+
+    deferred_plots.append({'plot': plot, 'file_name': file_name, 'arguments': arguments})
+
+
+def use_headless_backend():
+    plt.switch_backend('Agg')
+
+
+def render_plot(job, results_dir):
+
+    figure = plot_functions[job['plot']](**job['arguments'])
+    file_path = os.path.join(results_dir, job['file_name'])
+    figure.savefig(file_path, dpi=300)
+    plt.close(figure)
+
+    return file_path
+
+
+def render_plots(jobs=None, results_dir=None, n_jobs=None):
+
+    '''
+    Renders the queued figures (or the given jobs) to PDFs in results/ on the Agg backend, in a pool of worker
+    processes. Returns the written file paths.
+    '''
+
+    if jobs is None:
+        jobs = list(deferred_plots)
+        del deferred_plots[:]
+
+    # Two jobs writing one file would race in the pool
+    file_names = pd.Series([job['file_name'] for job in jobs])
+    if file_names.duplicated().any():
+        raise ValueError('Several figures are queued for %s' % ', '.join(file_names[file_names.duplicated()].unique()))
+
+    if results_dir is None:
+        results_dir = os.getcwd() + '/results/'
+
+    if n_jobs == 1:
+        use_headless_backend()
+        return [render_plot(job, results_dir) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=use_headless_backend) as pool:
+        file_paths = list(pool.map(render_plot, jobs, repeat(results_dir)))
+
+    print('Rendered %d figures to %s.' % (len(file_paths), results_dir))
+
+    return file_paths
+
+
+# ------------------------------- INSTRUMENTATION --------------------------------- #
+
+# Spans finished during this run (in order of completion) and the spans currently open
+profile_records = []
+open_spans = []
+profile_run = {'run_id': time.strftime('%Y%m%d_%H%M%S'), 'started': time.time(),
+               'perf_counter': time.perf_counter()}
+
+
+def peak_rss_mb():
+
+    # Peak resident set size of this process so far (ru_maxrss is in kB on Linux and in bytes on macOS)
+    if resource is None:
+        return np.nan
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss / 1024.0 ** 2 if sys.platform == 'darwin' else peak_rss / 1024.0
+
+
+def array_nbytes(value):
+    '''
+    Bytes held by the arrays in value (numpy arrays, sparse matrices, pandas objects and tuples/lists/dicts of
+    them). Used to record the size of what a profiled function returns.
+    '''
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.Index):
+        return value.memory_usage()
+    if hasattr(value, 'memory_usage'):
+        memory_usage = value.memory_usage(index=True, deep=False)
+        return int(np.sum(memory_usage))
+    if hasattr(value, 'indptr'):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(array_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(array_nbytes(item) for item in value.values())
+
+    return 0
+
+
+def start_profiling(trace_allocations='no', run_id=None):
+    '''
+    Starts a new profile. With trace_allocations='yes' tracemalloc also records the peak and net Python/numpy
+    allocations of every span (at a noticeable cost in speed, so it is off by default).
+    '''
+
+    del profile_records[:]
+    profile_run.update({'run_id': run_id or time.strftime('%Y%m%d_%H%M%S'), 'started': time.time(),
+                        'perf_counter': time.perf_counter()})
+
+    if trace_allocations == 'yes' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextmanager
+def profile_span(name, **details):
+    '''
+    Records the wall time, CPU time, peak RSS and (when tracemalloc is tracing) the peak and net allocations
+    of the enclosed block. details are stored with the record (e.g. rows=len(data)).
+    '''
+
+    tracing = tracemalloc.is_tracing()
+    span = {'name': name, 'parent': open_spans[-1]['name'] if open_spans else '', 'depth': len(open_spans),
+            'allocated_peak': 0, 'allocated_start': 0}
+
+    if tracing:
+        # Fold the peak so far into the enclosing span before resetting it for this one
+        current, peak = tracemalloc.get_traced_memory()
+        if open_spans:
+            open_spans[-1]['allocated_peak'] = max(open_spans[-1]['allocated_peak'], peak)
+        tracemalloc.reset_peak()
+        span['allocated_start'] = span['allocated_peak'] = current
+
+    open_spans.append(span)
+    rss_start = peak_rss_mb()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    try:
+        yield span
+
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        open_spans.pop()
+        peak_rss = peak_rss_mb()
+
+        record = {'name': name, 'parent': span['parent'], 'depth': span['depth'],
+                  'start': wall_start - profile_run['perf_counter'], 'wall_time': wall_time, 'cpu_time': cpu_time,
+                  'peak_rss_mb': peak_rss, 'rss_growth_mb': peak_rss - rss_start,
+                  'allocated_peak_mb': np.nan, 'allocated_net_mb': np.nan,
+                  'output_mb': span.get('output_bytes', 0) / 1024.0 ** 2}
+
+        if tracing and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            span['allocated_peak'] = max(span['allocated_peak'], peak)
+            record['allocated_peak_mb'] = (span['allocated_peak'] - span['allocated_start']) / 1024.0 ** 2
+            record['allocated_net_mb'] = (current - span['allocated_start']) / 1024.0 ** 2
+            if open_spans:
+                open_spans[-1]['allocated_peak'] = max(open_spans[-1]['allocated_peak'], span['allocated_peak'])
+
+        record.update(details)
+        profile_records.append(record)
+
+
+def profiled(name=None):
+    '''
+    Decorator version of profile_span; the span is named after the function unless name is given and also
+    records the size of the arrays the function returns.
+    '''
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+
+            with profile_span(name or function.__name__) as span:
+                output = function(*args, **kwargs)
+                span['output_bytes'] = array_nbytes(output)
+
+            return output
+
+        return wrapper
+
+    return decorator
+
+
+def profile_summary(records=None):
+    '''
+    Totals per span name: calls, wall and CPU seconds, the largest peak RSS, RSS growth and allocation peaks.
+    '''
+
+    records = pd.DataFrame(profile_records if records is None else records)
+
+    if records.empty:
+        return pd.DataFrame()
+
+    return records.groupby('name', sort=False).agg(calls=('wall_time', 'size'), wall_time=('wall_time', 'sum'),
+                                                  cpu_time=('cpu_time', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'),
+                                                  rss_growth_mb=('rss_growth_mb', 'max'),
+                                                  allocated_peak_mb=('allocated_peak_mb', 'max'),
+                                                  output_mb=('output_mb', 'max'))
+
+
+def git_revision():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def save_profile(file_name=None, records=None):
+    '''
+    Writes the run profile as JSON (run metadata, spans and summary) and CSV (one row per span) next to each other,
+    e.g. results/profile_<run_id>.json and .csv, so that runs of different code versions can be compared with
+    compare_profiles. Returns the JSON file path.
+    '''
+
+    records = list(profile_records if records is None else records)
+
+    if file_name is None:
+        file_name = os.getcwd() + '/results/profile_%s' % profile_run['run_id']
+    file_name = os.path.splitext(file_name)[0]
+
+    metadata = {'run_id': profile_run['run_id'], 'git_revision': git_revision(), 'python': sys.version.split()[0],
+                'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform(),
+                'command': ' '.join(sys.argv), 'wall_time': time.time() - profile_run['started'],
+                'allocations_traced': tracemalloc.is_tracing()}
+    summary = profile_summary(records)
+
+    with open(file_name + '.json', 'w') as json_file:
+        json.dump({'run': metadata, 'spans': records,
+                   'summary': json.loads(summary.reset_index().to_json(orient='records'))},
+                  json_file, indent=1, default=float)
+
+    pd.DataFrame(records).to_csv(file_name + '.csv', index=False)
+
+    print('Saved profile of %d spans to %s.json/.csv.' % (len(records), file_name))
+
+    return file_name + '.json'
+
+
+def compare_profiles(baseline_file, profile_file):
+    '''
+    Span summaries of two saved profiles side by side with the ratio current/baseline (values above 1 are slower).
+    Times are per call, so runs with a different number of repeats can be compared.
+    '''
+
+    summaries = []
+
+    for file_name in [baseline_file, profile_file]:
+        with open(os.path.splitext(file_name)[0] + '.json') as json_file:
+            summary = pd.DataFrame(json.load(json_file)['summary']).set_index('name')
+        summary[['wall_time', 'cpu_time']] = summary[['wall_time', 'cpu_time']].div(summary['calls'], axis=0)
+        summaries.append(summary)
+
+    comparison = summaries[0].join(summaries[1], how='outer', lsuffix='_baseline', rsuffix='_current')
+
+    for column in ['wall_time', 'cpu_time', 'peak_rss_mb', 'rss_growth_mb', 'allocated_peak_mb']:
+        if column + '_baseline' in comparison.columns and column + '_current' in comparison.columns:
+            comparison[column + '_ratio'] = comparison[column + '_current'] / comparison[column + '_baseline']
+
+    return comparison
+
+
+def memory_report(frames, exclude_columns=['click', 'bidprice', 'payprice']):
+    '''
+    Resident size of data frames (deep memory usage; slices of one frame may share its memory) next to the size
+    the same frames had with int64 dummies, and the float64 and float32 feature matrices the models receive
+    '''
+
+    rows = []
+
+    for name, frame in frames.items():
+
+        usage = frame.memory_usage(index=False, deep=True)
+        dummies = [column for column, dtype in frame.dtypes.items()
+                   if isinstance(dtype, pd.SparseDtype) or dtype in [np.uint8, np.bool_]]
+        n_features = frame.shape[1] - len(set(exclude_columns) & set(frame.columns))
+
+        rows.append({'frame': name, 'rows': frame.shape[0], 'columns': frame.shape[1], 'dummy_columns': len(dummies),
+                     'resident_mb': usage.sum() / 1024.0 ** 2,
+                     'int64_dummies_mb': (usage.sum() - usage[dummies].sum() + 8 * frame.shape[0] * len(dummies))
+                                         / 1024.0 ** 2,
+                     'float64_features_mb': 8 * frame.shape[0] * n_features / 1024.0 ** 2,
+                     'float32_features_mb': 4 * frame.shape[0] * n_features / 1024.0 ** 2})
+
+    return pd.DataFrame(rows).set_index('frame').round(1)
+
+
+# -------------------------------- SHARED ARRAYS ---------------------------------- #
+
+# Arrays this process has attached to, by directory (workers attach once and reuse them)
+attached_arrays = {}
+
+
+def share_arrays(arrays, directory=None):
+    '''
+    Writes named (dense or sparse) arrays to .npy files, in /dev/shm where available, for worker processes to
+    memory-map. Returns a picklable handle for attach_arrays and release_arrays.
+    '''
+
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='shared_arrays_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+    handle = {'directory': directory, 'arrays': {}}
+
+    for name, array in arrays.items():
+
+        if sp.issparse(array):
+            array = sp.csr_matrix(array)
+            for component in ['data', 'indices', 'indptr']:
+                np.save(os.path.join(directory, '%s.%s.npy' % (name, component)), getattr(array, component))
+            handle['arrays'][name] = {'format': 'csr', 'shape': array.shape}
+
+        else:
+            np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(np.asarray(array)))
+            handle['arrays'][name] = {'format': 'dense'}
+
+    return handle
+
+
+def attach_arrays(handle):
+    '''
+    Read-only memory-mapped views of the shared arrays (zero-copy; the pages are shared between processes)
+    '''
+
+    if handle['directory'] not in attached_arrays:
+
+        arrays = {}
+        for name, array in handle['arrays'].items():
+
+            if array['format'] == 'csr':
+                components = [np.load(os.path.join(handle['directory'], '%s.%s.npy' % (name, component)),
+                                      mmap_mode='r') for component in ['data', 'indices', 'indptr']]
+                arrays[name] = sp.csr_matrix(tuple(components), shape=array['shape'], copy=False)
+
+            else:
+                arrays[name] = np.load(os.path.join(handle['directory'], name + '.npy'), mmap_mode='r')
+
+        attached_arrays[handle['directory']] = arrays
+
+    return attached_arrays[handle['directory']]
+
+
+def release_arrays(handle):
+
+    attached_arrays.pop(handle['directory'], None)
+    shutil.rmtree(handle['directory'], ignore_errors=True)
+
+
+# ------------------------------ PREDICTION CACHE --------------------------------- #
+
+# File hashes by (path, size, modification time), so an unchanged model file is hashed once per session
+file_hashes = {}
+
+
+def file_hash(file_name):
+    '''
+    Content hash of a model file, read in blocks
+    '''
+
+    status = os.stat(file_name)
+    key = (os.path.abspath(file_name), status.st_size, status.st_mtime_ns)
+
+    if key not in file_hashes:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_name, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 24), b''):
+                digest.update(block)
+        file_hashes[key] = digest.hexdigest()
+
+    return file_hashes[key]
+
+
+def frame_hash(data, exclude_columns=['click', 'bidprice', 'payprice']):
+    '''
+    Hash of the feature columns of a frame (names, dtypes and values; sparse columns by their stored entries)
+    '''
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(data.shape[0]).encode())
+
+    for column in data.columns.drop(exclude_columns, errors='ignore'):
+
+        values = data[column].array
+        digest.update(('%s|%s|' % (column, data[column].dtype)).encode())
+
+        if isinstance(data[column].dtype, pd.SparseDtype):
+            digest.update(np.ascontiguousarray(values.sp_index.indices).tobytes())
+            digest.update(np.ascontiguousarray(values.sp_values).tobytes())
+        else:
+            digest.update(np.ascontiguousarray(np.asarray(values)).tobytes())
+
+    return digest.hexdigest()
+
+
+def cached_predictions(model_file, data, predict=None, directory=None):
+    '''
+    Predictions of a saved model on a feature frame, stored as .npy under models/prediction_cache and keyed by the
+    hashes of the model file and of the features, so a retrained model or different features never hit an old
+    entry. On a miss predict() is called and its output saved; without predict a miss returns None.
+    '''
+
+    if directory is None:
+        directory = os.getcwd() + "/models/prediction_cache"
+
+    file_name = os.path.join(directory, '%s_%s_%s.npy' % (os.path.splitext(os.path.basename(model_file))[0],
+                                                          file_hash(model_file), frame_hash(data)))
+
+    if os.path.exists(file_name):
+        print('Loading cached predictions from %s.' % file_name)
+        return np.load(file_name)
+
+    if predict is None:
+        return None
+
+    prediction = np.asarray(predict())
+    os.makedirs(directory, exist_ok=True)
+    with open(file_name + '.tmp', 'wb') as file: # Complete files only, also with parallel runs
+        np.save(file, prediction)
+    os.replace(file_name + '.tmp', file_name)
+
+    return prediction
+
+
+# --------------------------------- PLOTS ----------------------------------------- #
+
+def use_style(name):
+    '''
+    Applies a seaborn style by its old name; matplotlib 3.6+ only ships it as 'seaborn-v0_8-...'
+    '''
+
+    plt.style.use(name if name in plt.style.available else name.replace('seaborn', 'seaborn-v0_8', 1))
+
+
+# --- ROC CURVES
+def plot_ROC_curves(curves, title='ROC'):
+    '''
+    curves is a list of dicts with fpr, tpr and label (as returned by plot_ROC_curve).
+    '''
+
+    figure, ax = plt.subplots(figsize=(3.3 * 1.2, 2.2 * 1.4))
+    ax.tick_params(labelsize=6)
+
+    for curve in curves:
+        ax.plot(curve['fpr'], curve['tpr'], label=curve['label'])
+
+    ax.plot([0, 1], [0, 1], 'k--')  # random predictions curve
+    ax.set_xlim([0.0, 1.0])
+    ax.set_ylim([0.0, 1.0])
+    ax.set_xlabel('False Positive Rate or (1 - Specifity)', fontsize=8)
+    ax.set_ylabel('True Positive Rate or (Sensitivity)', fontsize=8)
+    ax.set_title(title, fontsize=10)
+    ax.legend(loc="lower right", fontsize=6)
+
+    return figure
+
+
+# --- DOWNSAMPLING SENSITIVITY
+def plot_downsampling(output, model_type='ERF'):
+
+    use_style("seaborn-darkgrid")
+    figure, ax = plt.subplots(figsize=(3.3 * 1.2, 2.2 * 1.2))
+    ax.plot(output.minority_level * 100, output.AUC)
+    ax.tick_params(labelsize=6)
+    ax.set_xlabel('% of Samples from Minority Class', fontsize=8)
+    ax.set_ylabel('AUC', fontsize=8)
+    ax.set_title('Sensitivity Analysis of Downsampling (Using %s Model)' % model_type, fontsize=10)
+
+    return figure
+
+
+# --- BIDDING STRATEGY PERFORMANCE
+def surface_grid(output, column):
+    '''
+    The parameter grids are full products (tile/repeat), so the surface is a pivot rather than an interpolation.
+    '''
+
+    surface = output.pivot_table(index='parameter_2', columns='parameter_1', values=column)
+    x, y = np.meshgrid(surface.columns.values.astype(float), surface.index.values.astype(float))
+
+    return x, y, surface.values.astype(float)
+
+
+def plot_strategy_evaluation(output, type='linear', plot_3d='no', small='no'):
+
+    if plot_3d == 'yes':
+
+        # Set the parameters for plotting
+        use_style("seaborn-whitegrid")
+        params = {'legend.fontsize': '8',
+                  'figure.figsize': (20,10),
+                  'axes.labelsize': '8',
+                  'axes.titlesize': '12',
+                  'xtick.labelsize': '6',
+                  'ytick.labelsize': '6'}
+
+        plt.rcParams.update(params)
+        plot_title = "Performance Evaluation of %s Model"%(type)
+        figure = plt.figure(figsize=(3.3*1.2, 2.2*1.2*2))
+
+        for position, column, colour_map in [(1, 'clicks_won', cm.Blues), (2, 'CTR', cm.Reds)]:
+
+            x, y, z = surface_grid(output, column)
+            ax = figure.add_subplot(2, 1, position, projection='3d')
+            surf = ax.plot_surface(x, y, z, rstride=1, cstride=1, cmap=colour_map,
+                                   linewidth=0.01, antialiased=False, edgecolors='grey', alpha=0.8)
+            ax.view_init(25, -45)
+
+            ax.set_xlabel('Parameter 1', fontsize = 6)
+            ax.set_ylabel('Parameter 2', fontsize = 6)
+            ax.zaxis.set_rotate_label(False)
+            ax.set_zlabel('Clicks' if column == 'clicks_won' else 'CTR', fontsize = 6, rotation = 90)
+            ax.tick_params(axis='both', which='major', labelsize=6)
+            ax.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
+            figure.colorbar(surf, ax=ax, shrink=0.5, aspect=10)
+            ax.set_title('Clicks' if column == 'clicks_won' else 'CTR', fontsize = 10)
+
+        figure.subplots_adjust(top=0.94, bottom=0.05, hspace=0.20)
+        figure.suptitle(plot_title, fontsize = 10)
+
+    else:
+
+        # Set title and style
+        plot_title = "Performance of %s Bidding Strategy" % type.capitalize()
+        use_style("seaborn-darkgrid")
+
+        # Plot bidding performance
+        best = output.clicks_won.idxmax()
+        figure, ax1 = plt.subplots()
+        ax1.plot(output.parameter_1, output.clicks_won, marker='o', markersize =1, color = 'royalblue', label='Clicks')
+        ax1.set_xlabel('Model Parameter', fontsize = 8)
+        ax1.set_ylabel('Clicks Won', color='royalblue', fontsize = 8)
+        ax1.set_title(plot_title, fontsize=10)
+        ax1.vlines(x=output.parameter_1[best], ymin=0, ymax=output.clicks_won[best], linewidth=1, color='royalblue',
+                   linestyle='--', label='Parameter with Max Clicks')
+        ax1.hlines(xmin=output.parameter_1.min(), xmax=output.parameter_1[best], y=output.clicks_won[best],
+                   linewidth=1, color='royalblue', linestyle='--', label='Parameter with Max Clicks')
+        ax1.set_axisbelow(True) # Push gridlines back
+        ax1.tick_params(axis='x', labelsize=6)
+        ax1.tick_params(axis='y', labelsize=6)
+
+        ax2 = ax1.twinx()
+        ax2.ticklabel_format(style='sci', axis='y', scilimits=(0,0))
+        ax2.yaxis.offsetText.set_fontsize(6)
+        ax2.tick_params(axis='y', labelsize=8)
+        ax2.plot(output.parameter_1, output.CTR, marker='s', markersize =1, color='darkred', label='CTR')
+        ax2.set_ylabel('CTR', color='darkred', fontsize = 8)
+        ax2.set_axisbelow(True)
+        ax2.grid(None)
+
+        lines = ax1.get_lines() + ax2.get_lines()
+        ax1.legend(lines, [line.get_label() for line in lines], loc='upper right', frameon=True)
+
+    if small == 'yes':
+        figure.set_size_inches(3.3*1.2, 2.2*1.2)
+
+    return figure
+
+
+# --- EXPLORATORY ANALYSIS
+def plot_table(table, kind='line', colours=None, xlabel='', ylabel='', title='', thousands='no'):
+    '''
+    One line or bar per column of a (cube slice) table.
+    '''
+
+    figure, ax = plt.subplots()
+    table.plot(kind=kind, color=colours, ax=ax)
+
+    if thousands == 'yes':
+        ax.get_yaxis().set_major_formatter(plt.FuncFormatter(lambda x, loc: "{:,}".format(int(x))))
+
+    ax.set_xlabel(xlabel, fontsize=8)
+    ax.set_ylabel(ylabel, fontsize=8)
+    ax.tick_params(axis='x', rotation=0)
+    ax.set_title(title, fontsize=10)
+    ax.legend(fontsize=6)
+    ax.tick_params(labelsize=6)
+
+    return figure
+
+
+def plot_histograms(histograms, xlabel='Price (Chinese Fen)', ylabel='Probability', title=''):
+    '''
+    histograms is a list of dicts with edges, counts and the bar style (facecolor, alpha, label).
+    '''
+
+    figure, ax = plt.subplots()
+
+    for histogram in histograms:
+        ax.hist(histogram['edges'][:-1], histogram['edges'], weights=histogram['counts'], density=True,
+                facecolor=histogram['facecolor'], alpha=histogram['alpha'], label=histogram.get('label'))
+
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.grid(True)
+
+    if any('label' in histogram for histogram in histograms):
+        ax.legend()
+
+    return figure
+
+
+def plot_violins(panels, labels=['Bid Price', 'Pay Price', 'Floor Price']):
+    '''
+    panels is a list of dicts with the Axes.violin statistics, quartiles, whiskers, title and colour.
+    '''
+
+    figure, axes = plt.subplots(nrows=len(panels), ncols=1, figsize=(3.3*1.2, 2.2*1.2*len(panels)), sharey=True)
+
+    for ax, panel in zip(np.atleast_1d(axes), panels):
+
+        ax.set_title(panel['title'], fontsize=10)
+        ax.set_ylabel('Prices (CNY Fen)', fontsize=8)
+        parts = ax.violin(panel['statistics'], showmeans=False, showmedians=False, showextrema=False)
+
+        for pc in parts['bodies']:
+            pc.set_facecolor(panel['colour'])
+            pc.set_edgecolor('none')
+            pc.set_alpha(0.75)
+
+        quartile1, medians, quartile3 = panel['quartiles']
+        whiskers = np.asarray(panel['whiskers'])
+        inds = np.arange(1, len(medians) + 1)
+        ax.scatter(inds, medians, marker='o', color='white', s=30, zorder=3)
+        ax.vlines(inds, quartile1, quartile3, color='k', linestyle='-', lw=5)
+        ax.vlines(inds, whiskers[:, 0], whiskers[:, 1], color='k', linestyle='-', lw=1)
+
+        # Axis style
+        ax.get_xaxis().set_tick_params(direction='out', labelsize = 8)
+        ax.get_yaxis().set_tick_params(labelsize = 8)
+        ax.xaxis.set_ticks_position('bottom')
+        ax.set_xticks(np.arange(1, len(labels) + 1))
+        ax.set_xticklabels(labels)
+        ax.set_xlim(0.25, len(labels) + 0.75)
+
+    figure.subplots_adjust(top=0.94, bottom=0.05, hspace=0.20)
+
+    return figure
+
+
+def plot_correlogram(corr, title='Correlogram of Prices'):
+
+    import seaborn as sns
+
+    sns.set(font_scale=6/8)
+    sns.set_style("whitegrid")
+
+    # Mask the upper triangle
+    mask = np.zeros(corr.shape, dtype=bool)
+    mask[np.triu_indices_from(mask)] = True
+
+    figure, ax = plt.subplots(figsize=(3.3*1.2, 2.2*1.2))
+    ax.tick_params(labelsize=6)
+    ax.set_title(title, fontsize=10)
+
+    # Diverging colormap
+    cmap = sns.diverging_palette(220, 10, as_cmap=True)
+    sns.heatmap(corr, cmap=cmap, vmax=.3, center=0, square=True, linewidths=.5, cbar_kws={"shrink": .5}, ax=ax)
+
+    return figure
+
+
+def plot_panels(panels):
+    '''
+    Stacked subplots, one per dict with table, kind, colours, title, xlabel and ylabel.
+    '''
+
+    use_style("seaborn-whitegrid")
+    figure, axes = plt.subplots(nrows=len(panels), ncols=1, figsize=(3.3*1.2, 2.2*1.2*len(panels)), sharey=False)
+
+    for ax, panel in zip(np.atleast_1d(axes), panels):
+        panel['table'].plot(kind=panel['kind'], color=panel['colours'], ax=ax)
+        ax.set_title(panel['title'], fontsize=10)
+        ax.set_ylabel(panel['ylabel'], fontsize=8)
+        ax.set_xlabel(panel['xlabel'], fontsize=8)
+        ax.xaxis.set_tick_params(rotation=0)
+
+    figure.subplots_adjust(top=0.96, bottom=0.05, hspace=0.30, left = 0.2)
+
+    return figure
+
+
+plot_functions = {'ROC_curves': plot_ROC_curves, 'downsampling': plot_downsampling,
+                  'strategy_evaluation': plot_strategy_evaluation, 'table': plot_table,
+                  'histograms': plot_histograms, 'violins': plot_violins, 'correlogram': plot_correlogram,
+                  'panels': plot_panels}
+
+####################### END ########################
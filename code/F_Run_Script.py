@@ -40,18 +40,29 @@ pd.set_option('display.max_columns', 40)
 # --- SOME TOGGLES FOR ANALYSIS
 run_gridsearch = 'no' #'no'
 use_saved_model = 'yes' #'no'
+bidding_from_cache = 'no' # 'yes' skips the models and bids from the cached predictions of the saved top model
 save_model = 'no'
 refit = 'no'
 to_plot = 'yes'
+use_target_encoding = 'no' # smoothed CTR features instead of one-hot columns
 minority_class = 0.025
+calibration_method = 'platt' # 'platt' or 'isotonic' table fitted on validation predictions, 'no' for the formula
 random_seed = 500
 budget = 6250000
+strategy_store = None # e.g. os.getcwd()+'/results/strategy_results.sqlite' to skip already evaluated parameters
+n_jobs = 1 # worker processes for the parameter grids (-1 for all cores; data shared through memory maps)
+profile_allocations = 'no' # tracemalloc allocation sizes in the run profile (slower)
+
+# Time and memory spans of every stage end up in results/profile_<run id>.json/.csv
+from E_Pipeline_Utilities import start_profiling, profile_span, save_profile
+start_profiling(trace_allocations=profile_allocations)
 
 # --------------------------------- GET DATA -------------------------------------- #
 
-train = pd.read_csv('./data/train.csv')
-test = pd.read_csv('./data/test.csv')
-validation = pd.read_csv('./data/validation.csv')
+with profile_span('read_data'):
+    train = pd.read_csv('./data/train.csv')
+    test = pd.read_csv('./data/test.csv')
+    validation = pd.read_csv('./data/validation.csv')
 
 # ---------------------------- FEATURE ENGINEERING -------------------------------- #
 
@@ -65,17 +76,38 @@ from B_Data_Preprocessing import *
 data = merge_datasets(train, validation, test)
 
 # Remove irrelevant columns
-data = exclude_irrelevant_features(data,
-                                   remove_columns=['bidid', 'userid', 'IP', 'domain', 'url', 'urlid', 'slotid',
-                                                   'city', 'adexchange', 'creative', 'keypage', 'advertiser'])
+irrelevant_columns = ['bidid', 'userid', 'IP', 'domain', 'url', 'urlid', 'slotid', 'city', 'adexchange', 'creative',
+                      'keypage', 'advertiser']
+data = exclude_irrelevant_features(data, remove_columns=irrelevant_columns)
 
 # Bucket floor prices
-data['slotprice'] = data['slotprice'].apply(slot_price_bucketing)
+with profile_span('slot_price_bucketing'):
+    data['slotprice'] = data['slotprice'].apply(slot_price_bucketing)
 
 # Modify and add some features
-data = add_features(data) # op sys and browser separation, usertag column splitting and slot width/height categorization
-data = one_hot_encoding(data, columns_to_encode = ['weekday', 'hour', 'region', 'slotvisibility', 'slotformat',
-                                                   'opsys', 'browser', 'slot_width_height', 'slotprice'])
+usertag_encoder = UsertagEncoder().fit(data['usertag']) # usertag vocabulary (sparse multi-hot columns)
+data = add_features(data, usertag_encoder=usertag_encoder) # op sys and browser separation, usertag column splitting and slot width/height categorization
+categorical_columns = ['weekday', 'hour', 'region', 'slotvisibility', 'slotformat', 'opsys', 'browser',
+                       'slot_width_height', 'slotprice']
+
+# Categories and vocabularies for encoding new rows the same way (used by the batch bidding script)
+feature_encoder = fit_feature_encoder(data, categorical_columns, irrelevant_columns, usertag_encoder)
+
+if use_target_encoding == 'yes':
+
+    # Dense smoothed CTR per field and selected crosses (out-of-fold for the training rows)
+    data, target_encoder = target_encoding(data, n_train=train.shape[0], columns=categorical_columns,
+                                           crosses=[('weekday', 'hour'), ('opsys', 'browser'),
+                                                    ('slot_width_height', 'slotvisibility'),
+                                                    ('region', 'slot_width_height')],
+                                           seed=random_seed)
+    data = data.drop(categorical_columns, axis=1)
+    feature_encoder['target_encoder'] = target_encoder
+
+else:
+    data = one_hot_encoding(data, columns_to_encode = categorical_columns)
+
+feature_encoder['feature_columns'] = list(data.columns.drop(['click', 'bidprice', 'payprice']))
 
 # data = min_max_scaling(data) # Not needed anymore
 # Extract label dictionary (not used in final process)
@@ -84,6 +116,10 @@ data = one_hot_encoding(data, columns_to_encode = ['weekday', 'hour', 'region',
 # Separate the datasets
 train1, validation1, test1 = separate_datasets(data, train, validation, test)
 
+# Memory of the encoded frames (uint8 dummies) against int64 dummies and the float matrices the models receive
+from E_Pipeline_Utilities import memory_report
+print(memory_report({'data': data, 'train1': train1, 'validation1': validation1, 'test1': test1}))
+
 # Upsample the minority class
 train2 = downsampling_majority_class(train1, class_ratio=minority_class, seed=random_seed)
 
@@ -97,193 +133,285 @@ train2 = downsampling_majority_class(train1, class_ratio=minority_class, seed=ra
 # Get functions from CTR prediction script
 from C_CTR_Prediction import *
 
-# --- LOGISTIC MODEL --- #
-log_classifier, log_prediction = logistic_model(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
-                                                refit_iter=500, use_saved_model=use_saved_model, save_model=save_model,
-                                                to_plot=to_plot, random_seed=random_seed,
-                                                parameters={'C': [0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1], 'penalty': ['l1', 'l2'],
-                                                            'class_weight': ['unbalanced'], 'tol': [0.0001],
-                                                            'solver': ['saga'], 'max_iter': [100]})
-# --- RANDOM FOREST --- #
-rf_classifier, rf_prediction = random_forest(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
-                                             refit_iter=1000, use_saved_model=use_saved_model, save_model=save_model,
-                                             to_plot=to_plot, random_seed=random_seed,
-                                             parameters={'max_depth': [3, 5, 10, None],
-                                                         'min_samples_split':[4, 6, 8],
-                                                         "n_estimators": [200],
-                                                         "min_samples_leaf": [1, 3, 5],
-                                                         "max_features": [5, 20, "sqrt"],
-                                                         "criterion": ['gini'],
-                                                         'random_state': [500]})
-
-# --- EXTREME RANDOM FOREST --- #
-erf_classifier, erf_prediction = extreme_random_forest(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
-                                                       refit_iter=1000, use_saved_model=use_saved_model,
-                                                       save_model=save_model, to_plot=to_plot, random_seed=random_seed,
-                                                       parameters={'max_depth': [5, 10, 20, None],
-                                                                   'min_samples_split': [2, 5, 10],
-                                                                   "n_estimators": [200],
-                                                                   "min_samples_leaf": [2, 5, 10],
-                                                                   "max_features": [5, 20, "sqrt"],
-                                                                   "criterion": ['gini']})
-
-# --- XGBOOST --- #
-xgb_classifier, xgb_prediction = gradient_boosted_trees(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
-                                                        refit_iter=120, use_saved_model=use_saved_model,
-                                                        save_model=save_model, to_plot=to_plot, random_seed=random_seed,
-                                                        parameters={'max_depth': [3, 4, 5, 6], "n_estimators": [200],
-                                                                    "learning_rate": [0.1],
-                                                                    "colsample_bytree": [1],
-                                                                    "reg_alpha": [0, 0.5, 1], "reg_lambda": [0.8, 1],
-                                                                    "subsample": [1], "gamma": [0]})
-# --- SUPPORT VECTOR MACHINES --- #
-svm_classifier, svm_prediction = support_vector_machine(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
-                                                        refit_iter=100, use_saved_model=use_saved_model,
-                                                        save_model=save_model, to_plot=to_plot, random_seed=random_seed,
-                                                        parameters={'C': [0.1, 1, 2],
-                                                                    "kernel": ['linear', 'poly', 'rbf', 'sigmoid'],
-                                                                    "degree": [2, 3, 4],
-                                                                    "gamma": ['auto'],
-                                                                    "tol": [0.001],
-                                                                    "max_iter": [10],
-                                                                    "probability": [True],
-                                                                    "cache_size": [1000]})
-
-# --- NAIVE BAYES --- #
-nb_classifier, nb_prediction = naive_bayes(train2, validation1, use_saved_model='no', save_model=save_model, to_plot =to_plot)
-
-# --- FACTORIZATION MACHINES --- #
-fm_classifier, fm_prediction = factorization_machine(train2, validation1, refit=refit,
-                                                     refit_iter=500, use_saved_model=use_saved_model, save_model=save_model,
-                                                     to_plot=to_plot, random_seed=500,
-                                                     parameters={'init_stdev': 0.1, "rank": 2,
-                                                                 'l2_reg_w': 0.1, 'l2_reg_V': 0.1,
-                                                                 'n_iter': 300})
-
-# --- NEURAL NETWORK --- #
-nn_classifier, nn_prediction = neural_network(train2, validation1, parameters={'learning_rate': [0.005, 0.01],
-                                                                               "learning_momentum": ['0.9'],
-                                                                               "regularize": ['L2'],
-                                                                               "dropout_rate": [0.1, 0.2],
-                                                                               "batch_size": [1],
-                                                                               "n_stable": [10],
-                                                                               "n_iter": [20],
-                                                                               'hidden0__units': [16, 32, 64, 128],
-                                                                               'hidden0__type': ["Rectifier"]},
-                                              use_gridsearch=run_gridsearch, refit=refit, refit_iter=20,
-                                              use_saved_model=use_saved_model, save_model=save_model, to_plot=to_plot,
-                                              random_seed=500)
-
-# --- STACKING MODEL --- #
-stacked_classifier, stacked_prediction = stacking_classifier(train2, validation1, refit=refit, use_saved_model=use_saved_model,
-                                                             save_model=save_model, to_plot=to_plot,
-                                                             meta_leaner_parameters={'max_depth': 3, "n_estimators": 100,
-                                                                                     "learning_rate": 0.1,
-                                                                                     'silent': False, 'n_jobs': 3,
-                                                                                     'subsample': 1,
-                                                                                     'objective': 'binary:logistic',
-                                                                                     'colsample_bytree': 1,
-                                                                                     'eval_metric': "auc",
-                                                                                     'reg_alpha': 1,
-                                                                                     'reg_lambda': 0.8,
-                                                                                     'random_state': random_seed},
-                                                             stacking_cv_parameters={'use_probas': True,
-                                                                                     'use_features_in_secondary': True,
-                                                                                     'cv': 5,
-                                                                                     'store_train_meta_features': False,
-                                                                                     'refit': False})
-
-# --- COMPARE THE AUC  (PLOT ROC CURVES ON SAME GRAPH) --- #
-plot_ROC_curve(validation1['click'], log_prediction, model='Logistic', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], rf_prediction, model='Random Forest', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], erf_prediction, model='Extreme Random Forest', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], xgb_prediction, model='XGBoost', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], svm_prediction, model='SVM', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], nb_prediction, model='Naive Bayes', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], fm_prediction, model='Factorization Machine', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], nn_prediction, model='Neural Network', minority_class=minority_class)
-plot_ROC_curve(validation1['click'], stacked_prediction, model='Stacked', minority_class=minority_class)
-plt.savefig(os.getcwd()+'/results/AUC_comparison_'+str(int(minority_class*100))+'.pdf', dpi=300)
-
-# Choose top classifier
-top_classifier = xgb_classifier
-top_prediction = xgb_prediction
-
-# ---------------------------- TEST DOWNSAMPLING EFFECT ---------------------------------------- #
-
-downsampling_sensitivity = test_downsampling(train1, validation1, top_classifier,
-                                             minority_levels=np.linspace(0.005, 0.2, 20),
-                                             model_type='Stacked', random_seed=500)
-plt.savefig(os.getcwd()+'/results/downsizing_sensitivity.pdf')
+# The bidding sweeps can also start from the cached validation pCTR of the saved top model (stored by an earlier
+# run with use_saved_model = 'yes') without loading or running any model
+top_model_file = os.getcwd() + "/models/xgb_model.pkl"
+
+if bidding_from_cache == 'yes':
+
+    top_classifier = None
+    top_prediction = cached_predictions(top_model_file, validation1,
+                                        lambda: joblib.load(top_model_file).predict_proba(model_features(validation1)))
+    top_prediction = top_prediction[:, 1]
+
+else:
+
+    # --- LOGISTIC MODEL --- #
+    log_classifier, log_prediction = logistic_model(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
+                                                    refit_iter=500, use_saved_model=use_saved_model, save_model=save_model,
+                                                    to_plot=to_plot, random_seed=random_seed,
+                                                    parameters={'C': [0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1], 'penalty': ['l1', 'l2'],
+                                                                'class_weight': ['unbalanced'], 'tol': [0.0001],
+                                                                'solver': ['saga'], 'max_iter': [100]})
+    # --- RANDOM FOREST --- #
+    rf_classifier, rf_prediction = random_forest(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
+                                                 refit_iter=1000, use_saved_model=use_saved_model, save_model=save_model,
+                                                 to_plot=to_plot, random_seed=random_seed,
+                                                 parameters={'max_depth': [3, 5, 10, None],
+                                                             'min_samples_split':[4, 6, 8],
+                                                             "n_estimators": [200],
+                                                             "min_samples_leaf": [1, 3, 5],
+                                                             "max_features": [5, 20, "sqrt"],
+                                                             "criterion": ['gini'],
+                                                             'random_state': [500]})
+
+    # --- EXTREME RANDOM FOREST --- #
+    erf_classifier, erf_prediction = extreme_random_forest(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
+                                                           refit_iter=1000, use_saved_model=use_saved_model,
+                                                           save_model=save_model, to_plot=to_plot, random_seed=random_seed,
+                                                           parameters={'max_depth': [5, 10, 20, None],
+                                                                       'min_samples_split': [2, 5, 10],
+                                                                       "n_estimators": [200],
+                                                                       "min_samples_leaf": [2, 5, 10],
+                                                                       "max_features": [5, 20, "sqrt"],
+                                                                       "criterion": ['gini']})
+
+    # --- XGBOOST --- #
+    xgb_classifier, xgb_prediction = gradient_boosted_trees(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
+                                                            refit_iter=120, use_saved_model=use_saved_model,
+                                                            save_model=save_model, to_plot=to_plot, random_seed=random_seed,
+                                                            parameters={'max_depth': [3, 4, 5, 6], "n_estimators": [200],
+                                                                        "learning_rate": [0.1],
+                                                                        "colsample_bytree": [1],
+                                                                        "reg_alpha": [0, 0.5, 1], "reg_lambda": [0.8, 1],
+                                                                        "subsample": [1], "gamma": [0]})
+    # --- SUPPORT VECTOR MACHINES --- #
+    # Linear SVM (SGD hinge loss, optional Nystroem/random Fourier kernel features) with calibrated probabilities;
+    # model_type='SVC' with the kernel grid {'C', 'kernel', 'degree', 'gamma', ...} runs sklearn's SVC instead (the
+    # committed svm_model.pkl is that model); no linear SVM model is committed, so it is always fitted here
+    svm_classifier, svm_prediction = support_vector_machine(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
+                                                            refit_iter=50, use_saved_model='no',
+                                                            save_model=save_model, to_plot=to_plot, random_seed=random_seed,
+                                                            model_type='linear',
+                                                            parameters={'alpha': [1e-6, 1e-5, 1e-4],
+                                                                        'kernel': ['none', 'rbf_sampler', 'nystroem'],
+                                                                        'n_components': [300],
+                                                                        'max_iter': [20],
+                                                                        'class_weight': [None, 'balanced'],
+                                                                        'calibration': ['sigmoid']})
+
+    # --- NAIVE BAYES --- #
+    nb_classifier, nb_prediction = naive_bayes(train2, validation1, use_saved_model='no', save_model=save_model, to_plot =to_plot)
+
+    # --- FACTORIZATION MACHINES --- #
+    fm_classifier, fm_prediction = factorization_machine(train2, validation1, refit=refit,
+                                                         refit_iter=20, use_saved_model='no', save_model=save_model,
+                                                         to_plot=to_plot, random_seed=500,
+                                                         parameters={'init_stdev': 0.1, "rank": 4,
+                                                                     'l2_reg_w': 1e-5, 'l2_reg_V': 1e-5,
+                                                                     'learning_rate': 0.05, 'solver': 'adagrad',
+                                                                     'batch_size': 1024, 'n_iter': 20, 'n_jobs': 3})
+
+    # --- NEURAL NETWORK --- #
+    nn_classifier, nn_prediction = neural_network(train2, validation1, parameters={'learning_rate': [0.001, 0.005],
+                                                                                   'alpha': [1e-5, 1e-4],
+                                                                                   'embedding_dim': [4, 8],
+                                                                                   'batch_size': [256, 1024],
+                                                                                   'n_iter_no_change': [3],
+                                                                                   'max_iter': [20],
+                                                                                   'hidden_layer_sizes': [(16,), (32,),
+                                                                                                          (64,), (128,)]},
+                                                  use_gridsearch=run_gridsearch, refit=refit, refit_iter=20,
+                                                  use_saved_model=use_saved_model, save_model=save_model, to_plot=to_plot,
+                                                  random_seed=500)
+
+    # --- K NEAREST NEIGHBOURS (APPROXIMATE IVF INDEX, HAMMING DISTANCE) --- #
+    knn_classifier, knn_prediction = KNN(train2, validation1, use_gridsearch=run_gridsearch, refit=refit,
+                                         use_saved_model='no', save_model=save_model, to_plot=to_plot,
+                                         random_seed=random_seed, model_type='hamming',
+                                         parameters={'n_neighbors': [20, 50, 100], 'n_lists': [256],
+                                                     'n_probe': [2, 4, 8], 'smoothing': [5], 'n_jobs': [3]})
+
+    # --- STACKING MODEL --- #
+    stacked_classifier, stacked_prediction = stacking_classifier(train2, validation1, refit=refit, use_saved_model=use_saved_model,
+                                                                 save_model=save_model, to_plot=to_plot,
+                                                                 meta_leaner_parameters={'max_depth': 3, "n_estimators": 100,
+                                                                                         "learning_rate": 0.1,
+                                                                                         'silent': False, 'n_jobs': 3,
+                                                                                         'subsample': 1,
+                                                                                         'objective': 'binary:logistic',
+                                                                                         'colsample_bytree': 1,
+                                                                                         'eval_metric': "auc",
+                                                                                         'reg_alpha': 1,
+                                                                                         'reg_lambda': 0.8,
+                                                                                         'random_state': random_seed},
+                                                                 stacking_cv_parameters={'use_probas': True,
+                                                                                         'use_features_in_secondary': True,
+                                                                                         'cv': 5,
+                                                                                         'store_train_meta_features': False,
+                                                                                         'refit': False},
+                                                                 include_knn='no') # 'yes' adds the KNN neighbour CTR
+
+    # --- COMPARE THE AUC  (PLOT ROC CURVES ON SAME GRAPH) --- #
+    ROC_curves = [plot_ROC_curve(validation1['click'], prediction, model=model, minority_class=minority_class)
+                  for model, prediction in [('Logistic', log_prediction), ('Random Forest', rf_prediction),
+                                            ('Extreme Random Forest', erf_prediction), ('XGBoost', xgb_prediction),
+                                            ('Linear SVM', svm_prediction), ('Naive Bayes', nb_prediction),
+                                            ('Factorization Machine', fm_prediction), ('Neural Network', nn_prediction),
+                                            ('Approximate KNN', knn_prediction), ('Stacked', stacked_prediction)]]
+    defer_plot('ROC_curves', 'AUC_comparison_'+str(int(minority_class*100))+'.pdf', curves=ROC_curves,
+               title=ROC_curves[0]['title'])
+
+    # Choose top classifier
+    top_classifier = xgb_classifier
+    top_prediction = xgb_prediction
+
+    # ---------------------------- TEST DOWNSAMPLING EFFECT ---------------------------------------- #
+
+    downsampling_sensitivity = test_downsampling(train1, validation1, top_classifier,
+                                                 minority_levels=np.linspace(0.005, 0.2, 20),
+                                                 model_type='Stacked', random_seed=500)
 
 # ---------------------------- BIDDING STRATEGY ---------------------------------------- #
 
 # Get functions from Bidding Strategies script
 from D_Bidding_Strategies import *
 
-# Normalise bids
-top_prediction = normalise_bids(top_prediction, minority_weighting = minority_class)
+# Calibrate the predictions to the true CTR (out-of-fold on validation), or normalise with the formula
+if calibration_method != 'no':
+    top_prediction, calibration = cross_fitted_calibration(top_prediction, validation1['click'],
+                                                           method=calibration_method, seed=random_seed,
+                                                           minority_weighting=minority_class)
+else:
+    top_prediction = normalise_bids(top_prediction, minority_weighting = minority_class)
+
+# Market price landscape from the training log (win rate and expected cost lookups per slot segment)
+landscape = fit_bid_landscape(train, segment_columns=['slotvisibility', 'slotwidth', 'slotheight'])
+validation_segments = landscape_segments(landscape, validation)
+ORTB_c = fit_ORTB_winning_function(landscape) # Calibrated c of w(b) = b / (c + b)
 
 # Run the grid search for hyperparameters
 
 # --- CONSTANT BIDDING --- #
 constant_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.linspace(20, 120, 100),
                                       type='constant', budget=budget, to_plot='yes', to_save='no',
-                                      file_name='constant_bidding_strategy.pdf') # Takes c. 13 seconds
+                                      file_name='constant_bidding_strategy.pdf', results_store=strategy_store) # Takes c. 13 seconds
 
 # --- RANDOM BIDDING --- #
 a = np.tile(np.linspace(50, 200, 50), 50)
 b = np.repeat(np.linspace(201, 300, 50), 50)
 random_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.column_stack((a, b)),
-                                    type='random', budget=budget, to_plot='yes', plot_3d='yes', repeated_runs=20)
+                                    type='random', budget=budget, to_plot='yes', plot_3d='yes', repeated_runs=20,
+                                    results_store=strategy_store, n_jobs=n_jobs)
 
 # --- LINEAR BIDDING --- #
 linear_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.linspace(50, 350, 100),
                                     type='linear', budget=budget, to_plot='yes', to_save='no',
-                                    file_name='linear_bidding_strategy.pdf')
+                                    file_name='linear_bidding_strategy.pdf', results_store=strategy_store)
+
+# --- LINEAR BIDDING UNDER BUDGET PACING (TIME-ORDERED REPLAY) --- #
+paced_linear_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.linspace(50, 350, 100),
+                                          type='linear', budget=budget, to_plot='yes', pacing='shading',
+                                          timestamps=validation[['weekday', 'hour']], n_jobs=n_jobs)
+
+# --- LINEAR BIDDING WITH PER-ADVERTISER CAMPAIGN BUDGETS --- #
+campaign_budgets = (budget * validation['advertiser'].value_counts(normalize=True)).to_dict() # Split by traffic
+campaign_linear_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.linspace(50, 350, 100),
+                                             type='linear', budget=campaign_budgets,
+                                             campaigns=validation['advertiser'],
+                                             timestamps=validation[['weekday', 'hour']])
+best_campaign_parameters = campaign_linear_output.loc[campaign_linear_output.groupby('campaign')['clicks_won'].idxmax()]
 
 # --- SQUARE BIDDING --- #
 square_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.linspace(180, 230, 100),
-                                    type='square', budget=budget, to_plot='yes', average_CTR = 7.375623e-04)
+                                    type='square', budget=budget, to_plot='yes', average_CTR = 7.375623e-04,
+                                    results_store=strategy_store)
 
 # --- EXPONENTIAL BIDDING --- #
 exponential_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.linspace(30, 40, 100),
-                                         type='exponential', budget=budget, to_plot='yes')
+                                         type='exponential', budget=budget, to_plot='yes',
+                                         results_store=strategy_store)
+
+# --- ORTB1 BIDDING WITH SOLVED LAMBDA (BISECTION ON EXPECTED SPEND INSTEAD OF THE GRID BELOW) --- #
+ORTB_lambda = optimal_lambda(landscape, top_prediction, budget, segments=validation_segments, type='ORTB1', c=ORTB_c)
+solved_ORTB1_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.array([[ORTB_c, ORTB_lambda]]),
+                                          type='ORTB1', budget=budget, to_plot='no')
+
+# Per campaign
+campaign_lambdas = optimal_lambda(landscape, top_prediction, campaign_budgets, segments=validation_segments,
+                                  type='ORTB1', c=ORTB_c, campaigns=validation['advertiser'])
+solved_campaign_output = campaign_replay(validation1, lagrangian_bids(top_prediction,
+                                                                      validation['advertiser'].map(campaign_lambdas).values,
+                                                                      type='ORTB1', c=ORTB_c),
+                                         campaign_budgets, campaigns=validation['advertiser'],
+                                         timestamps=validation[['weekday', 'hour']])
 
 # --- ORTB1 BIDDING --- #
 b = np.tile(np.linspace(4.6e-7, 5.8e-7, 70), 70)
 a = np.repeat(np.linspace(1, 30, 70), 70)
 ORTB1_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.column_stack((a, b)),
-                                    type='ORTB1', budget=budget, to_plot='yes', plot_3d='yes')
+                                    type='ORTB1', budget=budget, to_plot='yes', plot_3d='yes',
+                                    results_store=strategy_store, n_jobs=n_jobs)
 
 # --- ORTB2 BIDDING --- #
 b = np.tile(np.linspace(4.6e-7, 5.8e-6, 50), 50)
 a = np.repeat(np.linspace(1, 100, 50), 50)
 ORTB2_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.column_stack((a, b)),
-                                    type='ORTB2', budget=budget, to_plot='yes', plot_3d='yes')
+                                    type='ORTB2', budget=budget, to_plot='yes', plot_3d='yes',
+                                    results_store=strategy_store, n_jobs=n_jobs)
 
 # --- ORTBx BIDDING (quadratic function with two parameters) --- #
 b = np.tile(np.linspace(-30, 30, 70), 70)
 a = np.repeat(np.linspace(220, 280, 70), 70)
 ORTBx_output = strategy_evaluation(validation1, top_prediction, parameter_range=np.column_stack((a, b)),
                                    type='ORTBy', budget=budget, to_plot='yes', plot_3d='yes',
-                                   average_CTR=7.375623e-04)
+                                   average_CTR=7.375623e-04, results_store=strategy_store, n_jobs=n_jobs)
+
+# --- MULTI-AGENT SECOND PRICE AUCTION (OUR STRATEGIES COMPETING WITH EACH OTHER AND THE MARKET) --- #
+agents = [{'name': 'constant', 'type': 'constant', 'parameter': 80, 'budget': budget},
+          {'name': 'random', 'type': 'random', 'parameter': (50, 300), 'budget': budget, 'seed': random_seed},
+          {'name': 'linear', 'type': 'linear', 'parameter': 200, 'budget': budget},
+          {'name': 'square', 'type': 'square', 'parameter': 200, 'budget': budget},
+          {'name': 'ORTB1 (solved)', 'type': 'ORTB1', 'parameter': (ORTB_c, ORTB_lambda), 'budget': budget}]
+multi_agent_output = multi_agent_simulation(validation1, top_prediction, agents, market_price='yes')
+
+# ---------------------------- PLOTS --------------------------------------------------- #
+
+# Render every queued figure to results/ in parallel on the headless backend
+from E_Pipeline_Utilities import render_plots
+with profile_span('render_plots'):
+    render_plots()
 
 # ---------------------------- OUTPUT  ------------------------------------------------- #
 
-# Retrain the model using train plus validation data
-train_plus_validation = pd.concat([train1, validation1])
-train_plus_validation = train1.append(validation1)
-train_plus_validation = downsampling_majority_class(train_plus_validation, class_ratio=minority_class, seed=500)
+if bidding_from_cache == 'yes':
+
+    # Saved top model without the refit (its test pCTR is cached as well)
+    refitted_model = None
+    test_prediction = cached_predictions(top_model_file, test1,
+                                         lambda: joblib.load(top_model_file).predict_proba(model_features(test1)))
+    test_prediction = test_prediction[:, 1]
 
-# Refit the model with new training data
-refitted_model = top_classifier.fit(train_plus_validation.drop(['click', 'bidprice', 'payprice'], axis=1), train_plus_validation['click'])
+else:
 
-# Predict for the testing set using best model (ERF in our case) plus train and validation data together
-test_prediction = refitted_model.predict_proba(test1.drop(['click', 'bidprice', 'payprice'], axis=1))[:, 1]
+    # Retrain the model using train plus validation data
+    train_plus_validation = pd.concat([train1, validation1])
+    train_plus_validation = train1.append(validation1)
+    train_plus_validation = downsampling_majority_class(train_plus_validation, class_ratio=minority_class, seed=500)
 
-# Normalise
-test_prediction = normalise_bids(test_prediction, minority_weighting = minority_class)
+    # Refit the model with new training data
+    with profile_span('final_model.fit'):
+        refitted_model = top_classifier.fit(model_features(train_plus_validation), train_plus_validation['click'])
+
+    # Predict for the testing set using best model (ERF in our case) plus train and validation data together
+    with profile_span('final_model.predict'):
+        test_prediction = refitted_model.predict_proba(model_features(test1))[:, 1]
+
+# Calibrate (the refitted model is downsampled the same way, so the validation table carries over) or normalise
+if calibration_method != 'no':
+    test_prediction = calibrate_predictions(test_prediction, calibration)
+else:
+    test_prediction = normalise_bids(test_prediction, minority_weighting = minority_class)
 
 # Get the coefficient of the best model
 parameter_1 = square_output.ix[square_output['clicks_won'].argmax()][2]
@@ -297,9 +425,20 @@ avgCTR = 7.375623e-04 # from training set
 bids = (np.array(test_prediction) / np.repeat(avgCTR, test_prediction.shape[0])) ** 2 * parameter_1
 
 # Output results in csv file compatible with the submission
-submission = pd.DataFrame(np.asarray([np.array(test.bidid), bids]).T, columns=['bidid', 'bidprice'])
+submission = pd.DataFrame({'bidid': test['bidid'].values, 'bidprice': bids})
 submission.to_csv(os.getcwd()+"/results/testing_bidding_price.csv", index=False)
 
+# Keep the model and the feature encoder for scoring large test files in chunks, e.g.
+# python code/H_Batch_Bidding.py --test data/test.csv --bid-type square --parameter <parameter_1>
+if save_model == 'yes' and refitted_model is not None:
+    joblib.dump(refitted_model, os.getcwd() + "/models/submission_model.pkl", compress=9)
+    joblib.dump(feature_encoder, os.getcwd() + "/models/feature_encoder.pkl", compress=9)
+    if calibration_method != 'no':
+        joblib.dump(calibration, os.getcwd() + "/models/calibration.pkl") # --calibration models/calibration.pkl
+
+# Write the run profile (compare with an earlier run via compare_profiles(old_file, new_file))
+save_profile()
+
 # Submit electronically
 # curl http://deepmining.cs.ucl.ac.uk/api/upload/wining_criteria_1/92ZX62SoMlVG -X Post -F 'file=@/Users/ssabas/Desktop/ucl-webecon/results/testing_bidding_price.csv'
 # curl http://deepmining.cs.ucl.ac.uk/api/upload/wining_criteria_2/92ZX62SoMlVG -X Post -F 'file=@/Users/ssabas/Desktop/ucl-webecon/results/testing_bidding_price_multiagent.csv'
@@ -0,0 +1,389 @@
+"""
+Project:
+    COMPGW02/M041 Web Economics Coursework Project
+
+Description:
+    In this assignment, we are required to work on an online advertising problem. We will help advertisers to form
+    a bidding strategy in order to place their ads online in a realtime bidding system. We are required to train a
+    bidding strategy based on a provided advertising impression training set. This project aims to help us understand
+    some basic concepts and write a computer program in real-time bidding based display advertising. As we will be
+    evaluated both as a group as well as individually, part of the assignment is to train a model of our choice
+    independently. The performance of the model trained by the team, which is either a combination of the
+    individually developed models or the best performing individually-developed model, will be (mainly) evaluated
+    on the Click-through Rate achieved on a provided test set.
+
+    Benchmarks of the pipeline on synthetic iPinYou-shaped logs (B_Data_Preprocessing.synthetic_log), so they run
+    without the ./data files. The suites follow the asv conventions (params, param_names, setup and time_*/peakmem_*
+    methods, NotImplementedError in setup skips a case) and can also be run directly:
+
+        python code/G_Benchmark_Suite.py --rows 100000 1000000 --suites preprocessing strategy
+        python code/G_Benchmark_Suite.py --rows 100000 --baseline results/benchmark_<old run>.json
+
+    Every run is saved as a profile (see E_Pipeline_Utilities.save_profile) that includes the fit/predict and
+    replay spans of the instrumented functions.
+
+Authors:
+  Sven Sabas
+
+Date:
+  22/02/2018
+"""
+
+# ------------------------------ IMPORT LIBRARIES --------------------------------- #
+
+import os
+import sys
+import time
+import argparse
+import inspect
+import itertools
+import traceback
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# And own libraries
+working_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(working_dir)
+from B_Data_Preprocessing import *
+from D_Bidding_Strategies import *
+from E_Pipeline_Utilities import start_profiling, profile_span, profile_summary, save_profile, compare_profiles
+
+# ------------------------------ SETTINGS ----------------------------------------- #
+
+benchmark_rows = [100000, 1000000, 10000000]
+benchmark_seed = 500
+minority_class = 0.025
+average_CTR = 7.375623e-04
+
+# Same feature engineering as the run script
+irrelevant_columns = ['bidid', 'userid', 'IP', 'domain', 'url', 'urlid', 'slotid', 'city', 'adexchange', 'creative',
+                      'keypage', 'advertiser']
+categorical_columns = ['weekday', 'hour', 'region', 'slotvisibility', 'slotformat', 'opsys', 'browser',
+                       'slot_width_height', 'slotprice']
+
+# Small fixed settings (no grid search, nothing loaded from or saved to models/)
+benchmark_models = {'logistic': ('logistic_model', {'parameters': {'C': 0.1, 'penalty': 'l2', 'class_weight': None,
+                                                                   'max_iter': 100, 'n_jobs': 1, 'tol': 1e-4}}),
+                    'random_forest': ('random_forest', {'parameters': {'max_depth': 10, 'max_features': 'sqrt',
+                                                                       'min_samples_leaf': 5,
+                                                                       'min_samples_split': 10,
+                                                                       'criterion': 'gini', 'n_estimators': 50}}),
+                    'extreme_random_forest': ('extreme_random_forest',
+                                              {'parameters': {'max_depth': 10, 'max_features': 'sqrt',
+                                                              'min_samples_leaf': 5, 'min_samples_split': 10,
+                                                              'criterion': 'gini', 'n_estimators': 50}}),
+                    'xgboost': ('gradient_boosted_trees', {'refit_iter': 50,
+                                                           'parameters': {'max_depth': 4, 'learning_rate': 0.1,
+                                                                          'subsample': 1, 'colsample_bytree': 1,
+                                                                          'reg_alpha': 0, 'reg_lambda': 1,
+                                                                          'gamma': 0}}),
+                    'svm': ('support_vector_machine', {'refit_iter': 100,
+                                                       'parameters': {'C': 1, 'kernel': 'rbf', 'degree': 3,
+                                                                      'gamma': 'auto', 'tol': 1e-3}}),
+                    'linear_svm': ('support_vector_machine', {'refit_iter': 20, 'model_type': 'linear',
+                                                              'parameters': {'alpha': 1e-5, 'kernel': 'nystroem',
+                                                                             'n_components': 300, 'max_iter': 20}}),
+                    'naive_bayes': ('naive_bayes', {}),
+                    'knn': ('KNN', {'parameters': {'n_neighbors': 50, 'algorithm': 'auto'}}),
+                    'approximate_knn': ('KNN', {'model_type': 'hamming',
+                                                'parameters': {'n_neighbors': 50, 'n_lists': 256, 'n_probe': 4,
+                                                               'smoothing': 5}}),
+                    'factorization_machine': ('factorization_machine',
+                                              {'parameters': {'rank': 4, 'learning_rate': 0.05, 'l2_reg_w': 1e-5,
+                                                              'l2_reg_V': 1e-5, 'init_stdev': 0.1,
+                                                              'batch_size': 1024, 'n_iter': 5, 'solver': 'adagrad',
+                                                              'n_jobs': 3}}),
+                    'neural_network': ('neural_network', {'parameters': {'learning_rate': 0.001, 'alpha': 1e-5,
+                                                                         'embedding_dim': 4, 'batch_size': 1024,
+                                                                         'n_iter_no_change': 3, 'max_iter': 5,
+                                                                         'hidden_layer_sizes': (32,)}})}
+
+# Largest log each model is benchmarked on (models are fitted on the down-sampled training rows)
+model_row_limits = {'svm': 1000000, 'knn': 1000000, 'random_forest': 1000000, 'extreme_random_forest': 1000000,
+                    'neural_network': 1000000}
+
+# Parameter grids per bid type (smaller versions of the run script grids)
+benchmark_parameter_ranges = {'constant': np.linspace(20, 120, 20),
+                              'random': np.column_stack((np.tile(np.linspace(50, 200, 10), 10),
+                                                         np.repeat(np.linspace(201, 300, 10), 10))),
+                              'linear': np.linspace(50, 350, 20),
+                              'square': np.linspace(180, 230, 20),
+                              'exponential': np.linspace(30, 40, 20),
+                              'ORTB1': np.column_stack((np.repeat(np.linspace(1, 30, 10), 10),
+                                                        np.tile(np.linspace(4.6e-7, 5.8e-7, 10), 10))),
+                              'ORTB2': np.column_stack((np.repeat(np.linspace(1, 100, 10), 10),
+                                                        np.tile(np.linspace(4.6e-7, 5.8e-6, 10), 10))),
+                              'ORTBy': np.column_stack((np.repeat(np.linspace(220, 280, 10), 10),
+                                                        np.tile(np.linspace(-30, 30, 10), 10)))}
+
+# ------------------------------ BENCHMARK DATA ----------------------------------- #
+
+# Logs of the last requested size, shared by the suites of one run
+benchmark_cache = {}
+
+
+def benchmark_logs(rows, seed=benchmark_seed):
+    """
+    Synthetic train, validation and test logs in the proportions of the coursework data (8:1:1 of rows)
+    """
+
+    if benchmark_cache.get('rows') != rows:
+        benchmark_cache.clear()
+        profiles = synthetic_usertag_profiles(np.random.default_rng(0))
+        benchmark_cache.update({'rows': rows,
+                                'logs': (synthetic_log(rows, seed=seed, identifiers='no', usertag_profiles=profiles),
+                                         synthetic_log(rows // 8, seed=seed + 1, identifiers='no',
+                                                       usertag_profiles=profiles),
+                                         synthetic_log(rows // 8, seed=seed + 2, identifiers='no', labelled='no',
+                                                       usertag_profiles=profiles))})
+
+    return benchmark_cache['logs']
+
+
+def benchmark_features(train, validation, test):
+    """
+    Feature engineering of the run script (one-hot encoding)
+    """
+
+    data = merge_datasets(train, validation, test)
+    data = exclude_irrelevant_features(data, remove_columns=irrelevant_columns)
+    data['slotprice'] = data['slotprice'].apply(slot_price_bucketing)
+    data = add_features(data)
+    data = one_hot_encoding(data, columns_to_encode=categorical_columns)
+
+    return separate_datasets(data, train, validation, test)
+
+
+def benchmark_features_cached(rows):
+
+    if 'features' not in benchmark_cache or benchmark_cache.get('rows') != rows:
+        train, validation, test = benchmark_logs(rows)
+        benchmark_cache['features'] = benchmark_features(train, validation, test)
+
+    return benchmark_cache['features']
+
+
+def benchmark_prediction(validation, seed=benchmark_seed):
+    """
+    A noisy but informative CTR prediction for the strategy benchmarks, so they do not depend on a fitted model
+    """
+
+    generator = np.random.default_rng(seed)
+    prediction = average_CTR * generator.lognormal(0, 1, len(validation)) * (1 + 20 * validation['click'].values)
+
+    return np.clip(prediction, 0, 1)
+
+
+def benchmark_budget(validation):
+
+    # Budget of the coursework (6,250,000 for 303,925 validation rows) scaled to the synthetic log
+    return 6250000 * len(validation) / 303925
+
+# ------------------------------ SUITES ------------------------------------------- #
+
+
+class PreprocessingSuite:
+
+    params = [benchmark_rows]
+    param_names = ['rows']
+    timeout = 3600
+
+    def setup(self, rows):
+        self.train, self.validation, self.test = benchmark_logs(rows)
+
+    def time_merge_and_exclude(self, rows):
+        exclude_irrelevant_features(merge_datasets(self.train, self.validation, self.test),
+                                    remove_columns=irrelevant_columns)
+
+    def time_add_features(self, rows):
+        add_features(self.train.copy())
+
+    def time_usertag_encoding(self, rows):
+        UsertagEncoder().fit_transform(self.train['usertag'])
+
+    def time_one_hot_encoding(self, rows):
+        one_hot_encoding(add_features(self.train.copy()), columns_to_encode=categorical_columns)
+
+    def time_target_encoding(self, rows):
+        data = add_features(merge_datasets(self.train, self.validation, self.test))
+        target_encoding(data, n_train=self.train.shape[0], columns=categorical_columns, seed=benchmark_seed)
+
+    def time_downsampling(self, rows):
+        downsampling_majority_class(self.train, class_ratio=minority_class, seed=benchmark_seed)
+
+    def time_aggregate_cube(self, rows):
+        aggregate_cube(add_features(self.train.copy()))
+
+    def peakmem_feature_engineering(self, rows):
+        benchmark_features(self.train, self.validation, self.test)
+
+
+class ModelSuite:
+
+    params = [benchmark_rows, list(benchmark_models)]
+    param_names = ['rows', 'model']
+    timeout = 7200
+
+    def setup(self, rows, model):
+
+        if rows > model_row_limits.get(model, np.inf):
+            raise NotImplementedError('%s is not benchmarked above %d rows' % (model, model_row_limits[model]))
+
+        # The model libraries are only needed by the model benchmarks
+        import C_CTR_Prediction
+        self.function = getattr(C_CTR_Prediction, benchmark_models[model][0])
+        self.arguments = dict(benchmark_models[model][1], use_saved_model='no', to_plot='no')
+
+        # The signature of the model function itself (inspect follows the @profiled wrapper)
+        for argument, value in [('use_gridsearch', 'no'), ('refit', 'no'), ('save_model', 'no')]:
+            if argument in inspect.signature(self.function).parameters:
+                self.arguments[argument] = value
+
+        train, self.validation, _ = benchmark_features_cached(rows)
+        self.train = downsampling_majority_class(train, class_ratio=minority_class, seed=benchmark_seed)
+
+    def time_fit_predict(self, rows, model):
+        # Fit and predict are recorded as separate spans by the model functions
+        self.function(self.train, self.validation, **self.arguments)
+
+
+class StrategySuite:
+
+    params = [benchmark_rows, list(benchmark_parameter_ranges)]
+    param_names = ['rows', 'type']
+    timeout = 3600
+
+    def setup(self, rows, type):
+        _, self.validation, _ = benchmark_logs(rows)
+        self.prediction = benchmark_prediction(self.validation)
+        self.budget = benchmark_budget(self.validation)
+
+    def time_strategy_evaluation(self, rows, type):
+        strategy_evaluation(self.validation, self.prediction, benchmark_parameter_ranges[type], type=type,
+                            budget=self.budget, to_plot='no', repeated_runs=5, average_CTR=average_CTR)
+
+    def time_paced_replay(self, rows, type):
+        strategy_evaluation(self.validation, self.prediction, benchmark_parameter_ranges[type][:5], type=type,
+                            budget=self.budget, to_plot='no', pacing='shading', average_CTR=average_CTR)
+
+
+class ScoringSuite:
+
+    params = [benchmark_rows]
+    param_names = ['rows']
+    timeout = 7200
+
+    def setup(self, rows):
+        self.logs = benchmark_logs(rows)
+        self.file_name = os.path.join(os.getcwd(), 'results', 'benchmark_bidding_price.csv')
+
+    def time_end_to_end(self, rows):
+
+        # Features, logistic model, square bids for the test log and the submission file
+        train, validation, test = self.logs
+        train1, validation1, test1 = benchmark_features(train, validation, test)
+        train2 = downsampling_majority_class(train1, class_ratio=minority_class, seed=benchmark_seed)
+
+        import C_CTR_Prediction
+        model, _ = C_CTR_Prediction.logistic_model(train2, validation1, use_gridsearch='no', refit='no',
+                                                   use_saved_model='no', save_model='no', to_plot='no',
+                                                   **benchmark_models['logistic'][1])
+        test_prediction = normalise_bids(model.predict_proba(model_features(test1))[:, 1],
+                                         minority_weighting=minority_class)
+
+        bids = (test_prediction / average_CTR) ** 2 * 200
+        pd.DataFrame({'bidid': test['bidid'].values, 'bidprice': bids}).to_csv(self.file_name, index=False)
+
+
+benchmark_suites = {'preprocessing': PreprocessingSuite, 'model': ModelSuite, 'strategy': StrategySuite,
+                    'scoring': ScoringSuite}
+
+# ------------------------------ RUNNER ------------------------------------------- #
+
+
+def run_benchmarks(suites=None, rows=None, repeats=3, trace_allocations='no', file_name=None):
+    '''
+    Runs every time_*/peakmem_* method of the suites for each parameter combination, repeats times, inside a
+    profile span named Suite.method(parameters). A failing case is reported and skipped. Returns the summary and
+    the path of the saved profile.
+    '''
+
+    suites = [benchmark_suites[suite] for suite in (suites or list(benchmark_suites))]
+    failures = []
+    start_profiling(trace_allocations=trace_allocations, run_id='benchmark_' + time.strftime('%Y%m%d_%H%M%S'))
+
+    for suite in suites:
+
+        params = [(rows or benchmark_rows) if name == 'rows' else values
+                  for name, values in zip(suite.param_names, suite.params)]
+        methods = [method for method in sorted(dir(suite)) if method.startswith(('time_', 'peakmem_'))]
+
+        for values in itertools.product(*params):
+
+            case = ', '.join('%s=%s' % (name, value) for name, value in zip(suite.param_names, values))
+            benchmark = suite()
+
+            try:
+                with profile_span('%s.setup(%s)' % (suite.__name__, case)):
+                    benchmark.setup(*values)
+            except NotImplementedError as error:
+                print('Skipping %s(%s): %s' % (suite.__name__, case, error))
+                continue
+            except Exception:
+                print('Setup of %s(%s) failed:\n%s' % (suite.__name__, case, traceback.format_exc()))
+                failures.append('%s.setup(%s)' % (suite.__name__, case))
+                continue
+
+            for method in methods:
+                print('Running %s.%s(%s).' % (suite.__name__, method, case))
+
+                # peakmem_ methods are measured by their allocation peak (the process RSS peak never goes down)
+                trace = method.startswith('peakmem_') and not tracemalloc.is_tracing()
+                if trace:
+                    tracemalloc.start()
+
+                try:
+                    for repeat in range(repeats):
+                        with profile_span('%s.%s(%s)' % (suite.__name__, method, case), repeat=repeat):
+                            getattr(benchmark, method)(*values)
+                except Exception:
+                    print('%s.%s(%s) failed:\n%s' % (suite.__name__, method, case, traceback.format_exc()))
+                    failures.append('%s.%s(%s)' % (suite.__name__, method, case))
+                finally:
+                    if trace:
+                        tracemalloc.stop()
+
+    if failures:
+        print('Failed benchmarks: %s' % ', '.join(failures))
+
+    profile_file = save_profile(file_name)
+    summary = profile_summary()
+
+    benchmarks = summary[summary.index.str.contains(r'Suite\.(?:time|peakmem)_')]
+    print(benchmarks[['calls', 'wall_time', 'cpu_time', 'rss_growth_mb', 'allocated_peak_mb']].to_string())
+
+    return summary, profile_file
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the pipeline on synthetic logs.')
+    parser.add_argument('--rows', type=int, nargs='+', default=benchmark_rows)
+    parser.add_argument('--suites', nargs='+', choices=list(benchmark_suites), default=list(benchmark_suites))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--trace-allocations', choices=['yes', 'no'], default='no')
+    parser.add_argument('--output', default=None, help='profile file name (default results/profile_<run id>)')
+    parser.add_argument('--baseline', default=None, help='saved profile to compare this run with')
+    arguments = parser.parse_args()
+
+    summary, profile_file = run_benchmarks(arguments.suites, arguments.rows, arguments.repeats,
+                                           arguments.trace_allocations, arguments.output)
+
+    if arguments.baseline is not None:
+        comparison = compare_profiles(arguments.baseline, profile_file)
+        comparison = comparison[comparison.index.str.contains(r'Suite\.(?:time|peakmem)_')]
+        print(comparison[['wall_time_baseline', 'wall_time_current', 'wall_time_ratio']]
+              .sort_values('wall_time_ratio').to_string())
+
+####################### END ########################
@@ -0,0 +1,127 @@
+"""
+Project:
+    COMPGW02/M041 Web Economics Coursework Project
+
+Description:
+    In this assignment, we are required to work on an online advertising problem. We will help advertisers to form
+    a bidding strategy in order to place their ads online in a realtime bidding system. We are required to train a
+    bidding strategy based on a provided advertising impression training set. This project aims to help us understand
+    some basic concepts and write a computer program in real-time bidding based display advertising. As we will be
+    evaluated both as a group as well as individually, part of the assignment is to train a model of our choice
+    independently. The performance of the model trained by the team, which is either a combination of the
+    individually developed models or the best performing individually-developed model, will be (mainly) evaluated
+    on the Click-through Rate achieved on a provided test set.
+
+    Batch bid generation for large test logs. The raw csv is read in chunks, and every chunk goes through the
+    saved feature encoder, the saved model, the calibration table (or normalise_bids) and a bid function before its
+    bidid,bidprice rows are appended to the output, so memory stays constant whatever the size of the file. The
+    model and the encoder are written by F_Run_Script.py (save_model = 'yes'):
+
+        python code/H_Batch_Bidding.py --test data/test.csv --bid-type square --parameter 200
+
+Authors:
+  Sven Sabas
+
+Date:
+  22/02/2018
+"""
+
+# ------------------------------ IMPORT LIBRARIES --------------------------------- #
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+try:
+    from sklearn.externals import joblib
+except ImportError: # Newer scikit-learn versions no longer ship it
+    import joblib
+
+# And own libraries
+working_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(working_dir)
+from B_Data_Preprocessing import encode_features, model_features
+from D_Bidding_Strategies import normalise_bids, calibrate_predictions, bid_function_grid, bid_functions
+from E_Pipeline_Utilities import start_profiling, profile_span, save_profile
+
+# ------------------------------ BATCH BIDDING ------------------------------------ #
+
+
+def batch_bids(test_file, output_file, model, feature_encoder, bid_type='square', parameter=200,
+               average_CTR=7.375623e-04, minority_class=0.025, calibration=None, chunksize=100000):
+    '''
+    Scores test_file chunk by chunk and writes bidid,bidprice to output_file as it goes. parameter is a number
+    (or a pair for the two-parameter bid functions); with a calibration table the scores are looked up in it
+    instead of going through normalise_bids. Returns the number of rows and the rows per second.
+    '''
+
+    start_time = time.time()
+    rows = 0
+
+    # Bid buffers reused by every chunk
+    parameter = np.atleast_1d(np.asarray(parameter, dtype=np.float64))
+    out = np.empty((1, chunksize))
+    work = np.empty_like(out)
+
+    with open(output_file, 'w') as output:
+
+        output.write('bidid,bidprice\n')
+
+        for chunk in pd.read_csv(test_file, chunksize=chunksize, dtype={'usertag': str}):
+
+            with profile_span('batch_bids.chunk', rows=len(chunk)):
+
+                # Same features, model and normalisation as the submission in the run script
+                features = encode_features(chunk, feature_encoder)
+                prediction = model.predict_proba(model_features(features))[:, 1]
+                if calibration is not None:
+                    prediction = calibrate_predictions(prediction, calibration)
+                else:
+                    prediction = normalise_bids(prediction, minority_weighting=minority_class)
+                bids = bid_function_grid(prediction, parameter, type=bid_type, average_CTR=average_CTR,
+                                         out=out[:, :len(chunk)], work=work[:, :len(chunk)])[0]
+
+                pd.DataFrame({'bidid': chunk['bidid'].values, 'bidprice': bids}).to_csv(output, header=False,
+                                                                                       index=False)
+
+            rows += len(chunk)
+            print('Scored %d rows (%.0f rows/sec).' % (rows, rows / (time.time() - start_time)))
+
+    rows_per_second = rows / (time.time() - start_time)
+    print('Wrote bids for %d rows to %s in %.2f seconds (%.0f rows/sec).'
+          % (rows, output_file, time.time() - start_time, rows_per_second))
+
+    return rows, rows_per_second
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Streams a test log through the saved model and writes bids.')
+    parser.add_argument('--test', default=os.getcwd() + '/data/test.csv')
+    parser.add_argument('--output', default=os.getcwd() + '/results/testing_bidding_price.csv')
+    parser.add_argument('--model', default=os.getcwd() + '/models/submission_model.pkl')
+    parser.add_argument('--encoder', default=os.getcwd() + '/models/feature_encoder.pkl')
+    parser.add_argument('--bid-type', default='square', choices=list(bid_functions))
+    parser.add_argument('--parameter', type=float, nargs='+', default=[200])
+    parser.add_argument('--average-ctr', type=float, default=7.375623e-04)
+    parser.add_argument('--minority-class', type=float, default=0.025)
+    parser.add_argument('--calibration', default=None, help='calibration table saved by the run script')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--profile', choices=['yes', 'no'], default='no', help='save a run profile to results/')
+    arguments = parser.parse_args()
+
+    start_profiling()
+
+    batch_bids(arguments.test, arguments.output, joblib.load(arguments.model), joblib.load(arguments.encoder),
+               bid_type=arguments.bid_type, parameter=arguments.parameter, average_CTR=arguments.average_ctr,
+               minority_class=arguments.minority_class,
+               calibration=joblib.load(arguments.calibration) if arguments.calibration else None,
+               chunksize=arguments.chunksize)
+
+    if arguments.profile == 'yes':
+        save_profile()
+
+####################### END ########################
@@ -0,0 +1,65 @@
+"""
+Second price clearing and the budget multiplier of D_Bidding_Strategies on hand cases and a seeded synthetic log.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from B_Data_Preprocessing import synthetic_log
+from D_Bidding_Strategies import clear_auctions, fit_bid_landscape, expected_spend, optimal_lambda, lagrangian_bids
+
+
+def test_clear_auctions_second_price():
+    # 3 agents x 3 auctions
+    bids = np.array([[10, 0, 5],
+                     [7, 3, 0],
+                     [2, 0, 0]], dtype=np.float64)
+    market_price = np.array([5, 4, 1], dtype=np.float64)
+
+    winner, won, price = clear_auctions(bids, market_price)
+
+    # Top bid wins and pays the larger of the second bid and the market price; 3 does not beat a market price of 4
+    assert list(winner) == [0, 1, 0]
+    assert list(won) == [True, False, True]
+    assert list(price) == [7, 4, 1]
+
+
+def test_clear_auctions_without_market_price():
+    winner, won, price = clear_auctions(np.array([[0, 4, 2], [0, 6, 2], [0, 1, 2]], dtype=np.float64))
+
+    assert list(won) == [False, True, True]
+    assert list(winner[won]) == [1, 0]
+    assert list(price[won]) == [4, 2]
+
+
+@pytest.fixture(scope='module')
+def landscape():
+    data = synthetic_log(5000, seed=500)
+    prediction = np.clip(np.random.default_rng(7).beta(0.5, 400, len(data)), 1e-6, 1)
+    return fit_bid_landscape(data, segment_columns=[]), prediction
+
+
+@pytest.mark.parametrize('type,c', [('linear', None), ('ORTB1', 50)])
+def test_optimal_lambda_spends_the_budget(landscape, type, c):
+    landscape, prediction = landscape
+    budget = 0.3 * expected_spend(landscape, prediction, 1e-12, type=type, c=c)
+
+    lambda_ = optimal_lambda(landscape, prediction, budget, type=type, c=c, tolerance=1e-3)
+
+    assert abs(expected_spend(landscape, prediction, lambda_, type=type, c=c) - budget) <= 1e-3 * budget
+
+
+def test_optimal_lambda_bounds(landscape):
+    landscape, prediction = landscape
+    full_spend = expected_spend(landscape, prediction, 1e-12)
+
+    assert optimal_lambda(landscape, prediction, 2 * full_spend) == 1e-12
+    assert optimal_lambda(landscape, prediction, 1.0, upper=1e-6) == 1e-6
+
+
+def test_lagrangian_bids_unknown_type():
+    with pytest.raises(ValueError):
+        lagrangian_bids(np.ones(3), 1e-3, type='square')
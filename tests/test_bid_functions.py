@@ -0,0 +1,88 @@
+"""
+Pinned results of the bid function registry and the strategy functions on a seeded synthetic log.
+
+The numbers were computed with the strategy functions of the original code (before the registry), which use the
+click rate of the log as average CTR, except for ORTB2: its original formula had b * 2 instead of b ** 2, so its
+numbers come from a per-auction loop over the formula in the ORTB_strategy docstring.
+"""
+
+import os
+import sys
+import tracemalloc
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from B_Data_Preprocessing import synthetic_log
+from D_Bidding_Strategies import evaluate_bid_grid, constant_bidding_strategy, parametrised_bidding_strategy, \
+    ORTB_strategy, benchmark_bid_functions
+
+BUDGET = 200000
+
+# type, parameter, (impressions, clicks, ads auctioned)
+PINNED = [('constant', 50, (5107, 5, 20000)), ('constant', 80, (4054, 5, 7554)), ('constant', 120, (3175, 2, 4208)),
+          ('linear', 100, (2555, 3, 5035)), ('linear', 200, (2411, 1, 3816)),
+          ('square', 150, (2326, 2, 4439)), ('square', 200, (2317, 2, 4193)),
+          ('exponential', 30, (2665, 3, 5090)), ('exponential', 40, (2678, 3, 4386)),
+          ('ORTB1', (10, 5e-7), (2848, 2, 5155)), ('ORTB1', (50, 2e-6), (2826, 2, 5810)),
+          ('ORTB2', (20, 1e-6), (3530, 3, 8182)), ('ORTB2', (80, 5e-6), (3094, 2, 7609)),
+          ('ORTBx', (250, 0), (2309, 2, 4105)), ('ORTBx', (220, 30), (2420, 1, 3828)),
+          ('ORTBy', (250, -10), (2312, 2, 4149)), ('ORTBy', (280, 20), (2298, 1, 3894))]
+
+
+@pytest.fixture(scope='module')
+def log():
+    data = synthetic_log(20000, seed=500)
+    prediction = np.clip(np.random.default_rng(7).beta(0.5, 400, len(data)), 1e-6, 1)
+    return data, prediction
+
+
+def average_CTR(type, data):
+    # The parametrised strategies were pinned on the click rate of the log, ORTB on the default
+    return np.sum(data['click'] == 1) / data.shape[0] if type in ['linear', 'square', 'exponential'] \
+        else 7.375623e-04
+
+
+@pytest.mark.parametrize('type,parameter,expected', PINNED)
+def test_evaluate_bid_grid(log, type, parameter, expected):
+    data, prediction = log
+    result = evaluate_bid_grid(data, prediction, [parameter], type=type, budget=BUDGET,
+                               average_CTR=average_CTR(type, data))
+    assert tuple(int(metric[0]) for metric in result) == expected
+
+
+@pytest.mark.parametrize('type,parameter,expected', PINNED)
+def test_strategy_functions(log, type, parameter, expected):
+    data, prediction = log
+
+    if type == 'constant':
+        result = constant_bidding_strategy(data, parameter, budget=BUDGET)
+    elif type[0:4] == 'ORTB':
+        result = ORTB_strategy(data, prediction, type=type, c=parameter[0], b=parameter[1], budget=BUDGET)
+    else:
+        result = parametrised_bidding_strategy(data, prediction, type=type, parameter=parameter, budget=BUDGET)
+
+    assert tuple(int(metric) for metric in result) == expected
+
+
+def test_evaluate_bid_grid_chunks(log):
+    data, prediction = log
+    parameters = [50, 80, 120]
+    whole = evaluate_bid_grid(data, prediction, parameters, type='constant', budget=BUDGET)
+    chunked = evaluate_bid_grid(data, prediction, parameters, type='constant', budget=BUDGET, chunk_size=2)
+    assert all(np.array_equal(a, b) for a, b in zip(whole, chunked))
+    assert [tuple(int(metric[i]) for metric in whole) for i in range(3)] == [expected for _, _, expected in PINNED[:3]]
+
+
+@pytest.mark.parametrize('type,parameters', [('linear', [100, 200]), ('ORTB2', [(20, 1e-6), (80, 5e-6)])])
+def test_benchmark_bid_functions_keeps_outer_trace(log, type, parameters):
+    _, prediction = log
+    tracemalloc.start()
+    try:
+        table = benchmark_bid_functions(prediction, parameters, type=type, repeats=1)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    assert list(table['method']) == ['np.repeat per parameter', 'bid_function_grid']
+    assert (table['peak_MB_allocated'] > 0).all()
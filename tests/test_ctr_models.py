@@ -0,0 +1,61 @@
+"""
+Sparse click models of C_CTR_Prediction on a small seeded one-hot problem (skipped without the model libraries).
+"""
+
+import os
+import sys
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from sklearn.metrics import log_loss
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+C = pytest.importorskip('C_CTR_Prediction')
+
+
+@pytest.fixture(scope='module')
+def one_hot():
+    # Three fields of four categories; the click rate depends on the first two fields and their interaction
+    generator = np.random.default_rng(500)
+    categories = generator.integers(0, 4, (3000, 3))
+    X = sp.csr_matrix((np.ones(categories.size, dtype=np.float32),
+                       (np.repeat(np.arange(3000), 3), (categories + np.arange(3) * 4).ravel())), shape=(3000, 12))
+    logit = -1.5 + 1.0 * (categories[:, 0] == 1) + 1.5 * ((categories[:, 0] == 2) & (categories[:, 1] == 3))
+    y = (generator.random(3000) < 1 / (1 + np.exp(-logit))).astype(int)
+    return X, y, np.repeat(np.arange(3), 4)
+
+
+@pytest.mark.parametrize('solver', ['sgd', 'adagrad'])
+def test_field_aware_factorization_machine_loss_decreases(one_hot, solver):
+    X, y, fields = one_hot
+    parameters = dict(fields=fields, rank=2, learning_rate=0.1, solver=solver, batch_size=256, n_iter_no_change=20)
+
+    # Same seed, so both start from the same weights
+    initial = C.FieldAwareFactorizationMachine(n_iter=0, **parameters).fit(X[:2500], y[:2500], X[2500:], y[2500:])
+    trained = C.FieldAwareFactorizationMachine(n_iter=10, **parameters).fit(X[:2500], y[:2500], X[2500:], y[2500:])
+
+    assert log_loss(y[:2500], trained.predict_proba(X[:2500])[:, 1]) < \
+        log_loss(y[:2500], initial.predict_proba(X[:2500])[:, 1])
+    assert trained.best_validation_auc_ > 0.6
+
+
+def test_field_aware_factorization_machine_predict_proba(one_hot):
+    X, y, fields = one_hot
+    model = C.FieldAwareFactorizationMachine(fields=fields, rank=2, n_iter=2).fit(X, y)
+
+    probability = model.predict_proba(X)
+    assert probability.shape == (X.shape[0], 2)
+    assert np.allclose(probability.sum(axis=1), 1)
+    assert model.predict_proba(X[:0]).shape == (0, 2)
+
+
+def test_field_embedding_mlp_loss_decreases(one_hot):
+    X, y, fields = one_hot
+    parameters = dict(fields=fields, embedding_dim=4, hidden_layer_sizes=(8,), batch_size=256, n_iter_no_change=20)
+
+    initial = C.FieldEmbeddingMLPClassifier(max_iter=0, **parameters).fit(X[:2500], y[:2500], X[2500:], y[2500:])
+    trained = C.FieldEmbeddingMLPClassifier(max_iter=10, **parameters).fit(X[:2500], y[:2500], X[2500:], y[2500:])
+
+    assert log_loss(y[:2500], trained.predict_proba(X[:2500])[:, 1]) < \
+        log_loss(y[:2500], initial.predict_proba(X[:2500])[:, 1])
+    assert trained.predict_proba(X).shape == (X.shape[0], 2)
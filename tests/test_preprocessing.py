@@ -0,0 +1,81 @@
+"""
+Streaming sketches and target encoding of B_Data_Preprocessing on small seeded data.
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from B_Data_Preprocessing import HyperLogLog, QuantileDigest, RunningMoments, describe_from_statistics, \
+    target_encoding
+
+
+def test_hyperloglog_merge_within_error_bound():
+    generator = np.random.default_rng(500)
+    first, second = generator.integers(0, 10 ** 9, 60000), generator.integers(0, 10 ** 9, 60000)
+
+    sketch = HyperLogLog(precision=12).update(first).merge(HyperLogLog(precision=12).update(second))
+    true_count = len(np.unique(np.concatenate([first, second])))
+
+    assert abs(sketch.estimate() - true_count) / true_count <= 3 * 1.04 / np.sqrt(2 ** 12)
+
+
+def test_hyperloglog_counts_int_and_float_chunks_alike():
+    values = np.arange(1000)
+    assert HyperLogLog().update(values).estimate() == HyperLogLog().update(values.astype(np.float64)).estimate()
+
+
+def test_quantile_digest_merge():
+    generator = np.random.default_rng(500)
+    values = generator.normal(0, 1, 100000)
+
+    digest = QuantileDigest().update(values[:50000]).merge(QuantileDigest().update(values[50000:]))
+
+    assert np.allclose(digest.quantile([0.01, 0.5, 0.99]), np.quantile(values, [0.01, 0.5, 0.99]), atol=0.02)
+    assert digest.quantile(0) == values.min() and digest.quantile(1) == values.max()
+
+
+def test_running_moments_merge_matches_numpy():
+    generator = np.random.default_rng(500)
+    values = generator.normal(5, 2, (1000, 2))
+
+    moments = RunningMoments(2).update(values[:300]).merge(RunningMoments(2).update(values[300:]))
+
+    assert moments.count == 1000
+    assert np.allclose(moments.mean, values.mean(axis=0))
+    assert np.allclose(moments.std(), values.std(axis=0, ddof=1))
+
+
+def test_describe_empty_column_is_nan():
+    statistics = {'moments': {'urlid': RunningMoments().update(np.full(10, np.nan))},
+                  'quantiles': {'urlid': QuantileDigest().update(np.full(10, np.nan))}}
+
+    row = describe_from_statistics(statistics).loc['urlid']
+
+    assert row['count'] == 0
+    assert row.drop('count').isna().all()
+
+
+def test_target_encoding_is_out_of_fold():
+    generator = np.random.default_rng(500)
+    data = pd.DataFrame({'click': (generator.random(1000) < 0.2).astype(int),
+                         'region': generator.integers(0, 5, 1000)})
+
+    # Without smoothing a training row is encoded by the clicks of the other folds only
+    encoded, _ = target_encoding(data.copy(), 800, columns=['region'], crosses=[], smoothing=0)
+    flipped = data.copy()
+    flipped.loc[3, 'click'] = 1 - flipped.loc[3, 'click']
+    encoded_flipped, _ = target_encoding(flipped, 800, columns=['region'], crosses=[], smoothing=0)
+
+    assert encoded['te_region'][3] == encoded_flipped['te_region'][3]
+    assert not np.array_equal(encoded['te_region'].values, encoded_flipped['te_region'].values)
+
+    folds = np.random.RandomState(500).randint(0, 5, 800)
+    other_folds = (data['region'].values[:800] == data['region'][3]) & (folds != folds[3])
+    assert np.isclose(encoded['te_region'][3], data['click'].values[:800][other_folds].mean())
+
+    # Rows after n_train use the full training statistics
+    train_CTR = data[:800].groupby('region')['click'].mean()
+    assert np.allclose(encoded['te_region'].values[800:], train_CTR[data['region'].values[800:]].values)